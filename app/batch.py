@@ -0,0 +1,71 @@
+# app/batch.py
+# 一括処理 (/analyze_purpose/batch/) の補助
+# 重複の除去、プロンプトの前半 (知識ベース) が同じ要素のグループ化、同時実行数を制限した実行、
+# NDJSON (1行1JSON) での逐次出力を行う。
+
+import asyncio
+import json
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Sequence, Tuple, TypeVar
+
+from fastapi import HTTPException
+
+T = TypeVar("T")
+
+
+def ndjson_line(value: Dict[str, Any]) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def dedupe(keys: Sequence[str]) -> "OrderedDict[str, List[int]]":
+    """キーごとに元の位置 (インデックス) をまとめる。順序は最初に現れた順。"""
+    unique: "OrderedDict[str, List[int]]" = OrderedDict()
+    for index, key in enumerate(keys):
+        unique.setdefault(key, []).append(index)
+    return unique
+
+
+def group_by(items: Sequence[T], key: Callable[[T], Hashable]) -> List[List[T]]:
+    """同じキーの要素をまとめる。大きいグループから順に並べ、グループ内は元の順序を保つ。"""
+    groups: Dict[Hashable, List[T]] = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return sorted(groups.values(), key=len, reverse=True)
+
+
+def chunked(items: Sequence[T], size: int) -> List[List[T]]:
+    size = max(1, size)
+    return [list(items[i:i + size]) for i in range(0, len(items), size)]
+
+
+def error_detail(exc: BaseException) -> Dict[str, Any]:
+    """要素ごとのエラーを、HTTPエラー応答と同じ形 (status, detail) で表す。"""
+    if isinstance(exc, HTTPException):
+        return {"status": exc.status_code, "detail": exc.detail}
+    return {"status": 500, "detail": f"{type(exc).__name__}: {exc}"}
+
+
+async def run_bounded(jobs: Sequence[Tuple[Any, Callable[[], Awaitable[Any]]]], limit: int) -> AsyncIterator[Tuple[Any, Any, BaseException]]:
+    """(タグ, ジョブ) を最大 limit 件ずつ並行に実行し、終わったものから (タグ, 結果, 例外) を返す。
+
+    ジョブは渡された順に開始する。呼び出し側が途中で読むのをやめた場合 (クライアントの切断など) は、
+    残りのジョブをキャンセルする。
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(tag: Any, job: Callable[[], Awaitable[Any]]):
+        async with semaphore:
+            try:
+                return tag, await job(), None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                return tag, None, e
+
+    tasks = [asyncio.ensure_future(run(tag, job)) for tag, job in jobs]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
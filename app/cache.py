@@ -0,0 +1,269 @@
+# app/cache.py
+# Gemini応答キャッシュ
+# 同一 (または空白・表記揺れだけが違う) UserPayload の二重送信やリトライで、
+# 数秒かかる generate_content_async を何度も呼ばないようにする。
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+def _normalize_value(value: Any) -> Any:
+    if isinstance(value, str):
+        # 全角/半角・連続空白・前後の空白の違いは同じ要件とみなす
+        return " ".join(unicodedata.normalize("NFKC", value).split())
+    return value
+
+
+def make_cache_key(endpoint: str, model_name: str, payload: Dict[str, Any], language: Optional[str], kb_hash: str) -> str:
+    normalized = {k: _normalize_value(v) for k, v in sorted(payload.items()) if k != "language"}
+    material = json.dumps(
+        [endpoint, model_name, normalized, language or "", kb_hash],
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    """プロセス内のLRUキャッシュ (TTL・件数上限・メモリ上限つき)。"""
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._data: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(value: str) -> int:
+        return len(value.encode("utf-8"))
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._data.pop(key)
+        self._bytes -= self._size(value)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        size = self._size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, time.time() + ttl)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"backend": "memory", "entries": len(self._data), "bytes": self._bytes, "evictions": self.evictions}
+
+
+class SQLiteCacheBackend:
+    """SQLiteファイルに保存するキャッシュ。gunicornワーカーの再起動後も残り、ワーカー間で共有される。"""
+
+    def __init__(self, path: str, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024, table: str = "response_cache"):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+                " expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_access ON {self.table} (last_access)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            return None
+        conn.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now + ttl, now),
+            )
+            conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+            count, total = conn.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+            while count > self.max_entries or total > self.max_bytes:
+                oldest = conn.execute(
+                    f"SELECT key, size FROM {self.table} ORDER BY last_access LIMIT 1"
+                ).fetchone()
+                if oldest is None:
+                    break
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (oldest[0],))
+                count -= 1
+                total -= oldest[1]
+                self.evictions += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, key: str) -> None:
+        self._connect().execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        self._connect().execute(f"DELETE FROM {self.table}")
+
+    def stats(self) -> Dict[str, Any]:
+        count, total = self._connect().execute(
+            f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}"
+        ).fetchone()
+        return {"backend": "sqlite", "path": self.path, "table": self.table, "entries": count, "bytes": total, "evictions": self.evictions}
+
+
+class ResponseCache:
+    """バックエンドの前段で、同時に届いた同一リクエストを1回の上流呼び出しにまとめる。"""
+
+    def __init__(self, backend, ttl: float = 3600.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._inflight: Dict[str, "asyncio.Task[str]"] = {}
+
+    def get(self, key: str) -> Optional[str]:
+        """キャッシュ済みの値だけを返す (無くても計算しない)。"""
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logging.warning(f"応答キャッシュの読み込みに失敗しました: {e}")
+            return None
+        if value is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[str]]) -> Tuple[str, bool]:
+        """キャッシュ済みの値を返す。無ければ compute() を1回だけ実行する。
+
+        戻り値は (値, キャッシュから返したか)。同時実行中のリクエストに相乗りした場合もヒット扱い。
+        """
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logging.warning(f"応答キャッシュの読み込みに失敗しました: {e}")
+            value = None
+        if value is not None:
+            self.hits += 1
+            return value, True
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+
+        self.misses += 1
+        task = asyncio.ensure_future(self._compute_and_store(key, compute))
+        self._inflight[key] = task
+        # クライアントが切断しても、相乗りしている他のリクエストのために上流呼び出しは継続する
+        return await asyncio.shield(task), False
+
+    async def _compute_and_store(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        try:
+            value = await compute()
+            try:
+                self.backend.set(key, value, self.ttl)
+            except Exception as e:
+                logging.warning(f"応答キャッシュへの書き込みに失敗しました: {e}")
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.coalesced + self.misses
+        stats = {
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "in_flight": len(self._inflight),
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+        }
+        stats.update(self.backend.stats())
+        return stats
+
+
+def create_response_cache(
+    backend: str,
+    ttl: float,
+    max_entries: int,
+    max_bytes: int,
+    sqlite_path: str,
+) -> Optional[ResponseCache]:
+    """設定に応じてキャッシュを作る。backend が 'off' の場合は None。"""
+    backend = backend.lower()
+    if backend in ("off", "none", "disabled", ""):
+        return None
+    if backend == "sqlite":
+        return ResponseCache(SQLiteCacheBackend(sqlite_path, max_entries=max_entries, max_bytes=max_bytes), ttl=ttl)
+    if backend != "memory":
+        logging.warning(f"不明なキャッシュバックエンド '{backend}' が指定されたため、memory を使用します。")
+    return ResponseCache(MemoryCacheBackend(max_entries=max_entries, max_bytes=max_bytes), ttl=ttl)
@@ -0,0 +1,124 @@
+# app/catalog.py
+# 知識ベースの参照API (/knowledge_base/entries) の検索とページ分割
+# 一覧の各要素は、スナップショット作成時にシリアライズ済みのエントリJSONに
+# カテゴリと正規化した費用区分を付けた文字列を、スナップショットごとに一度だけ作って連結する。
+# ページ分割は知識ベース内の位置をキーにしたカーソル方式。カーソルには知識ベースのハッシュを含め、
+# 再読み込みで並びが変わった後の古いカーソルは受け付けない。
+
+import base64
+import json
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from app.knowledge_base import KnowledgeRecord, KnowledgeSnapshot
+from app.retrieval import tokenize
+
+# 全文検索の対象 (00_ai_models.json は use_case / features)
+_SEARCH_FIELDS = ("name", "functions", "use_cases", "use_case", "features")
+
+
+class StaleCursorError(ValueError):
+    """カーソルを発行した後に知識ベースが更新された。"""
+
+
+def _search_terms(record: KnowledgeRecord) -> FrozenSet[str]:
+    parts = []
+    for key in _SEARCH_FIELDS:
+        value = record.data.get(key)
+        if isinstance(value, str):
+            parts.append(value)
+        elif isinstance(value, list):
+            parts.extend(str(v) for v in value)
+    return frozenset(tokenize(" ".join(parts)))
+
+
+def _item_json(record: KnowledgeRecord) -> str:
+    meta = json.dumps({"category": record.category, "cost_tier": record.cost_tier}, ensure_ascii=False)
+    return meta[:-1] + ', "entry": ' + record.serialized + "}"
+
+
+class Catalog:
+    """知識ベースのスナップショットごとに1つ作る。"""
+
+    def __init__(self, snapshot: KnowledgeSnapshot):
+        self.snapshot = snapshot
+        self.items: List[str] = [_item_json(record) for record in snapshot.records]
+        self.terms: List[FrozenSet[str]] = [_search_terms(record) for record in snapshot.records]
+
+    def query(
+        self,
+        type: Optional[str] = None,
+        cost_tier: Optional[str] = None,
+        category: Optional[str] = None,
+        q: Optional[str] = None,
+    ) -> List[int]:
+        """条件に一致するエントリの位置を知識ベースの並び順で返す。q は全ての語を含むものに絞る。"""
+        if type is None and cost_tier is None and category is None:
+            positions = list(range(len(self.snapshot.records)))
+        else:
+            positions = self._positions(type, cost_tier, category)
+        query_terms = set(tokenize(q)) if q else set()
+        if query_terms:
+            positions = [p for p in positions if query_terms <= self.terms[p]]
+        return positions
+
+    def _positions(self, type: Optional[str], cost_tier: Optional[str], category: Optional[str]) -> List[int]:
+        matched: Optional[set] = None
+        for index, key in ((self.snapshot.by_type, type), (self.snapshot.by_cost_tier, cost_tier), (self.snapshot.by_category, category)):
+            if key is None:
+                continue
+            found = set(index.get(key, ()))
+            matched = found if matched is None else matched & found
+        return sorted(matched or ())
+
+    def page(self, positions: List[int], limit: int, cursor: Optional[str] = None) -> Tuple[List[int], Optional[str]]:
+        """カーソルの次から limit 件を返す。続きがあれば次のカーソルも返す。"""
+        after = decode_cursor(cursor, self.snapshot.hash) if cursor else -1
+        remaining = [p for p in positions if p > after]
+        page = remaining[:limit]
+        next_cursor = encode_cursor(self.snapshot.hash, page[-1]) if len(remaining) > limit else None
+        return page, next_cursor
+
+    def render_page(self, positions: List[int], total: int, next_cursor: Optional[str]) -> str:
+        envelope = json.dumps({"total": total, "next_cursor": next_cursor, "knowledge_base_hash": self.snapshot.hash}, ensure_ascii=False)
+        return envelope[:-1] + ', "items": [' + ", ".join(self.items[p] for p in positions) + "]}"
+
+    def render_entry(self, record: KnowledgeRecord) -> str:
+        return self.items[self.snapshot.by_name[record.name.strip().lower()]]
+
+    def facets(self) -> Dict[str, object]:
+        return {
+            "knowledge_base_hash": self.snapshot.hash,
+            "entries": len(self.snapshot.records),
+            "categories": {category: len(positions) for category, positions in self.snapshot.by_category.items()},
+            "types": {type: len(positions) for type, positions in self.snapshot.by_type.items()},
+            "cost_tiers": {tier: len(positions) for tier, positions in self.snapshot.by_cost_tier.items()},
+        }
+
+
+def encode_cursor(knowledge_base_hash: str, position: int) -> str:
+    raw = f"{knowledge_base_hash[:16]}:{position}".encode("ascii")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, knowledge_base_hash: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        prefix, position = raw.split(":", 1)
+        position = int(position)
+    except ValueError as e:
+        raise ValueError(f"不正なカーソルです: {cursor}") from e
+    if prefix != knowledge_base_hash[:16]:
+        raise StaleCursorError("知識ベースが更新されたため、このカーソルは使えません。最初のページから取得し直してください。")
+    return position
+
+
+_catalog: Optional[Catalog] = None
+
+
+def catalog_for(snapshot: KnowledgeSnapshot) -> Catalog:
+    """スナップショットが差し替わった (知識ベースが再読み込みされた) 場合だけ作り直す。"""
+    global _catalog
+    current = _catalog
+    if current is None or current.snapshot is not snapshot:
+        current = _catalog = Catalog(snapshot)
+    return current
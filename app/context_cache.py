@@ -0,0 +1,97 @@
+# app/context_cache.py
+# Geminiのコンテキストキャッシュ (CachedContent) に知識ベース全体を載せる
+# 知識ベースはリクエスト間で共通のため、一度キャッシュしておけば毎回送信・課金・処理されずに済む。
+# コンテキストキャッシュはバージョン固定のモデル名 (例: models/gemini-1.5-flash-002) と
+# 32kトークン以上の内容が必要なため、設定されたモデルに対してのみ有効にする。
+# 知識ベースが再読み込みされた場合は、次の呼び出しで新しい内容のキャッシュを作り直す。
+
+import asyncio
+import datetime
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+import google.generativeai as genai
+from google.generativeai import caching
+
+# 有効期限の少し前に作り直す
+_REFRESH_MARGIN_SECONDS = 60
+# 作成に失敗した場合、しばらくは通常のプロンプトで処理する
+_FAILURE_BACKOFF_SECONDS = 300
+
+
+class KnowledgeContextCache:
+    def __init__(
+        self,
+        model_versions: Dict[str, str],
+        ttl_seconds: int = 3600,
+        create: Optional[Callable[..., Any]] = None,
+        model_factory: Optional[Callable[[Any], Any]] = None,
+    ):
+        # エンドポイントで使うモデル名 -> コンテキストキャッシュを作成するバージョン固定のモデル名
+        self.model_versions = {k: v for k, v in model_versions.items() if v}
+        self.ttl_seconds = ttl_seconds
+        self._create = create
+        self._model_factory = model_factory
+        self._models: Dict[str, Any] = {}
+        self._expires_at: Dict[str, float] = {}
+        self._knowledge_base_hashes: Dict[str, str] = {}
+        self._disabled_until: Dict[str, float] = {}
+        self._lock = asyncio.Lock()
+
+    def enabled_for(self, model_name: str) -> bool:
+        return model_name in self.model_versions
+
+    def _fresh_model(self, model_name: str, knowledge_base_hash: str) -> Optional[Any]:
+        if self._knowledge_base_hashes.get(model_name) != knowledge_base_hash:
+            return None
+        if self._expires_at.get(model_name, 0) - _REFRESH_MARGIN_SECONDS > time.time():
+            return self._models.get(model_name)
+        return None
+
+    async def get_model(self, model_name: str, knowledge_base: str, knowledge_base_hash: str) -> Optional[Any]:
+        """知識ベースをキャッシュ済みのモデルを返す。使えない場合は None (通常のプロンプトで処理する)。"""
+        if not self.enabled_for(model_name) or self._disabled_until.get(model_name, 0) > time.time():
+            return None
+        model = self._fresh_model(model_name, knowledge_base_hash)
+        if model is not None:
+            return model
+        async with self._lock:
+            model = self._fresh_model(model_name, knowledge_base_hash)
+            if model is not None:
+                return model
+            try:
+                model = await asyncio.to_thread(self._create_model, model_name, knowledge_base)
+            except Exception as e:
+                logging.warning(f"Geminiコンテキストキャッシュの作成に失敗しました。通常のプロンプトで処理します: {e}")
+                self._disabled_until[model_name] = time.time() + _FAILURE_BACKOFF_SECONDS
+                return None
+            self._models[model_name] = model
+            self._expires_at[model_name] = time.time() + self.ttl_seconds
+            self._knowledge_base_hashes[model_name] = knowledge_base_hash
+            logging.info(f"知識ベースをGeminiコンテキストキャッシュに登録しました。(モデル: {self.model_versions[model_name]})")
+            return model
+
+    def _create_model(self, model_name: str, knowledge_base: str) -> Any:
+        create = self._create or caching.CachedContent.create
+        model_factory = self._model_factory or genai.GenerativeModel.from_cached_content
+        cached_content = create(
+            model=self.model_versions[model_name],
+            display_name="ain-knowledge-base",
+            system_instruction="以下はAI Navigatorの知識ベース (ツール・サービスの一覧) です。ユーザーの指示に答える際に参照してください。",
+            contents=[f"# 知識ベース: ```json\n{knowledge_base}\n```"],
+            ttl=datetime.timedelta(seconds=self.ttl_seconds),
+        )
+        return model_factory(cached_content)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            name: {
+                "cached_model": version,
+                "active": self._expires_at.get(name, 0) > now,
+                "knowledge_base_hash": self._knowledge_base_hashes.get(name),
+                "disabled": self._disabled_until.get(name, 0) > now,
+            }
+            for name, version in self.model_versions.items()
+        }
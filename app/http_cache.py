@@ -0,0 +1,133 @@
+# app/http_cache.py
+# 読み取り専用APIの条件付きGETと圧縮
+# ETag は内容 (知識ベースのハッシュとリクエストの条件) から計算するため、応答本文を作る前に
+# If-None-Match を判定して 304 を返せる。圧縮は Accept-Encoding に応じて brotli (インストール
+# されている場合) か gzip を使い、圧縮済みの本文は ETag ごとに小さなLRUで使い回す。
+
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # brotli は任意。無ければ gzip のみ
+    brotli = None
+
+# これより小さい本文は圧縮しない
+MIN_COMPRESS_BYTES = 1024
+
+
+def make_etag(*parts: str) -> str:
+    """強いETagを作る (圧縮の有無は encoding_etag で区別する)。"""
+    digest = hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def encoding_etag(etag: str, encoding: Optional[str]) -> str:
+    # 強いETagはバイト列ごとに異なる必要があるため、圧縮した表現には接尾辞を付ける
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+
+def matching_etag(if_none_match: Optional[str], etag: str) -> Optional[str]:
+    """If-None-Match のうち ETag (どの圧縮形式のものでも) に一致するものを返す。GETでは弱い比較を使う。"""
+    if not if_none_match:
+        return None
+    base = etag.strip('"')
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return etag
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        value = candidate.strip('"')
+        if value == base or value.startswith(base + "-"):
+            return f'"{value}"'
+    return None
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Accept-Encoding から使う圧縮形式を選ぶ (q=0 は除外し、同じ重みなら br を優先)。"""
+    if not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip().lower()] = quality
+    available = (["br"] if brotli is not None else []) + ["gzip"]
+    candidates = [(weights.get(name, weights.get("*", 0.0)), -i, name) for i, name in enumerate(available)]
+    quality, _, name = max(candidates)
+    return name if quality > 0 else None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+class CompressedBodyCache:
+    """(ETag, 圧縮形式) -> 圧縮済みの本文 のLRU。"""
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple[str, str], bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag: str, encoding: str) -> Optional[bytes]:
+        with self._lock:
+            cached = self._entries.get((etag, encoding))
+            if cached is not None:
+                self._entries.move_to_end((etag, encoding))
+            return cached
+
+    def put(self, etag: str, encoding: str, body: bytes) -> None:
+        with self._lock:
+            self._entries[(etag, encoding)] = body
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": sum(len(body) for body in self._entries.values())}
+
+
+def conditional_json_response(
+    request: Request,
+    etag: str,
+    render: Callable[[], str],
+    cache_control: str,
+    compressed_cache: Optional[CompressedBodyCache] = None,
+) -> Response:
+    """ETagが一致すれば本文を作らずに 304 を返し、それ以外は必要に応じて圧縮したJSONを返す。"""
+    headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    encoding = choose_encoding(request.headers.get("accept-encoding"))
+    matched = matching_etag(request.headers.get("if-none-match"), etag)
+    if matched is not None:
+        headers["ETag"] = matched
+        return Response(status_code=304, headers=headers)
+
+    body = compressed_cache.get(etag, encoding) if compressed_cache is not None and encoding is not None else None
+    if body is None:
+        body = render().encode("utf-8")
+        if encoding is not None and len(body) >= MIN_COMPRESS_BYTES:
+            body = compress(body, encoding)
+            if compressed_cache is not None:
+                compressed_cache.put(etag, encoding, body)
+        else:
+            encoding = None
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    headers["ETag"] = encoding_etag(etag, encoding)
+    return Response(content=body, media_type="application/json", headers=headers)
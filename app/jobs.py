@@ -0,0 +1,280 @@
+# app/jobs.py
+# 企画書生成の非同期ジョブ
+# /generate_full_proposal/ は最大で数分間HTTPリクエストを保持するため、プロキシのアイドルタイムアウトで
+# 切断されたり、gunicornのワーカーを占有したりする。ジョブとして受け付けてすぐにIDを返し、
+# 生成はワーカープロセス内のバックグラウンドワーカーで行う。
+# ジョブの状態と結果はセッションと同じバックエンド (メモリ / SQLite) に保存するため、
+# SQLiteを使えばどのワーカーに問い合わせても状態を取得できる。
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import secrets
+import socket
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app.batch import error_detail
+from app.cache import MemoryCacheBackend, SQLiteCacheBackend
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+TERMINAL_STATUSES = (JOB_SUCCEEDED, JOB_FAILED)
+
+
+class JobQueueFullError(HTTPException):
+    """待ち行列が満杯のときに送出する。FastAPIがそのまま 503 + Retry-After を返す。"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail=f"現在ジョブが混み合っています。{retry_after}秒ほど待ってから再度お試しください。",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.retry_after = retry_after
+
+
+@dataclass
+class Job:
+    id: str
+    key: str  # 同一リクエストの判定に使うキー (応答キャッシュと同じ正規化)
+    request: Dict[str, Any]
+    status: str = JOB_QUEUED
+    stage: str = "待機中"
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[Dict[str, Any]] = None
+    owner: str = ""  # 処理しているプロセス (ホスト名:PID)
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def terminal(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def public(self) -> Dict[str, Any]:
+        """APIで返す形 (リクエスト内容と内部のキーは含めない)。"""
+        view = {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.result is not None:
+            view["result"] = self.result
+        if self.error is not None:
+            view["error"] = self.error
+        return view
+
+
+class JobStore:
+    def __init__(self, backend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, job_id: str) -> Optional[Job]:
+        value = self.backend.get(f"job:{job_id}")
+        if value is None:
+            return None
+        return Job(**json.loads(value))
+
+    def save(self, job: Job) -> None:
+        job.updated_at = time.time()
+        self.backend.set(f"job:{job.id}", json.dumps(asdict(job), ensure_ascii=False), self.ttl)
+
+    def find_by_key(self, key: str) -> Optional[Job]:
+        job_id = self.backend.get(f"key:{key}")
+        return self.get(job_id) if job_id else None
+
+    def link_key(self, job: Job) -> None:
+        self.backend.set(f"key:{job.key}", job.id, self.ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"ttl_seconds": self.ttl, **self.backend.stats()}
+
+
+class JobQueue:
+    """待ち行列の長さとワーカー数を制限したジョブ実行器 (ワーカープロセスごとに1つ)。
+
+    実行中・待機中のジョブは heartbeat 秒ごとに更新時刻を書き込む。更新が stale_after 秒以上途絶えたジョブは、
+    処理していたプロセスが終了したものとみなして失敗扱いにする (同じリクエストを再投入すればやり直せる)。
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        runner: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+        workers: int = 2,
+        max_queue: int = 16,
+        retry_after: int = 30,
+        heartbeat: float = 15.0,
+        stale_after: float = 60.0,
+        name: str = "job",
+    ):
+        self.store = store
+        self.runner = runner
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.submitted = 0
+        self.deduplicated = 0
+        self.succeeded = 0
+        self.failed = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._local: Dict[str, Job] = {}
+        self._tasks = []
+        self._lock = asyncio.Lock()
+
+    def _ensure_started(self) -> None:
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        # 投入したリクエストの計測コンテキストなどを引き継がないよう、空のコンテキストで起動する
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.get_running_loop().create_task(self._worker(), context=contextvars.Context()))
+        self._tasks.append(asyncio.get_running_loop().create_task(self._heartbeat(), context=contextvars.Context()))
+
+    def _is_stale(self, job: Job) -> bool:
+        return not job.terminal and job.id not in self._local and time.time() - job.updated_at > self.stale_after
+
+    def _expire_if_stale(self, job: Job) -> Job:
+        if self._is_stale(job):
+            job.status = JOB_FAILED
+            job.stage = "中断"
+            job.error = {"status": 500, "detail": "ジョブを処理していたワーカーが停止しました。再度送信してください。"}
+            job.finished_at = time.time()
+            self.store.save(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        job = self._local.get(job_id) or self.store.get(job_id)
+        return self._expire_if_stale(job) if job is not None else None
+
+    async def submit(self, key: str, request: Dict[str, Any]) -> Tuple[Job, bool]:
+        """ジョブを登録する。同じキーのジョブが待機中・実行中・成功済みなら、それを返す (戻り値の2番目が True)。"""
+        self._ensure_started()
+        async with self._lock:
+            existing = self.store.find_by_key(key)
+            if existing is not None:
+                existing = self._local.get(existing.id, existing)
+                self._expire_if_stale(existing)
+                if existing.status != JOB_FAILED:
+                    self.deduplicated += 1
+                    return existing, True
+            if self._queue.full():
+                raise JobQueueFullError(self.retry_after)
+            job = Job(id=secrets.token_urlsafe(16), key=key, request=request, owner=self.owner)
+            self.store.save(job)
+            self.store.link_key(job)
+            self._local[job.id] = job
+            self._queue.put_nowait(job)
+            self.submitted += 1
+        logging.info(f"ジョブを受け付けました。(ID: {job.id}, 待機中: {self._queue.qsize()}件)")
+        return job, False
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 保存先の障害 (SQLiteのロックなど) でワーカー自体が止まらないよう、このジョブだけを失敗にして続ける
+                logging.exception(f"ジョブの処理中にエラーが発生しました (ID: {job.id})")
+                self._fail(job, e)
+            finally:
+                self._local.pop(job.id, None)
+                self._queue.task_done()
+
+    def _fail(self, job: Job, error: Exception) -> None:
+        if not job.terminal:
+            job.status = JOB_FAILED
+            job.stage = "失敗"
+            job.error = error_detail(error)
+            job.finished_at = time.time()
+            self.failed += 1
+        try:
+            self.store.save(job)
+        except Exception as e:
+            logging.error(f"ジョブの失敗の保存に失敗しました (ID: {job.id}): {e}")
+
+    async def shutdown(self) -> None:
+        """ワーカーとハートビートのタスクを止める (アプリの終了時に呼ぶ)。実行中のジョブは中断として扱われる。"""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queue = None
+
+    async def _run(self, job: Job) -> None:
+        job.status = JOB_RUNNING
+        job.stage = "生成中"
+        job.started_at = time.time()
+        self.store.save(job)
+        try:
+            job.result = await self.runner(job.request)
+            job.status = JOB_SUCCEEDED
+            job.stage = "完了"
+            self.succeeded += 1
+            logging.info(f"ジョブが完了しました。(ID: {job.id}, {time.time() - job.started_at:.1f}秒)")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception(f"ジョブの実行中にエラーが発生しました (ID: {job.id})")
+            job.status = JOB_FAILED
+            job.stage = "失敗"
+            job.error = error_detail(e)
+            self.failed += 1
+        job.finished_at = time.time()
+        try:
+            self.store.save(job)
+        except Exception as e:
+            logging.error(f"ジョブの結果の保存に失敗しました (ID: {job.id}): {e}")
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            for job in list(self._local.values()):
+                try:
+                    self.store.save(job)
+                except Exception as e:
+                    logging.warning(f"ジョブの更新時刻の書き込みに失敗しました (ID: {job.id}): {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "owner": self.owner,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "in_progress": len(self._local),
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "store": self.store.stats(),
+        }
+
+
+def create_job_store(backend: str, ttl: float, max_jobs: int, max_bytes: int, sqlite_path: str) -> JobStore:
+    if backend.lower() == "sqlite":
+        return JobStore(
+            SQLiteCacheBackend(sqlite_path, max_entries=max_jobs, max_bytes=max_bytes, table="proposal_jobs"),
+            ttl=ttl,
+        )
+    return JobStore(MemoryCacheBackend(max_entries=max_jobs, max_bytes=max_bytes), ttl=ttl)
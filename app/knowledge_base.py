@@ -0,0 +1,264 @@
+# app/knowledge_base.py
+# 知識ベース (data/*.json) の読み込みとホットリロード
+# エントリを型付きのレコードに変換し、type / cost_tier / 名前で引けるようにする。
+# ファイルの更新 (mtime・サイズ・内容ハッシュ) を検知すると、プロセスを再起動せずに
+# 新しいスナップショットを丸ごと作り直して差し替える。リクエストは取得したスナップショットを
+# 最後まで使うため、読み込み途中の状態が見えることはない。
+
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.retrieval import COST_TIERS, KnowledgeIndex, category_from_filename
+
+# (ファイル名, mtime_ns, サイズ) の組。変化が無ければファイルを読み直さない
+FileSignature = Tuple[Tuple[str, int, int], ...]
+
+
+@dataclass(frozen=True, slots=True)
+class KnowledgeRecord:
+    name: str
+    category: str
+    type: str
+    cost_tier: str  # 正規化した費用区分 (COST_TIERS のいずれか)
+    cost_tier_detail: str  # 元データの cost_tier (AIモデルは pricing.model)
+    difficulty: float
+    serialized: str  # 読み込み時に一度だけシリアライズしたJSON
+    estimated_tokens: int
+    data: dict
+
+
+@dataclass(frozen=True)
+class KnowledgeSnapshot:
+    """ある時点の知識ベース。作成後は変更しない。"""
+
+    records: Tuple[KnowledgeRecord, ...]
+    index: KnowledgeIndex
+    # カテゴリごとに連結済みのJSON断片 ("{...}, {...}")。プロンプトはこれを繋げるだけで組み立てられる
+    fragments: Dict[str, str]
+    text: str  # 知識ベース全体のJSON (json.dumps(全エントリ, ensure_ascii=False) と同じ)
+    hash: str
+    source_hash: str
+    signature: FileSignature = ()
+    files: Tuple[str, ...] = ()
+    loaded_at: float = field(default_factory=time.time)
+    by_type: Dict[str, Tuple[int, ...]] = field(default_factory=dict)
+    by_cost_tier: Dict[str, Tuple[int, ...]] = field(default_factory=dict)
+    by_category: Dict[str, Tuple[int, ...]] = field(default_factory=dict)
+    by_name: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.records
+
+    @property
+    def categories(self) -> List[str]:
+        return list(self.fragments)
+
+    def get(self, name: str) -> Optional[KnowledgeRecord]:
+        position = self.by_name.get(name.strip().lower())
+        return None if position is None else self.records[position]
+
+    def filter(self, type: Optional[str] = None, cost_tier: Optional[str] = None, category: Optional[str] = None) -> List[KnowledgeRecord]:
+        """条件に一致するレコードを知識ベースの並び順で返す。条件が無ければ全件。"""
+        positions: Optional[set] = None
+        for index, key in ((self.by_type, type), (self.by_cost_tier, cost_tier), (self.by_category, category)):
+            if key is None:
+                continue
+            matched = set(index.get(key, ()))
+            positions = matched if positions is None else positions & matched
+        if positions is None:
+            return list(self.records)
+        return [self.records[position] for position in sorted(positions)]
+
+    def render(self, categories: Optional[Sequence[str]] = None) -> str:
+        """指定したカテゴリ (既定は全カテゴリ) の知識ベースJSONを、事前に作った断片から組み立てる。"""
+        if categories is None:
+            return self.text
+        parts = [self.fragments[c] for c in categories if self.fragments.get(c)]
+        return "[" + ", ".join(parts) + "]"
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "entries": len(self.records),
+            "categories": {category: len(positions) for category, positions in self.by_category.items()},
+            "cost_tiers": {tier: len(positions) for tier, positions in self.by_cost_tier.items()},
+            "types": len(self.by_type),
+            "chars": len(self.text),
+            "hash": self.hash,
+            "loaded_at": self.loaded_at,
+        }
+
+
+def _group(records: Sequence[KnowledgeRecord], attribute: str) -> Dict[str, Tuple[int, ...]]:
+    groups: Dict[str, List[int]] = {}
+    for position, record in enumerate(records):
+        groups.setdefault(getattr(record, attribute), []).append(position)
+    return {key: tuple(positions) for key, positions in groups.items()}
+
+
+def build_snapshot(
+    items: Sequence[Tuple[str, dict]],
+    source_hash: str = "",
+    signature: FileSignature = (),
+    files: Sequence[str] = (),
+) -> KnowledgeSnapshot:
+    """(カテゴリ, エントリ) の組からスナップショットを作る。"""
+    # 検索インデックスが各エントリを一度だけシリアライズするので、レコードはその結果を共有する
+    index = KnowledgeIndex(items)
+    records: List[KnowledgeRecord] = []
+    for item in index.entries:
+        entry = item.entry
+        detail = entry.get("cost_tier")
+        if not detail and isinstance(entry.get("pricing"), dict):
+            detail = entry["pricing"].get("model")
+        records.append(KnowledgeRecord(
+            name=item.name,
+            category=item.category,
+            type=str(entry.get("type", "")),
+            cost_tier=COST_TIERS[item.cost_rank],
+            cost_tier_detail=str(detail or ""),
+            difficulty=item.difficulty,
+            serialized=item.serialized,
+            estimated_tokens=item.estimated_tokens,
+            data=entry,
+        ))
+
+    by_category = _group(records, "category")
+    fragments = {
+        category: ", ".join(records[position].serialized for position in positions)
+        for category, positions in by_category.items()
+    }
+    text = "[" + ", ".join(fragment for fragment in fragments.values() if fragment) + "]"
+    by_name: Dict[str, int] = {}
+    for position, record in enumerate(records):
+        by_name.setdefault(record.name.strip().lower(), position)
+    return KnowledgeSnapshot(
+        records=tuple(records),
+        index=index,
+        fragments=fragments,
+        text=text,
+        hash=hashlib.sha256(text.encode("utf-8")).hexdigest(),
+        source_hash=source_hash,
+        signature=signature,
+        files=tuple(files),
+        by_type=_group(records, "type"),
+        by_cost_tier=_group(records, "cost_tier"),
+        by_category=by_category,
+        by_name=by_name,
+    )
+
+
+EMPTY_SNAPSHOT = build_snapshot([])
+
+
+class KnowledgeBase:
+    """data/ ディレクトリの知識ベース。最初に使われた時に読み込み、以降は更新を検知して再読み込みする。"""
+
+    def __init__(self, directory: str, reload_interval: float = 5.0):
+        self.directory = directory
+        # 0以下の場合はホットリロードしない (起動後の最初の読み込みのみ)
+        self.reload_interval = reload_interval
+        self.reloads = 0
+        self.reload_errors = 0
+        self._snapshot: Optional[KnowledgeSnapshot] = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> KnowledgeSnapshot:
+        """現在のスナップショットを返す。確認間隔を過ぎていればファイルの更新を確認する。"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.reload()
+        if self.reload_interval > 0 and time.monotonic() - self._last_check >= self.reload_interval:
+            return self.reload()
+        return snapshot
+
+    def reload(self, force: bool = False) -> KnowledgeSnapshot:
+        """ファイルが変わっていれば読み直して差し替える。失敗した場合は以前のスナップショットを使い続ける。"""
+        with self._lock:
+            self._last_check = time.monotonic()
+            current = self._snapshot
+            try:
+                signature = self._signature()
+                if current is not None and not force and signature == current.signature:
+                    return current
+                snapshot = self._load(signature, strict=current is not None)
+            except Exception as e:
+                self.reload_errors += 1
+                if current is not None:
+                    logging.error(f"知識ベースの再読み込みに失敗しました。以前の内容を使い続けます: {e}")
+                    return current
+                logging.critical(f"知識ベースの読み込み処理全体でエラー: {e}")
+                snapshot = EMPTY_SNAPSHOT
+
+            if current is not None and snapshot.source_hash == current.source_hash:
+                # mtime だけが変わった (内容は同じ) 場合は作り直さない
+                snapshot = dataclasses.replace(current, signature=signature)
+            elif current is not None:
+                self.reloads += 1
+                logging.info(f"知識ベースの変更を検知し、再読み込みしました。({len(current.records)}件 → {len(snapshot.records)}件)")
+            self._snapshot = snapshot
+            return snapshot
+
+    def _json_files(self) -> List[str]:
+        return sorted(f for f in os.listdir(self.directory) if f.endswith(".json"))
+
+    def _signature(self) -> FileSignature:
+        if not os.path.isdir(self.directory):
+            return ()
+        signature = []
+        for filename in self._json_files():
+            stat = os.stat(os.path.join(self.directory, filename))
+            signature.append((filename, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def _load(self, signature: FileSignature, strict: bool) -> KnowledgeSnapshot:
+        """ファイルを読み込む。strict の場合 (再読み込み時)、編集途中などで壊れたファイルがあれば全体を失敗にする。"""
+        if not os.path.isdir(self.directory):
+            logging.warning(f"警告: 指定された知識ベースのパス '{self.directory}' はディレクトリではありません。")
+            return EMPTY_SNAPSHOT
+        items: List[Tuple[str, dict]] = []
+        files: List[str] = []
+        digest = hashlib.sha256()
+        for filename, _, _ in signature:
+            file_path = os.path.join(self.directory, filename)
+            try:
+                with open(file_path, "rb") as f:
+                    raw = f.read()
+                data = json.loads(raw.decode("utf-8"))
+            except Exception as e:
+                if strict:
+                    raise ValueError(f"{filename} の読み込み中にエラー: {e}") from e
+                logging.error(f"エラー: {filename} の読み込み中にエラー: {e}")
+                continue
+            if not isinstance(data, list):  # 単一のJSONオブジェクトの場合も対応
+                data = [data]
+            digest.update(filename.encode("utf-8") + b"\0" + raw + b"\0")
+            category = category_from_filename(filename)
+            items.extend((category, entry) for entry in data)
+            files.append(filename)
+            logging.info(f"知識ベースファイル '{filename}' を読み込みました。")
+
+        if not items:
+            logging.warning(f"警告: '{self.directory}' ディレクトリにJSONファイルが見つからないか、データが空です。")
+        snapshot = build_snapshot(items, source_hash=digest.hexdigest(), signature=signature, files=files)
+        logging.info(f"合計 {len(snapshot.records)} 件の知識ベースエントリを読み込みました。(カテゴリ: {', '.join(snapshot.categories)})")
+        return snapshot
+
+    def stats(self) -> Dict[str, object]:
+        snapshot = self._snapshot
+        return {
+            "directory": self.directory,
+            "loaded": snapshot is not None,
+            "reload_interval_seconds": self.reload_interval,
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors,
+            **(snapshot.stats() if snapshot is not None else {}),
+        }
@@ -1,15 +1,59 @@
 # app/main.py (最終修正版 - エラー解消済み)
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
 import os
 from dotenv import load_dotenv
 import google.generativeai as genai
+import asyncio
 import json
 import logging
+import time
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
-import datetime
-from typing import Optional, List
+from typing import Optional, List, Awaitable, Callable, Dict, Tuple
+
+from app.batch import chunked, dedupe, error_detail, group_by, ndjson_line, run_bounded
+from app.cache import create_response_cache, make_cache_key
+from app.catalog import StaleCursorError, catalog_for
+from app.context_cache import KnowledgeContextCache
+from app.http_cache import CompressedBodyCache, conditional_json_response, make_etag
+from app.jobs import JOB_FAILED, JOB_SUCCEEDED, JobQueue, create_job_store
+from app.knowledge_base import KnowledgeBase, KnowledgeSnapshot
+from app.model_clients import create_model_factory
+from app.metrics import (
+    REGISTRY,
+    MetricsMiddleware,
+    record_cache,
+    record_model_call,
+    record_queue_wait,
+    record_retries,
+    timed_prompt,
+    track,
+)
+from app.prompts import (
+    BATCH_INITIAL_PROMPT,
+    CACHED_KNOWLEDGE_BASE_NOTE,
+    CUSTOM_PROMPT,
+    FULL_PROPOSAL_PROMPT,
+    INITIAL_PROMPT,
+    PROMPT_CREATION_PROMPT,
+    REFINE_PROMPT,
+    SECTION_REFINE_PROMPT,
+    PromptTemplate,
+    language_instruction,
+    today,
+)
+from app.rate_limit import RateLimitMiddleware, RateLimiter, RateLimitRule, check_prompt_size, create_bucket_store
+from app.recommend import recommender_for, render_markdown
+from app.retrieval import COST_TIERS, estimate_tokens
+from app.sections import Section, apply_patches, outline, render_sections, select_sections, split_sections
+from app.sessions import create_session_store
+from app.streaming import RefinementStreamParser, sse_event
+from app.resilience import ResilientCaller
+from app.upstream import ModelPool, UpstreamScheduler, PRIORITY_BULK, PRIORITY_INTERACTIVE
 
 # --- 基本設定 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,6 +66,71 @@ app = FastAPI(
     version="9.0.0"
 )
 
+# --- レート制限・受け付け制御 ---
+# Geminiを呼び出すエンドポイントごとに、クライアント (RATE_LIMIT_API_KEYS に登録された X-API-Key、無ければIPアドレス)
+# 単位のトークンバケットで制限する。pro を使うエンドポイントは1回で RATE_LIMIT_PRO_COST 個消費する。
+# 一括処理は本文を読んだ後、Geminiの呼び出し回数 × RATE_LIMIT_FLASH_COST を専用のバケットから消費する。
+# RATE_LIMIT_BACKEND: memory (既定。ワーカーごと) / sqlite (全ワーカーで共有) / off
+# CORSの内側に置くため、CORSより先に登録する (429 にもCORSヘッダーが付く)。
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_REFILL_PER_MINUTE = float(os.getenv("RATE_LIMIT_REFILL_PER_MINUTE", "20"))
+RATE_LIMIT_FLASH_COST = float(os.getenv("RATE_LIMIT_FLASH_COST", "1"))
+RATE_LIMIT_PRO_COST = float(os.getenv("RATE_LIMIT_PRO_COST", "5"))
+# 一括処理のバケット。既定の容量は BATCH_MAX_ITEMS 件を1件ずつ生成できる量 (小さくした場合は BATCH_MAX_ITEMS を合わせて下げる)
+RATE_LIMIT_BATCH_BURST = float(os.getenv("RATE_LIMIT_BATCH_BURST", str(int(os.getenv("BATCH_MAX_ITEMS", "500")) * RATE_LIMIT_FLASH_COST)))
+RATE_LIMIT_BATCH_REFILL_PER_MINUTE = float(os.getenv("RATE_LIMIT_BATCH_REFILL_PER_MINUTE", "20"))
+# 本文の上限 (バイト) と、Geminiに送るプロンプトの上限 (推定トークン数。0 で無制限)
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(256 * 1024)))
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", "120000"))
+
+def _is_local_analyze(query: Dict[str, str]) -> bool:
+    # mode=fast はGeminiを呼ばないため消費しない (ANALYZE_DEFAULT_MODE は後で定義されるが、判定はリクエスト時)
+    return (query.get("mode") or ANALYZE_DEFAULT_MODE).lower() == "fast"
+
+def _rate_limit_rules() -> Dict[str, RateLimitRule]:
+    costs = {
+        "/analyze_purpose/": RATE_LIMIT_FLASH_COST,
+        "/generate_prompt/": RATE_LIMIT_FLASH_COST,
+        "/execute_custom_prompt/": RATE_LIMIT_FLASH_COST,
+        "/generate_full_proposal/": RATE_LIMIT_PRO_COST,
+        "/generate_full_proposal/stream/": RATE_LIMIT_PRO_COST,
+        "/generate_full_proposal/jobs/": RATE_LIMIT_PRO_COST,
+        "/refine_proposal/": RATE_LIMIT_PRO_COST,
+        "/refine_proposal/stream/": RATE_LIMIT_PRO_COST,
+        "/proposal_sessions/{session_id}/refine": RATE_LIMIT_PRO_COST,
+    }
+    rules = {
+        path: RateLimitRule(
+            bucket=path,
+            cost=cost,
+            capacity=RATE_LIMIT_BURST,
+            refill_per_second=RATE_LIMIT_REFILL_PER_MINUTE / 60,
+            exempt=_is_local_analyze if path == "/analyze_purpose/" else None,
+        )
+        for path, cost in costs.items()
+    }
+    rules["/analyze_purpose/batch/"] = RateLimitRule(
+        bucket="/analyze_purpose/batch/",
+        cost=RATE_LIMIT_FLASH_COST,
+        capacity=RATE_LIMIT_BATCH_BURST,
+        refill_per_second=RATE_LIMIT_BATCH_REFILL_PER_MINUTE / 60,
+        charged_by_endpoint=True,
+    )
+    return rules
+
+RATE_LIMITER = RateLimiter(
+    create_bucket_store(RATE_LIMIT_BACKEND, os.getenv("RATE_LIMIT_PATH", ".cache/rate_limit.sqlite3")),
+    _rate_limit_rules(),
+    api_keys=os.getenv("RATE_LIMIT_API_KEYS", "").split(","),
+    # リバースプロキシ (Renderなど) の後ろで動かす場合のみ X-Forwarded-For を信頼する。
+    # RATE_LIMIT_FORWARDED_HOPS はクライアントとの間にある信頼できるプロキシの段数 (右から数えた位置の値を使う)
+    trust_forwarded=os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() in ("1", "true", "yes"),
+    forwarded_hops=int(os.getenv("RATE_LIMIT_FORWARDED_HOPS", "1")),
+    max_body_bytes=MAX_REQUEST_BYTES,
+)
+app.add_middleware(RateLimitMiddleware, limiter=RATE_LIMITER)
+
 # Renderデプロイのため、一旦すべて許可します。本番環境ではフロントエンドのURLに限定してください。
 origins = ["*"] 
 app.add_middleware(
@@ -31,16 +140,105 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# リクエストごとの計測 (/metrics と構造化ログ)
+app.add_middleware(MetricsMiddleware)
 
 # --- Gemini APIの設定 ---
-try:
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise ValueError("環境変数 'GEMINI_API_KEY' が設定されていません。")
-    genai.configure(api_key=api_key)
-except Exception as e:
-    logging.critical(f"Gemini APIキーの設定に失敗しました: {e}")
-    raise RuntimeError("Gemini APIキーが設定されていないため、アプリケーションを起動できません。")
+# MODEL_BACKEND=fake の場合はローカルの偽モデルで応答するため、APIキーは不要 (負荷試験・ベンチマーク用)
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini").lower()
+if MODEL_BACKEND != "fake":
+    try:
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise ValueError("環境変数 'GEMINI_API_KEY' が設定されていません。")
+        genai.configure(api_key=api_key)
+    except Exception as e:
+        logging.critical(f"Gemini APIキーの設定に失敗しました: {e}")
+        raise RuntimeError("Gemini APIキーが設定されていないため、アプリケーションを起動できません。")
+
+# --- 上流 (Gemini) 呼び出しの設定 ---
+# モデルはモデル名ごとに一度だけ生成して使い回し、同時実行数はスケジューラで制限する。
+# pro の同時実行数をワーカー全体の上限より小さくしておくことで、企画書生成が集中しても
+# flash の対話系エンドポイントの枠が残る。
+FLASH_MODEL = 'gemini-1.5-flash-latest'
+PRO_MODEL = 'gemini-1.5-pro-latest'
+
+MODEL_POOL = ModelPool(create_model_factory(MODEL_BACKEND))
+UPSTREAM_SCHEDULER = UpstreamScheduler(
+    global_limit=int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "8")),
+    model_limits={
+        FLASH_MODEL: int(os.getenv("UPSTREAM_FLASH_CONCURRENCY", "8")),
+        PRO_MODEL: int(os.getenv("UPSTREAM_PRO_CONCURRENCY", "4")),
+    },
+    max_queue=int(os.getenv("UPSTREAM_MAX_QUEUE", "32")),
+    retry_after=int(os.getenv("UPSTREAM_RETRY_AFTER", "5")),
+)
+
+# 一時的なエラーの再試行・サーキットブレーカー
+RESILIENT_CALLER = ResilientCaller(
+    max_attempts=int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3")),
+    base_delay=float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.5")),
+    max_delay=float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "8")),
+    failure_threshold=int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("UPSTREAM_BREAKER_RESET", "30")),
+)
+
+# エンドポイントごとの全体の締め切り (秒)。再試行・フォールバックを含めてこの時間内に応答する
+ENDPOINT_DEADLINES = {
+    "analyze_purpose": float(os.getenv("DEADLINE_ANALYZE_PURPOSE", "60")),
+    "generate_prompt": float(os.getenv("DEADLINE_GENERATE_PROMPT", "60")),
+    "generate_full_proposal": float(os.getenv("DEADLINE_GENERATE_FULL_PROPOSAL", "300")),
+    "refine_proposal": float(os.getenv("DEADLINE_REFINE_PROPOSAL", "180")),
+    "execute_custom_prompt": float(os.getenv("DEADLINE_EXECUTE_CUSTOM_PROMPT", "60")),
+    "analyze_purpose_batch": float(os.getenv("DEADLINE_ANALYZE_PURPOSE_BATCH", "180")),
+}
+# pro の締め切りが危うくなったときに flash で生成し直すために残しておく時間 (秒)
+FALLBACK_RESERVES = {
+    "generate_full_proposal": float(os.getenv("FALLBACK_RESERVE_GENERATE_FULL_PROPOSAL", "90")),
+    "refine_proposal": float(os.getenv("FALLBACK_RESERVE_REFINE_PROPOSAL", "45")),
+}
+
+
+async def call_gemini(endpoint: str, model_name: str, priority: int, prompt: str, fallback_model: Optional[str] = None, model=None, **kwargs):
+    """スケジューラの枠を確保し、締め切り・再試行・フォールバックつきでGeminiを呼び出す。
+
+    model を渡すと (コンテキストキャッシュ済みのモデルなど)、model_name の共有クライアントの代わりに使う。
+    """
+    check_prompt_size(prompt, MAX_PROMPT_TOKENS, endpoint)
+    override = model
+
+    # 実行枠の待ち時間が試行のタイムアウトやサーキットブレーカーに数えられないよう、枠は ResilientCaller に確保させる
+    @asynccontextmanager
+    async def slot(current_model: str):
+        async with UPSTREAM_SCHEDULER.slot(current_model, priority) as lease:
+            record_queue_wait(current_model, lease.wait_seconds)
+            yield lease
+
+    async def invoke(current_model: str, timeout: float):
+        model = override if override is not None and current_model == model_name else MODEL_POOL.get(current_model)
+        started = time.perf_counter()
+        try:
+            response = await model.generate_content_async(prompt, request_options={"timeout": timeout}, **kwargs)
+        except Exception:
+            record_model_call(current_model, time.perf_counter() - started, ok=False)
+            raise
+        record_model_call(current_model, time.perf_counter() - started)
+        return response
+
+    result = await RESILIENT_CALLER.call(
+        invoke,
+        model_name,
+        deadline=ENDPOINT_DEADLINES[endpoint],
+        fallback_model=fallback_model,
+        fallback_reserve=FALLBACK_RESERVES.get(endpoint, 0.0),
+        slot=slot,
+    )
+    record_retries(model_name, result.attempts - 1)
+    if result.fallback_used:
+        logging.warning(f"{model_name} が締め切りまでに応答しなかったため {result.model_name} で生成しました。(エンドポイント: {endpoint}, 試行回数: {result.attempts})")
+    elif result.attempts > 1:
+        logging.warning(f"Gemini呼び出しを再試行しました。(エンドポイント: {endpoint}, 試行回数: {result.attempts})")
+    return result.value
 
 # --- Pydanticモデル定義 (ReactのUserPayloadに完全に一致させる) ---
 class UserPayload(BaseModel):
@@ -65,6 +263,8 @@ class RefinementRequest(BaseModel):
     user_payload: UserPayload = Field(..., alias='userPayload')
     current_proposal: str = Field(..., alias='currentProposal')
     refinement_request: str = Field(..., alias='refinementRequest')
+    # 'full': 企画書全体を送って再生成 (既定) / 'sections': 対象セクションだけを送って差分で修正
+    mode: Optional[str] = "full"
 
     class Config:
         populate_by_name = True
@@ -73,319 +273,587 @@ class RefinementRequest(BaseModel):
 class RefinementResponse(BaseModel):
     type: str  # 'proposal', 'answer', 'rejection' のいずれか
     content: str
+    # 差分修正モードのみ: 修正したセクションIDと、全体再生成と比べたトークン数 (推定値)
+    updated_sections: Optional[List[str]] = None
+    token_usage: Optional[dict] = None
+    session_id: Optional[str] = None
+
+# SessionRefinementRequest: サーバー側のセッションに対する修正依頼 (企画書と要件の再送は不要)
+class SessionRefinementRequest(BaseModel):
+    refinement_request: str = Field(..., alias='refinementRequest')
+    mode: Optional[str] = "full"
+
+    class Config:
+        populate_by_name = True
 
 # CustomPromptRequest (新しいエンドポイント用)
 class CustomPromptRequest(BaseModel):
     prompt: str
     language: Optional[str] = "en"
 
+# BatchAnalyzeRequest: 複数のUserPayloadに対する初期提案の一括生成
+class BatchAnalyzeRequest(BaseModel):
+    items: List[UserPayload]
+    # 同時に処理する件数 (BATCH_MAX_CONCURRENCY 以下)
+    concurrency: Optional[int] = None
+    # 'online': 1件ずつ生成 (既定) / 'offline': 条件の近い要件をまとめて1回の呼び出しで生成 (安価だが遅い)
+    mode: Optional[str] = "online"
+
+
+# --- 知識ベース読み込み ---
+# 最初に使われた時に data/ を読み込み、以降は KB_RELOAD_INTERVAL 秒ごとにファイルの更新を確認する。
+# JSONを追加・編集した場合も、各ワーカーが再起動なしで新しい内容に切り替わる (0 で無効)。
+KNOWLEDGE_BASE = KnowledgeBase(
+    os.getenv("KB_DIRECTORY", "data"),
+    reload_interval=float(os.getenv("KB_RELOAD_INTERVAL", "5")),
+)
+
+# --- 知識ベース検索の設定 ---
+# プロンプトには知識ベース全体ではなく、ユーザー要件に関連するエントリのみを含める
+KB_RETRIEVAL_ENABLED = os.getenv("KB_RETRIEVAL_ENABLED", "true").lower() not in ("0", "false", "no")
+KB_RETRIEVAL_TOP_K = int(os.getenv("KB_RETRIEVAL_TOP_K", "3"))
+KB_RETRIEVAL_TOKEN_BUDGET = int(os.getenv("KB_RETRIEVAL_TOKEN_BUDGET", "12000"))
+
+
+def select_knowledge_base(knowledge_base: KnowledgeSnapshot, query: str, budget: Optional[int] = None, experience: Optional[str] = None) -> str:
+    """プロンプトに埋め込む知識ベースのJSON文字列を返す (検索無効時は全体)。
+
+    知識ベースのスナップショットはハンドラーの最初に一度だけ取得して渡す。1つのリクエストの途中で
+    ホットリロードが起きても、キャッシュキーとプロンプトが同じスナップショットから作られるようにするため。
+    """
+    if not KB_RETRIEVAL_ENABLED or knowledge_base.is_empty:
+        return knowledge_base.text
+    result = knowledge_base.index.select(
+        query,
+        budget=budget,
+        experience=experience,
+        top_k=KB_RETRIEVAL_TOP_K,
+        token_budget=KB_RETRIEVAL_TOKEN_BUDGET,
+    )
+    logging.info(f"知識ベース検索: {result.total_entries}件中 {len(result.entries)}件を選択しました。(推定 {result.estimated_tokens} トークン)")
+    return result.render()
+
+
+# --- Geminiコンテキストキャッシュの設定 ---
+# 知識ベース全体をCachedContentとして登録し、flash系エンドポイントのプロンプトから知識ベースを省く。
+# バージョン固定のモデル名 (例: models/gemini-1.5-flash-002) を指定した場合のみ有効。
+KNOWLEDGE_CONTEXT_CACHE = KnowledgeContextCache(
+    model_versions={FLASH_MODEL: os.getenv("GEMINI_CONTEXT_CACHE_FLASH_MODEL", "")},
+    ttl_seconds=int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600")),
+)
 
-# --- 知識ベース読み込み (起動時に一度だけ実行) ---
-KNOWLEDGE_BASE_STR = ""
-try:
-    all_knowledge_data = []
-    directory_path = "data"
-    if os.path.isdir(directory_path):
-        json_files = sorted([f for f in os.listdir(directory_path) if f.endswith('.json')])
-        for filename in json_files:
-            file_path = os.path.join(directory_path, filename)
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    if isinstance(data, list):
-                        all_knowledge_data.extend(data)
-                    else: # 単一のJSONオブジェクトの場合も対応
-                        all_knowledge_data.append(data)
-                logging.info(f"知識ベースファイル '{filename}' を読み込みました。")
-            except Exception as e:
-                logging.error(f"エラー: {filename} の読み込み中にエラー: {e}")
-    else:
-        logging.warning(f"警告: 指定された知識ベースのパス '{directory_path}' はディレクトリではありません。")
-        
-    if not all_knowledge_data:
-        logging.warning(f"警告: '{directory_path}' ディレクトリにJSONファイルが見つからないか、データが空です。")
-        
-    KNOWLEDGE_BASE_STR = json.dumps(all_knowledge_data, ensure_ascii=False)
-    logging.info(f"合計 {len(all_knowledge_data)} 件の知識ベースエントリを起動時に読み込みました。")
-except Exception as e:
-    logging.critical(f"起動時の知識ベース読み込み処理全体でエラー: {e}")
-    KNOWLEDGE_BASE_STR = "[]" # エラー時は空のJSON文字列
+
+async def knowledge_base_for_model(model_name: str, knowledge_base: KnowledgeSnapshot):
+    """コンテキストキャッシュが使える場合は (キャッシュ済みモデル, 知識ベースの代わりの案内) を返す。"""
+    cached_model = await KNOWLEDGE_CONTEXT_CACHE.get_model(model_name, knowledge_base.text, knowledge_base.hash)
+    if cached_model is None:
+        return None, None
+    return cached_model, CACHED_KNOWLEDGE_BASE_NOTE
+
+
+# --- 応答キャッシュの設定 ---
+# RESPONSE_CACHE_BACKEND: memory (既定) / sqlite (ワーカー再起動後も保持) / off
+RESPONSE_CACHE = create_response_cache(
+    backend=os.getenv("RESPONSE_CACHE_BACKEND", "memory"),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    sqlite_path=os.getenv("RESPONSE_CACHE_PATH", ".cache/gemini_responses.sqlite3"),
+)
+
+
+# --- 企画書セッションの設定 ---
+# SESSION_BACKEND: memory (既定) / sqlite (複数ワーカーで共有)
+SESSION_STORE = create_session_store(
+    backend=os.getenv("SESSION_BACKEND", "memory"),
+    ttl=float(os.getenv("SESSION_TTL", str(24 * 3600))),
+    max_sessions=int(os.getenv("SESSION_MAX_SESSIONS", "1000")),
+    max_bytes=int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024))),
+    sqlite_path=os.getenv("SESSION_PATH", ".cache/proposal_sessions.sqlite3"),
+)
+
+
+async def cached_generate(endpoint: str, model_name: str, payload: UserPayload, compute: Callable[[], Awaitable[str]], knowledge_base_hash: str) -> str:
+    """同一の要件に対するGemini呼び出しをキャッシュし、同時実行中の同一リクエストは1回にまとめる。"""
+    if RESPONSE_CACHE is None:
+        return await compute()
+    key = make_cache_key(endpoint, model_name, payload.model_dump(), payload.language, knowledge_base_hash)
+    value, hit = await RESPONSE_CACHE.get_or_compute(key, compute)
+    record_cache(hit)
+    if hit:
+        logging.info(f"キャッシュ済みの応答を返します。(エンドポイント: {endpoint})")
+    return value
+
+
+def select_knowledge_base_for(knowledge_base: KnowledgeSnapshot, user_input: UserPayload) -> str:
+    return select_knowledge_base(
+        knowledge_base,
+        f"{user_input.purpose} {user_input.project_type}",
+        budget=user_input.budget,
+        experience=user_input.experience_level,
+    )
 
 
 # --- プロンプト生成関数 ---
 
-def generate_initial_prompt(user_input: UserPayload) -> str:
-    language_instruction = "Please respond in English." if user_input.language == "en" else "日本語で回答してください。"
-    
-    return f"""
-# 役割: あなたは、世界トップクラスのソリューションアーキテクトです。ユーザーの要件から最適な技術スタックを提案します。
-# 現在の日付: {datetime.date.today().strftime("%Y年%m月%d日")}
-# 知識ベース: ```json
-{KNOWLEDGE_BASE_STR}
-```
-# ユーザー要件:
-- **目的**: {user_input.purpose}
-- **プロジェクト種類**: {user_input.project_type}
-- **月額予算**: {user_input.budget}円 以下
-- **開発経験**: {user_input.experience_level}
-- **週の開発時間**: {user_input.weekly_hours}
-- **開発期間**: {user_input.development_time or '未指定'}ヶ月 (ユーザー入力があれば考慮)
-- **言語設定**: {user_input.language}
-
-{language_instruction}
-
-# 指示: 上記に基づき、最適な技術スタック構成案を提案してください。AIモデルだけでなく、フレームワーク、DB等のAI以外のツールも網羅的に考慮し、なぜそれを選んだのか理由を明確に記述してください。
-
-# 提案フォーマット (Markdown)
----
-### **ご提案する技術スタック**
-**1. 構成概要と選定思想**
-**2. フロントエンド**
-- **推奨ツール**:
-- **選定理由**:
-**3. バックエンド**
-- **推奨ツール**:
-- **選定理由**:
-**4. データベース**
-- **推奨ツール**:
-- **選定理由**:
-**5. 主要なAIモデル / API**
-- **推奨モデル**:
-- **選定理由**:
-**6. CI/CDとホスティング**
-- **推奨ツール**:
-- **選定理由**:
-**7. 監視・分析**
-- **推奨ツール**:
-- **選定理由**:
-**8. 開発と運用のための推奨ステップ**
-(プロジェクトを始めるための具体的な初期ステップを5〜7個程度記述)
-"""
+def _render_prompt(template: PromptTemplate, knowledge_base: Optional[str] = None, snapshot: Optional[KnowledgeSnapshot] = None, **fields) -> str:
+    # 知識ベース全体やコンテキストキャッシュの案内はリクエスト間で共通なので、連結済みの前半を再利用する
+    static = (snapshot is not None and knowledge_base is snapshot.text) or knowledge_base is CACHED_KNOWLEDGE_BASE_NOTE
+    return template.render(knowledge_base=knowledge_base, static_knowledge_base=static, **fields)
 
-def generate_prompt_creation_prompt(user_input: UserPayload) -> str:
-    """Generate a prompt that creates an AI prompt based on user requirements"""
-    language_instruction = "Please respond in English." if user_input.language == "en" else "日本語で回答してください。"
-    
-    return f"""
-# 役割: あなたは、プロンプトエンジニアリングの専門家です。ユーザーの要件から、AIシステムに送信するための最適化されたプロンプトを生成します。
+def _requirement_fields(user_input: UserPayload) -> dict:
+    return {
+        "today": today(),
+        "purpose": user_input.purpose,
+        "project_type": user_input.project_type,
+        "budget": user_input.budget,
+        "experience_level": user_input.experience_level,
+        "weekly_hours": user_input.weekly_hours,
+        "development_time": user_input.development_time or '未指定',
+        "language": user_input.language,
+        "language_instruction": language_instruction(user_input.language),
+    }
 
-# 現在の日付: {datetime.date.today().strftime("%Y年%m月%d日")}
+@timed_prompt
+def generate_initial_prompt(user_input: UserPayload, snapshot: KnowledgeSnapshot, knowledge_base: Optional[str] = None) -> str:
+    if knowledge_base is None:
+        knowledge_base = select_knowledge_base_for(snapshot, user_input)
+    return _render_prompt(INITIAL_PROMPT, knowledge_base, snapshot, **_requirement_fields(user_input))
 
-# ユーザー要件:
-- **目的**: {user_input.purpose}
-- **プロジェクト種類**: {user_input.project_type}
-- **月額予算**: {user_input.budget}円 以下
-- **開発経験**: {user_input.experience_level}
-- **週の開発時間**: {user_input.weekly_hours}
-- **開発期間**: {user_input.development_time or '未指定'}ヶ月
-- **言語設定**: {user_input.language}
+@timed_prompt
+def generate_batch_initial_prompt(items: List[Tuple[str, UserPayload]], snapshot: KnowledgeSnapshot, knowledge_base: str) -> str:
+    """一括処理のオフラインモード用。items は (id, 要件) の組で、言語は全件同じであること。"""
+    profiles = [
+        {
+            "id": item_id,
+            "purpose": payload.purpose,
+            "project_type": payload.project_type,
+            "budget": payload.budget,
+            "experience_level": payload.experience_level,
+            "weekly_hours": payload.weekly_hours,
+            "development_time": payload.development_time,
+        }
+        for item_id, payload in items
+    ]
+    return _render_prompt(
+        BATCH_INITIAL_PROMPT,
+        knowledge_base,
+        snapshot,
+        today=today(),
+        profiles=json.dumps(profiles, ensure_ascii=False),
+        language_instruction=language_instruction(items[0][1].language),
+    )
 
-{language_instruction}
+@timed_prompt
+def generate_prompt_creation_prompt(user_input: UserPayload) -> str:
+    """Generate a prompt that creates an AI prompt based on user requirements"""
+    return _render_prompt(PROMPT_CREATION_PROMPT, **_requirement_fields(user_input))
 
-# 指示: 上記のユーザー要件を基に、AIシステムに送信するための包括的で効果的なプロンプトを生成してください。
+@timed_prompt
+def generate_full_proposal_prompt(request: FullProposalRequest, snapshot: KnowledgeSnapshot, knowledge_base: Optional[str] = None) -> str:
+    if knowledge_base is None:
+        # 初期提案に登場したツール名も検索語に含め、提案済みのツールを確実に拾う
+        knowledge_base = select_knowledge_base(
+            snapshot,
+            f"{request.purpose} {request.project_type} {request.initial_suggestion}",
+            budget=request.budget,
+            experience=request.experience_level,
+        )
+    return _render_prompt(
+        FULL_PROPOSAL_PROMPT,
+        knowledge_base,
+        snapshot,
+        initial_suggestion=request.initial_suggestion,
+        **_requirement_fields(request),
+    )
 
-生成するプロンプトには以下の要素を含めてください：
-1. 明確なプロジェクトコンテキストと目標
-2. 技術的要件と制約
-3. 予算とタイムラインの考慮事項
-4. 経験レベルに応じた推奨事項の要求
-5. 具体的な技術スタック推奨の依頼
-6. 実装ステップとベストプラクティスの要求
+def _conversation_block(conversation_summary: Optional[str]) -> str:
+    if not conversation_summary:
+        return ""
+    return f"## これまでのやり取り (要約):\n{conversation_summary}\n\n"
 
-生成されたプロンプトは、そのままAIシステムに送信して包括的な技術スタック推奨を得られるように構成してください。
+@timed_prompt
+def generate_refine_prompt(request: RefinementRequest, conversation_summary: Optional[str] = None) -> str:
+    return _render_prompt(
+        REFINE_PROMPT,
+        language_instruction=language_instruction(request.user_payload.language),
+        current_proposal=request.current_proposal,
+        user_payload_json=json.dumps(request.user_payload.model_dump(by_alias=True), ensure_ascii=False),
+        conversation=_conversation_block(conversation_summary),
+        refinement_request=request.refinement_request,
+    )
 
-# 出力フォーマット:
-生成されたプロンプトのみを出力してください（説明文は不要）。
-"""
+@timed_prompt
+def generate_section_refine_prompt(request: RefinementRequest, sections: List[Section], targets: List[Section], conversation_summary: Optional[str] = None) -> str:
+    target_text = "\n".join(f"<section id=\"{section.id}\">\n{section.text.rstrip()}\n</section>" for section in targets)
+    return _render_prompt(
+        SECTION_REFINE_PROMPT,
+        outline=outline(sections),
+        target_sections=target_text,
+        conversation=_conversation_block(conversation_summary),
+        refinement_request=request.refinement_request,
+        **_requirement_fields(request.user_payload),
+    )
 
-def generate_full_proposal_prompt(request: FullProposalRequest) -> str:
-    language_instruction = "Please respond in English." if request.language == "en" else "日本語で回答してください。"
-    
-    return f"""
-# 役割: あなたは、経験豊富なシニアプロジェクトマネージャー兼AIコンサルタントです。
-# 現在の日付: {datetime.date.today().strftime("%Y年%m月%d日")}
-# ユーザー要件:
-- 目的: {request.purpose}
-- 予算: {request.budget}円/月 以下
-- 経験: {request.experience_level}
-- 時間: {request.weekly_hours}/週
-- プロジェクト種類: {request.project_type}
-- 開発期間: {request.development_time or '未指定'}ヶ月 (ユーザー入力があれば考慮)
-- 言語設定: {request.language}
-
-{language_instruction}
-
-# 知識ベース: ```json
-{KNOWLEDGE_BASE_STR}
-```
-# 初期提案 (AINによる技術スタック提案):
-{request.initial_suggestion}
-
-# 指示:
-上記情報を基に、投資家や経営層にも提出できる、最高品質のプロジェクト企画書を作成してください。
-以下のフォーマットと項目を**すべて**含め、具体的かつ論理的に記述してください。
-特に「6. 開発フェーズ別具体的なタスクリスト」は、ユーザーが次に行うべきアクションを明確に理解できるよう、極めて詳細に記述してください。
-
-# 企画書フォーマット (Markdown)
----
-### **プロジェクト名案**
-- 案1: (キャッチーで覚えやすい名前)
-- 案2: (プロジェクト内容を的確に表す名前)
-- 案3: (先進性を感じさせる名前)
-### **1. 目的と背景**
-(ユーザーの「実現したいこと」をより詳細に、その背景にある課題と機会を記述)
-### **2. ターゲットユーザーと課題**
-### **3. ソリューション概要**
-(AINが提案した技術スタックと、それがどのようにユーザーの課題を解決するかを具体的な機能として記述)
-### **4. 技術スタック**
-(主要なAIモデル/API、フレームワーク、DB、クラウド、CI/CD、監視など、AINが提案した具体的なツールとその選定理由を簡潔にまとめる)
-### **5. 開発ロードマップと期間**
-(プロジェクト全体をフェーズ分けし、各フェーズの目標、主要な成果物、期間の目安を記述。ユーザーの「週に使える開発時間」と「開発経験レベル」を考慮した現実的な期間を設定。)
-### **6. 開発フェーズ別具体的なタスクリスト**
-(【最重要】「フェーズ1: 環境構築と基盤作成」「フェーズ2: コア機能実装」「フェーズ3: UI/UX改善とデプロイ」のようにフェーズ分けし、各タスクに[期間目安][スキルレベル][関連ツール]を付記し、「**💡このタスクで行き詰まったら、AINに『[タスク名]についてもっと詳しく教えて』と聞いてみてください。**」という次の対話への誘導を必ず含めること)
-### **7. 開発体制**
-(推奨されるチーム構成と役割、あるいは個人で進める場合の推奨事項を記述)
-### **8. リスク分析と対策**
-(技術的リスク、運用リスク、スケジュールリスクなどを挙げ、それぞれの対策を記述)
-### **9. 費用概算とROI（投資対効果）予測**
-(提案された技術スタックに基づく月額費用概算を具体的に記述。ROI予測は、費用対効果やビジネスインパクトを簡潔に予測。ユーザーの予算制約を考慮し、無料枠での可能性や、予算超過時の注意点を明記。)
-### **10. 競合分析と差別化**
-(類似の既存サービスや代替アプローチを挙げ、本プロジェクトの独自性や優位性を記述)
-### **11. 類似プロジェクト事例**
-(あなたの知識を基に、ユーザーの目的に近い実在のオープンソースプロジェクトや有名サービスの事例を2〜3個提示し、参考にできる点や、本プロジェクトとの違いを記述)
-### **12. 最新AIトレンドのハイライト**
-(このプロジェクトに関連する最先端のAI技術や研究動向（例：リアルタイム音声対話、エージェント技術、マルチモーダルLLMの活用事例など）を簡潔に紹介し、本プロジェクトの先進性をアピール。具体的な技術名も記述。)
-### **13. 成功指標 (KPI)**
-### **14. 今後の展望**
-(将来的な機能拡張、ビジネスモデル（フリーミアム、サブスクなど）、チーム開発支援、自動情報収集など、長期的なビジョンを記述)
-### **15. 3段階のスケーリング案**
-- **最小構成 (MVP)**:
-- **標準構成**:
-- **理想構成**:
-"""
-
-def generate_refine_prompt(request: RefinementRequest) -> str:
-    language_instruction = "Please respond in English." if request.user_payload.language == "en" else "日本語で回答してください。"
-    
-    return f"""
-# 役割:
-あなたは「AIアドバイザー」です。ユーザーからの指示を分析し、以下のルールに従って応答を生成してください。
-
-{language_instruction}
-
-# ルール:
-1.  まず、ユーザーの指示が「現在の企画書」に直接関連する「修正依頼」か「質問」かを判断します。
-2.  **修正依頼の場合**: 企画書を指示通りに修正し、修正後の企画書全体を生成します。応答タイプは "proposal" とします。
-3.  **質問の場合**: 企画書は変更せず、その質問に対する回答のみを生成します。応答タイプは "answer" とします。
-4.  **企画書に関係ない場合**: 「申し訳ありませんが、そのご質問にはお答えできません。企画書に関する内容でお願いします。」という固定の文章を生成します。応答タイプは "rejection" とします。
-5.  生成するテキストの最後に、`(AINからのアドバイス：無料版でのご相談はあと数回可能です。より専門的なコンサルティングや無制限の修正はProプランをご検討ください。)` というメッセージを**含めないでください**。
-
-# 出力フォーマット (JSON):
-必ず以下のJSON形式で応答してください。
-{{
-  "type": "proposal" | "answer" | "rejection",
-  "content": "ここに生成したテキスト（企画書全体、回答、または拒否メッセージ）を入れる"
-}}
-
----
-# 入力情報
-
-## 現在の企画書:
-```markdown
-{request.current_proposal}
-```
-
-## ユーザーの初期要件:
-```json
-{json.dumps(request.user_payload.model_dump(by_alias=True), ensure_ascii=False, indent=2)}
-```
-
-## ユーザーからの今回の指示:
-「{request.refinement_request}」
-
----
-# あなたの応答 (JSON形式で):
-"""
+@timed_prompt
+def generate_custom_prompt(request: CustomPromptRequest, snapshot: KnowledgeSnapshot, knowledge_base: Optional[str] = None) -> str:
+    if knowledge_base is None:
+        knowledge_base = select_knowledge_base(snapshot, request.prompt)
+    return _render_prompt(
+        CUSTOM_PROMPT,
+        knowledge_base,
+        snapshot,
+        prompt=request.prompt,
+        language_instruction=language_instruction(request.language),
+    )
 
 # --- ユーティリティ: 知識ベースを返す関数 ---
 def load_knowledge_base():
-    return KNOWLEDGE_BASE_STR
+    return KNOWLEDGE_BASE.get().text
 
 # --- APIエンドポイント ---
+async def analyze_payload(request: UserPayload, snapshot: KnowledgeSnapshot, priority: int = PRIORITY_INTERACTIVE, knowledge_base: Optional[str] = None, shortlist: Optional[str] = None) -> str:
+    """初期提案を生成する (キャッシュ済みならそれを返す)。knowledge_base は snapshot から選択済みの知識ベース。
+
+    shortlist はローカルの推薦で絞り込んだ候補 (mode=hybrid)。この場合はコンテキストキャッシュを使わず、
+    候補だけをプロンプトに含める。応答キャッシュも通常のモードとは分ける。
+    """
+    model_name = FLASH_MODEL
+
+    async def call_model() -> str:
+        cached_model, cached_knowledge_base = (None, None) if shortlist is not None else await knowledge_base_for_model(model_name, snapshot)
+        prompt = generate_initial_prompt(request, snapshot, knowledge_base=cached_knowledge_base or shortlist or knowledge_base)
+
+        logging.info(f"Geminiに初期提案リクエストを送信します... (モデル: {model_name})")
+        response = await call_gemini("analyze_purpose", model_name, priority, prompt, model=cached_model)
+
+        logging.info("Geminiから初期提案応答を受信しました。")
+        return response.text
+
+    cache_endpoint = "analyze_purpose" if shortlist is None else "analyze_purpose:hybrid"
+    return await cached_generate(cache_endpoint, model_name, request, call_model, snapshot.hash)
+
+# --- ローカル推薦 (LLMを使わない高速モード) ---
+# /analyze_purpose/?mode=fast : 知識ベースの構造化データだけで順位付けし、数ミリ秒で返す
+# /analyze_purpose/?mode=hybrid : ローカルで絞り込んだ候補だけをGeminiに渡して提案を生成する
+# 既定のモードは ANALYZE_DEFAULT_MODE (llm / fast / hybrid)
+ANALYZE_MODES = ("llm", "fast", "hybrid")
+ANALYZE_DEFAULT_MODE = os.getenv("ANALYZE_DEFAULT_MODE", "llm").lower()
+FAST_TOP_K = int(os.getenv("FAST_RECOMMEND_TOP_K", "3"))
+HYBRID_SHORTLIST_TOP_K = int(os.getenv("HYBRID_SHORTLIST_TOP_K", "5"))
+
+def recommend_locally(request: UserPayload, snapshot: KnowledgeSnapshot, top_k: int = FAST_TOP_K):
+    recommender = recommender_for(snapshot)
+    return recommender, recommender.recommend(
+        f"{request.purpose} {request.project_type}",
+        budget=request.budget,
+        experience=request.experience_level,
+        top_k=top_k,
+    )
+
 @app.post("/analyze_purpose/")
-async def analyze_purpose(request: UserPayload):
+async def analyze_purpose(request: UserPayload, mode: Optional[str] = None):
+    mode = (mode or ANALYZE_DEFAULT_MODE).lower()
+    if mode not in ANALYZE_MODES:
+        raise HTTPException(status_code=400, detail=f"不明なモードです: {mode}")
     try:
-        if KNOWLEDGE_BASE_STR == "[]":
+        snapshot = KNOWLEDGE_BASE.get()
+        if snapshot.is_empty:
             logging.error("知識ベースが空です。data/ディレクトリのJSONファイルを確認してください。")
             raise HTTPException(status_code=500, detail="提案の生成中にエラー: 知識ベースが空です。")
-            
-        prompt = generate_initial_prompt(request)
-        model = genai.GenerativeModel('gemini-1.5-flash-latest') 
-        
-        logging.info(f"Geminiに初期提案リクエストを送信します... (モデル: {model.model_name})")
-        response = await model.generate_content_async(prompt)
-        
-        logging.info("Geminiから初期提案応答を受信しました。")
-        return {"suggestion": response.text}
+
+        if mode == "fast":
+            _, result = recommend_locally(request, snapshot)
+            return {"suggestion": render_markdown(result, request.language), "mode": mode, "recommendations": result.to_dict(request.language)}
+
+        if mode == "hybrid":
+            recommender, result = recommend_locally(request, snapshot, top_k=HYBRID_SHORTLIST_TOP_K)
+            logging.info(f"ローカル推薦: {result.total_entries}件中 {len(result.names)}件を候補としてGeminiに渡します。")
+            suggestion = await analyze_payload(request, snapshot, shortlist=recommender.render_shortlist(result))
+            return {"suggestion": suggestion, "mode": mode}
+
+        suggestion = await analyze_payload(request, snapshot)
+        return {"suggestion": suggestion}
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.exception("初期提案の生成中にエラーが発生しました")
         raise HTTPException(status_code=500, detail=f"初期提案の生成中にエラーが発生しました: {str(e)}")
 
+# --- 一括処理 ---
+# テンプレートとなる多数のプロジェクト要件に対して、初期提案をまとめて生成する。
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+if RATE_LIMITER.store is not None and RATE_LIMIT_FLASH_COST > 0 and BATCH_MAX_ITEMS * RATE_LIMIT_FLASH_COST > RATE_LIMIT_BATCH_BURST:
+    # 上限いっぱいの一括処理が常にレート制限の容量を超えて 413 にならないよう、件数の上限を容量に合わせる
+    logging.warning(f"BATCH_MAX_ITEMS ({BATCH_MAX_ITEMS}) がレート制限の容量 (RATE_LIMIT_BATCH_BURST={RATE_LIMIT_BATCH_BURST:g}) を超えるため、容量に合わせます。")
+    BATCH_MAX_ITEMS = max(1, int(RATE_LIMIT_BATCH_BURST // RATE_LIMIT_FLASH_COST))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+# オフラインモードで1回の呼び出しにまとめる件数
+BATCH_PACK_SIZE = int(os.getenv("BATCH_PACK_SIZE", "5"))
+
+def _batch_cached_jobs(unique: Dict[str, List[int]], items: List[UserPayload]):
+    """応答キャッシュにある要件はキャッシュから返すジョブにし、残り (キー, 要件) の一覧と合わせて返す。"""
+    pending = []
+    cached_jobs = []
+    for key, indexes in unique.items():
+        cached = RESPONSE_CACHE.get(key) if RESPONSE_CACHE is not None else None
+        if cached is not None:
+            async def from_cache(key=key, value=cached) -> Dict[str, Dict[str, str]]:
+                return {key: {"suggestion": value}}
+            cached_jobs.append(([key], from_cache))
+        else:
+            pending.append((key, items[indexes[0]]))
+    return cached_jobs, pending
+
+def _batch_online_jobs(unique: Dict[str, List[int]], items: List[UserPayload], snapshot: KnowledgeSnapshot):
+    """1件ずつ生成するジョブ。同じ知識ベースが選ばれる要件 (=プロンプトの前半が同じ) を続けて実行する。
+
+    ジョブは (対象のキーの一覧, {キー: 結果} を返す関数) の組。(ジョブ, グループ数, Geminiの呼び出し回数) を返す。
+    """
+    cached_jobs, pending = _batch_cached_jobs(unique, items)
+    planned = [(key, payload, select_knowledge_base_for(snapshot, payload)) for key, payload in pending]
+    jobs = []
+    for group in group_by(planned, key=lambda plan: hash(plan[2])):
+        for key, payload, knowledge_base in group:
+            async def job(key=key, payload=payload, knowledge_base=knowledge_base) -> Dict[str, Dict[str, str]]:
+                return {key: {"suggestion": await analyze_payload(payload, snapshot, PRIORITY_BULK, knowledge_base)}}
+            jobs.append(([key], job))
+    return cached_jobs + jobs, len(set(hash(plan[2]) for plan in planned)), len(jobs)
+
+def _batch_offline_jobs(unique: Dict[str, List[int]], items: List[UserPayload], snapshot: KnowledgeSnapshot):
+    """予算区分・経験・言語が同じ要件を BATCH_PACK_SIZE 件ずつまとめ、1回の呼び出しで生成するジョブ。"""
+    cached_jobs, pending = _batch_cached_jobs(unique, items)
+    jobs = []
+    groups = group_by(pending, key=lambda plan: (plan[1].budget <= 0, plan[1].experience_level, plan[1].language))
+    for group in groups:
+        for pack in chunked(group, BATCH_PACK_SIZE):
+            async def job(pack=pack) -> Dict[str, Dict[str, str]]:
+                knowledge_base = select_knowledge_base(
+                    snapshot,
+                    " ".join(f"{payload.purpose} {payload.project_type}" for _, payload in pack),
+                    budget=min(payload.budget for _, payload in pack),
+                    experience=pack[0][1].experience_level,
+                )
+                prompt = generate_batch_initial_prompt([(f"p{i}", payload) for i, (_, payload) in enumerate(pack)], snapshot, knowledge_base)
+                logging.info(f"Geminiに初期提案の一括リクエストを送信します... (モデル: {FLASH_MODEL}, {len(pack)}件)")
+                response = await call_gemini(
+                    "analyze_purpose_batch",
+                    FLASH_MODEL,
+                    PRIORITY_BULK,
+                    prompt,
+                    generation_config=genai.types.GenerationConfig(response_mime_type="application/json"),
+                )
+                results = {
+                    str(result.get("id")): result.get("suggestion")
+                    for result in json.loads(response.text).get("results", [])
+                    if isinstance(result, dict)
+                }
+                suggestions = {key: results.get(f"p{i}") for i, (key, _) in enumerate(pack)}
+                # 次回の一括処理や /analyze_purpose/ で使えるよう、生成できた提案を応答キャッシュに保存する
+                if RESPONSE_CACHE is not None:
+                    for key, suggestion in suggestions.items():
+                        if not suggestion:
+                            continue
+                        try:
+                            RESPONSE_CACHE.backend.set(key, suggestion, RESPONSE_CACHE.ttl)
+                        except Exception as e:
+                            logging.warning(f"応答キャッシュへの書き込みに失敗しました: {e}")
+                return {key: {"suggestion": suggestion} for key, suggestion in suggestions.items()}
+            jobs.append(([key for key, _ in pack], job))
+    return cached_jobs + jobs, len(groups), len(jobs)
+
+@app.post("/analyze_purpose/batch/")
+async def analyze_purpose_batch(request: BatchAnalyzeRequest, http_request: Request):
+    """複数の要件の初期提案を生成し、終わったものから NDJSON (1行1JSON) で返す。
+
+    行の形式:
+      {"type": "summary", "total", "unique", "groups", "mode"}  (最初の1行)
+      {"type": "item", "index", "ok": true, "suggestion"} / {"type": "item", "index", "ok": false, "error": {"status", "detail"}}
+      {"type": "done", "succeeded", "failed", "elapsed_ms"}  (最後の1行)
+    重複した要件は1回だけ生成し、同じ結果をそれぞれの index で返す。
+    レート制限は応答キャッシュに無い要件についてのGeminiの呼び出し回数 (offline モードではまとめた回数) に応じて消費し、
+    足りなければ 429 を返す。
+    """
+    snapshot = KNOWLEDGE_BASE.get()
+    if snapshot.is_empty:
+        logging.error("知識ベースが空です。data/ディレクトリのJSONファイルを確認してください。")
+        raise HTTPException(status_code=500, detail="提案の生成中にエラー: 知識ベースが空です。")
+    if not request.items:
+        raise HTTPException(status_code=400, detail="items が空です。")
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"一度に処理できるのは {BATCH_MAX_ITEMS} 件までです。")
+    mode = (request.mode or "online").lower()
+    if mode not in ("online", "offline"):
+        raise HTTPException(status_code=400, detail=f"不明なモードです: {request.mode}")
+
+    started = time.perf_counter()
+    keys = [make_cache_key("analyze_purpose", FLASH_MODEL, item.model_dump(), item.language, snapshot.hash) for item in request.items]
+    unique = dedupe(keys)
+    # 知識ベースの検索は要件ごとに1ms程度かかるため、件数が多い場合にイベントループを止めないよう別スレッドで計画する
+    plan = _batch_offline_jobs if mode == "offline" else _batch_online_jobs
+    jobs, group_count, calls = await asyncio.to_thread(plan, unique, request.items, snapshot)
+    # 件数に関係なく一定量を消費すると、大きな一括処理ほど安くなるため、Geminiの呼び出し回数に応じて消費する
+    RATE_LIMITER.charge(http_request.scope, "/analyze_purpose/batch/", calls)
+    concurrency = min(request.concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+    logging.info(f"一括処理を開始します。({len(request.items)}件, 重複除去後 {len(unique)}件, グループ {group_count}, モード: {mode}, 同時実行数: {concurrency})")
+
+    async def results():
+        succeeded = failed = 0
+        yield ndjson_line({"type": "summary", "total": len(request.items), "unique": len(unique), "groups": group_count, "mode": mode})
+        async for job_keys, value, error in run_bounded(jobs, concurrency):
+            for key in job_keys:
+                # オフラインモードでは1つのジョブが複数の要件の結果を返す
+                result = value.get(key) if value is not None else None
+                item_error = error
+                if item_error is None and not (result and result.get("suggestion")):
+                    item_error = HTTPException(status_code=502, detail="AIの応答にこの要件の提案が含まれていませんでした。")
+                for index in unique[key]:
+                    if item_error is None:
+                        succeeded += 1
+                        yield ndjson_line({"type": "item", "index": index, "ok": True, "suggestion": result["suggestion"]})
+                    else:
+                        failed += 1
+                        yield ndjson_line({"type": "item", "index": index, "ok": False, "error": error_detail(item_error)})
+        logging.info(f"一括処理が完了しました。(成功 {succeeded}件, 失敗 {failed}件)")
+        yield ndjson_line({"type": "done", "succeeded": succeeded, "failed": failed, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)})
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
 @app.post("/generate_prompt/")
 async def generate_prompt(request: UserPayload):
     """Generate an AI prompt based on user requirements"""
     try:
-        if KNOWLEDGE_BASE_STR == "[]":
+        snapshot = KNOWLEDGE_BASE.get()
+        if snapshot.is_empty:
             logging.error("知識ベースが空です。data/ディレクトリのJSONファイルを確認してください。")
             raise HTTPException(status_code=500, detail="プロンプト生成中にエラー: 知識ベースが空です。")
             
-        prompt = generate_prompt_creation_prompt(request)
-        model = genai.GenerativeModel('gemini-1.5-flash-latest') 
-        
-        logging.info(f"Geminiにプロンプト生成リクエストを送信します... (モデル: {model.model_name})")
-        response = await model.generate_content_async(prompt)
-        
-        logging.info("Geminiからプロンプト生成応答を受信しました。")
-        return {"suggestion": response.text}
+        model_name = FLASH_MODEL
+
+        async def call_model() -> str:
+            prompt = generate_prompt_creation_prompt(request)
+            
+            logging.info(f"Geminiにプロンプト生成リクエストを送信します... (モデル: {model_name})")
+            response = await call_gemini("generate_prompt", model_name, PRIORITY_INTERACTIVE, prompt)
+            
+            logging.info("Geminiからプロンプト生成応答を受信しました。")
+            return response.text
+
+        suggestion = await cached_generate("generate_prompt", model_name, request, call_model, snapshot.hash)
+        return {"suggestion": suggestion}
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.exception("プロンプト生成中にエラーが発生しました")
         raise HTTPException(status_code=500, detail=f"プロンプト生成中にエラーが発生しました: {str(e)}")
 
+async def create_full_proposal(request: FullProposalRequest) -> dict:
+    """企画書を生成してセッションを作成する (/generate_full_proposal/ と非同期ジョブで共通)。"""
+    snapshot = KNOWLEDGE_BASE.get()
+    if snapshot.is_empty:
+        logging.error("知識ベースが空です。data/ディレクトリのJSONファイルを確認してください。")
+        raise HTTPException(status_code=500, detail="企画書生成中にエラー: 知識ベースが空です。")
+
+    prompt = generate_full_proposal_prompt(request, snapshot)
+
+    logging.info(f"Geminiに企画書生成リクエストを送信します... (モデル: {PRO_MODEL})")
+    response = await call_gemini("generate_full_proposal", PRO_MODEL, PRIORITY_BULK, prompt, fallback_model=FLASH_MODEL)
+
+    logging.info("Geminiから企画書生成応答を受信しました。")
+    session = SESSION_STORE.create(request.model_dump(by_alias=True, exclude={"initial_suggestion"}), response.text)
+    return {"suggestion": response.text, "session_id": session.id}
+
 @app.post("/generate_full_proposal/")
 async def generate_full_proposal(request: FullProposalRequest):
     try:
-        if KNOWLEDGE_BASE_STR == "[]":
-            logging.error("知識ベースが空です。data/ディレクトリのJSONファイルを確認してください。")
-            raise HTTPException(status_code=500, detail="企画書生成中にエラー: 知識ベースが空です。")
-            
-        prompt = generate_full_proposal_prompt(request)
-        model = genai.GenerativeModel('gemini-1.5-pro-latest') 
-        
-        logging.info(f"Geminiに企画書生成リクエストを送信します... (モデル: {model.model_name})")
-        response = await model.generate_content_async(prompt, request_options={"timeout": 600})
-        
-        logging.info("Geminiから企画書生成応答を受信しました。")
-        return {"suggestion": response.text}
+        return await create_full_proposal(request)
+    except HTTPException:
+        raise
     except Exception as e:
         logging.exception("企画書生成中にエラーが発生しました")
         raise HTTPException(status_code=500, detail=f"企画書生成中にエラーが発生しました: {str(e)}")
 
+async def refine_by_sections(request: RefinementRequest, sections: List[Section], targets: List[Section], conversation_summary: Optional[str] = None) -> RefinementResponse:
+    """対象セクションと目次だけを送り、モデルが返したセクションパッチを企画書に適用する。"""
+    prompt = generate_section_refine_prompt(request, sections, targets, conversation_summary)
+    
+    logging.info(f"Geminiに差分修正リクエストを送信します... (モデル: {PRO_MODEL}, 対象: {', '.join(s.id for s in targets)})")
+    response = await call_gemini(
+        "refine_proposal",
+        PRO_MODEL,
+        PRIORITY_BULK,
+        prompt,
+        fallback_model=FLASH_MODEL,
+        generation_config=genai.types.GenerationConfig(response_mime_type="application/json")
+    )
+    response_json = json.loads(response.text)
+    response_type = response_json.get("type", "answer")
+    content = response_json.get("content", "エラー：応答を解析できませんでした。")
+    patches = response_json.get("patches") or []
+    updated_sections = None
+    if response_type == "proposal":
+        patched, applied = apply_patches(sections, patches if isinstance(patches, list) else [])
+        if applied:
+            content = render_sections(patched)
+            updated_sections = applied
+        else:
+            # 有効なパッチが1つも無ければ企画書は変更せず、モデルの content をそのまま返す。
+            # content が企画書全体でなく要約だけなら、企画書を置き換えないよう回答として扱う
+            logging.warning("適用できるセクションパッチが無かったため、モデルの応答本文をそのまま返します。")
+            if len(split_sections(content)) <= 1:
+                response_type = "answer"
+
+    # 全体再生成モードなら、企画書全体を送り、修正後の企画書全体を受け取っていた
+    # (比較用に組み立てるだけなので、プロンプトの計測には含めない)
+    baseline_prompt_tokens = estimate_tokens(generate_refine_prompt.__wrapped__(request, conversation_summary))
+    baseline_output_tokens = estimate_tokens(content) if response_type == "proposal" else estimate_tokens(response.text)
+    prompt_tokens = estimate_tokens(prompt)
+    output_tokens = estimate_tokens(response.text)
+    token_usage = {
+        "prompt_tokens": prompt_tokens,
+        "output_tokens": output_tokens,
+        "baseline_prompt_tokens": baseline_prompt_tokens,
+        "baseline_output_tokens": baseline_output_tokens,
+        "saved_tokens": (baseline_prompt_tokens + baseline_output_tokens) - (prompt_tokens + output_tokens),
+    }
+    logging.info(f"差分修正で推定 {token_usage['saved_tokens']} トークンを節約しました。")
+    return RefinementResponse(type=response_type, content=content, updated_sections=updated_sections, token_usage=token_usage)
+
 @app.post("/refine_proposal/", response_model=RefinementResponse)
 async def refine_proposal_endpoint(request: RefinementRequest):
+    return await refine_proposal(request)
+
+async def refine_proposal(request: RefinementRequest, conversation_summary: Optional[str] = None) -> RefinementResponse:
+    response, _ = await refine_proposal_checked(request, conversation_summary)
+    return response
+
+async def refine_proposal_checked(request: RefinementRequest, conversation_summary: Optional[str] = None) -> Tuple[RefinementResponse, bool]:
+    """refine_proposal() と同じ応答に、モデルの応答を得られたか (お詫びの応答でないか) を添えて返す。"""
     response_text_for_logging = ""
     try:
-        if KNOWLEDGE_BASE_STR == "[]":
+        if KNOWLEDGE_BASE.get().is_empty:
             logging.error("知識ベースが空です。data/ディレクトリのJSONファイルを確認してください。")
             raise HTTPException(status_code=500, detail="企画書修正中にエラー: 知識ベースが空です。")
+        
+        if request.mode == "sections":
+            sections = split_sections(request.current_proposal)
+            targets = select_sections(sections, request.refinement_request)
+            # 見出しが無い企画書や、指示から対象セクションを特定できない場合は全体モードで処理する
+            if len(sections) > 1 and targets:
+                return await refine_by_sections(request, sections, targets, conversation_summary), True
+            logging.info("修正対象のセクションを特定できなかったため、企画書全体を送信します。")
             
-        prompt = generate_refine_prompt(request)
-        model = genai.GenerativeModel('gemini-1.5-pro-latest') 
+        prompt = generate_refine_prompt(request, conversation_summary)
         
-        logging.info(f"Geminiに修正/質問リクエストを送信します... (モデル: {model.model_name})")
-        response = await model.generate_content_async(
-            prompt, 
+        logging.info(f"Geminiに修正/質問リクエストを送信します... (モデル: {PRO_MODEL})")
+        response = await call_gemini(
+            "refine_proposal",
+            PRO_MODEL,
+            PRIORITY_BULK,
+            prompt,
+            fallback_model=FLASH_MODEL,
             generation_config=genai.types.GenerationConfig(response_mime_type="application/json")
         )
         
@@ -395,46 +863,445 @@ async def refine_proposal_endpoint(request: RefinementRequest):
         return RefinementResponse(
             type=response_json.get("type", "answer"),
             content=response_json.get("content", "エラー：応答を解析できませんでした。")
-        )
+        ), True
 
     except json.JSONDecodeError as e:
         logging.error(f"/refine_proposal/ JSONパースエラー: {e} - Geminiからの応答: {response_text_for_logging}")
         return RefinementResponse(
             type="answer",
             content=f"大変申し訳ありません、AIからの応答形式に問題があり解析できませんでした。少し時間を置いてから再度お試しください。"
-        )
+        ), False
+    except HTTPException:
+        raise
     except Exception as e:
         logging.exception("企画書修正/質問応答中にエラーが発生しました")
         return RefinementResponse(
             type="answer",
             content=f"大変申し訳ありません、リクエストの処理中に予期せぬエラーが発生しました。({type(e).__name__})"
+        ), False
+
+# --- 企画書セッション ---
+@app.get("/proposal_sessions/{session_id}")
+def get_proposal_session(session_id: str):
+    session = SESSION_STORE.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="セッションが見つかりません。有効期限が切れた可能性があります。")
+    return {
+        "session_id": session.id,
+        "proposal": session.proposal,
+        "history": session.history,
+        "updated_at": session.updated_at,
+    }
+
+@app.post("/proposal_sessions/{session_id}/refine", response_model=RefinementResponse)
+async def refine_proposal_session(session_id: str, request: SessionRefinementRequest):
+    # 同じセッションへの修正は1件ずつ処理し、先に終わった修正を後の保存で上書きしないようにする
+    async with SESSION_STORE.locked(session_id):
+        session = SESSION_STORE.get(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="セッションが見つかりません。有効期限が切れた可能性があります。")
+        refinement = RefinementRequest(
+            user_payload=UserPayload(**session.user_payload),
+            current_proposal=session.proposal,
+            refinement_request=request.refinement_request,
+            mode=request.mode,
         )
+        response, succeeded = await refine_proposal_checked(refinement, session.conversation_summary())
+        if succeeded:
+            session.record_turn(request.refinement_request, response.type, response.content)
+            SESSION_STORE.save(session)
+        else:
+            # お詫びの応答は履歴に残さず、次の修正のプロンプトにも含めない
+            logging.warning(f"修正に失敗したため、セッション {session.id} の履歴は更新しません。")
+    response.session_id = session.id
+    return response
 
-@app.post("/execute_custom_prompt/")
-async def execute_custom_prompt(request: CustomPromptRequest):
+# --- 企画書生成の非同期ジョブ ---
+# POST で受け付けてすぐにジョブIDを返し、生成はバックグラウンドで行う。
+# 状態は GET /generate_full_proposal/jobs/{job_id} のポーリング、または .../events (SSE) で取得する。
+# JOB_BACKEND: memory (既定) / sqlite (複数ワーカーで共有。どのワーカーに問い合わせても状態を返せる)
+async def run_full_proposal_job(payload: dict) -> dict:
+    with track("job:/generate_full_proposal/"):
+        try:
+            return await create_full_proposal(FullProposalRequest.model_validate(payload))
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"企画書生成中にエラーが発生しました: {str(e)}")
+
+PROPOSAL_JOBS = JobQueue(
+    create_job_store(
+        backend=os.getenv("JOB_BACKEND", "memory"),
+        ttl=float(os.getenv("JOB_TTL", str(24 * 3600))),
+        max_jobs=int(os.getenv("JOB_MAX_JOBS", "1000")),
+        max_bytes=int(os.getenv("JOB_MAX_BYTES", str(64 * 1024 * 1024))),
+        sqlite_path=os.getenv("JOB_PATH", ".cache/proposal_jobs.sqlite3"),
+    ),
+    run_full_proposal_job,
+    workers=int(os.getenv("JOB_WORKERS", "2")),
+    max_queue=int(os.getenv("JOB_MAX_QUEUE", "16")),
+    retry_after=int(os.getenv("JOB_RETRY_AFTER", "30")),
+    heartbeat=float(os.getenv("JOB_HEARTBEAT_INTERVAL", "15")),
+    stale_after=float(os.getenv("JOB_STALE_AFTER", "60")),
+)
+app.router.on_shutdown.append(PROPOSAL_JOBS.shutdown)
+JOB_EVENTS_POLL_INTERVAL = float(os.getenv("JOB_EVENTS_POLL_INTERVAL", "1.0"))
+JOB_EVENTS_MAX_SECONDS = float(os.getenv("JOB_EVENTS_MAX_SECONDS", "900"))
+
+def _get_job(job_id: str):
+    job = PROPOSAL_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つからないか、有効期限が切れています。")
+    return job
+
+@app.post("/generate_full_proposal/jobs/", status_code=202)
+async def submit_full_proposal_job(request: FullProposalRequest):
+    """企画書生成をジョブとして受け付ける。同じ内容のジョブが待機中・実行中・完了済みなら、そのジョブを返す。"""
+    snapshot = KNOWLEDGE_BASE.get()
+    if snapshot.is_empty:
+        logging.error("知識ベースが空です。data/ディレクトリのJSONファイルを確認してください。")
+        raise HTTPException(status_code=500, detail="企画書生成中にエラー: 知識ベースが空です。")
+    key = make_cache_key("generate_full_proposal", PRO_MODEL, request.model_dump(), request.language, snapshot.hash)
+    job, deduplicated = await PROPOSAL_JOBS.submit(key, request.model_dump(by_alias=True))
+    if deduplicated:
+        logging.info(f"同じ内容のジョブが存在するため、既存のジョブを返します。(ID: {job.id})")
+    return {**job.public(), "deduplicated": deduplicated}
+
+@app.get("/generate_full_proposal/jobs/{job_id}")
+def get_full_proposal_job(job_id: str):
+    return _get_job(job_id).public()
+
+@app.get("/generate_full_proposal/jobs/{job_id}/events")
+async def full_proposal_job_events(job_id: str):
+    """ジョブの状態が変わるたびに status イベントを送り、完了 (done) または失敗 (error) で終了する。"""
+    _get_job(job_id)
+
+    async def event_stream():
+        last = None
+        deadline = time.monotonic() + JOB_EVENTS_MAX_SECONDS
+        while time.monotonic() < deadline:
+            job = PROPOSAL_JOBS.get(job_id)
+            if job is None:
+                yield sse_event("error", {"detail": "ジョブが見つからないか、有効期限が切れています。"})
+                return
+            if (job.status, job.stage) != last:
+                last = (job.status, job.stage)
+                if job.status == JOB_SUCCEEDED:
+                    yield sse_event("done", job.public())
+                    return
+                if job.status == JOB_FAILED:
+                    yield sse_event("error", job.public())
+                    return
+                yield sse_event("status", job.public())
+            await asyncio.sleep(JOB_EVENTS_POLL_INTERVAL)
+        yield sse_event("error", {"detail": "ジョブの完了を待つ時間の上限に達しました。状態の取得をやり直してください。"})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+# --- ストリーミング (SSE) エンドポイント ---
+# 生成完了を待たずに、モデルが出力したチャンクを Server-Sent Events で逐次返す。
+# イベント: chunk {"text"} / type {"type"} (修正のみ) / done {} / error {"detail"}
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+async def start_stream(endpoint: str, model_name: str, prompt: str, **kwargs):
+    """最初のチャンクを受信するまでを再試行つきで実行する。
+
+    実行枠は呼び出し側で確保済みのため、ここではモデルのフォールバックは行わない。
+    チャンクを送り始めた後のエラーは再試行せず、error イベントとしてクライアントに返す。
+    プロンプトの大きさは、呼び出し側でレスポンスを開始する前に確認しておくこと。
+    """
+    async def invoke(current_model: str, timeout: float):
+        model = MODEL_POOL.get(current_model)
+        started = time.perf_counter()
+        try:
+            return await model.generate_content_async(prompt, stream=True, request_options={"timeout": timeout}, **kwargs)
+        except Exception:
+            record_model_call(current_model, time.perf_counter() - started, ok=False)
+            raise
+
+    result = await RESILIENT_CALLER.call(invoke, model_name, deadline=ENDPOINT_DEADLINES[endpoint])
+    record_retries(model_name, result.attempts - 1)
+    return result.value
+
+async def timed_chunks(response, model_name: str, started: float):
+    """ストリーミング応答のチャンクを中継し、最初のチャンクまでの時間と全体の応答時間を記録する。"""
+    first_token = None
     try:
-        language_instruction = "Please respond in English." if request.language == "en" else "日本語で回答してください。"
-        
-        enhanced_prompt = f"""
-{language_instruction}
+        async for chunk in response:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            yield chunk
+    except Exception:
+        record_model_call(model_name, time.perf_counter() - started, first_token, ok=False)
+        raise
+    record_model_call(model_name, time.perf_counter() - started, first_token)
+
+@app.post("/generate_full_proposal/stream/")
+async def generate_full_proposal_stream(request: FullProposalRequest):
+    snapshot = KNOWLEDGE_BASE.get()
+    if snapshot.is_empty:
+        logging.error("知識ベースが空です。data/ディレクトリのJSONファイルを確認してください。")
+        raise HTTPException(status_code=500, detail="企画書生成中にエラー: 知識ベースが空です。")
+
+    prompt = generate_full_proposal_prompt(request, snapshot)
+    check_prompt_size(prompt, MAX_PROMPT_TOKENS, "generate_full_proposal")
+    # 混雑時は 503 を返せるよう、レスポンスを開始する前に実行枠を確保する
+    lease = await UPSTREAM_SCHEDULER.acquire(PRO_MODEL, PRIORITY_BULK)
+
+    async def event_stream():
+        try:
+            logging.info(f"Geminiに企画書生成リクエスト (ストリーミング) を送信します... (モデル: {PRO_MODEL})")
+            record_queue_wait(PRO_MODEL, lease.wait_seconds)
+            started = time.perf_counter()
+            response = await start_stream("generate_full_proposal", PRO_MODEL, prompt)
+            parts = []
+            async for chunk in timed_chunks(response, PRO_MODEL, started):
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield sse_event("chunk", {"text": chunk.text})
+            logging.info("Geminiから企画書生成応答 (ストリーミング) を受信しました。")
+            session = SESSION_STORE.create(request.model_dump(by_alias=True, exclude={"initial_suggestion"}), "".join(parts))
+            yield sse_event("done", {"session_id": session.id})
+        except Exception as e:
+            logging.exception("企画書生成 (ストリーミング) 中にエラーが発生しました")
+            yield sse_event("error", {"detail": f"企画書生成中にエラーが発生しました: {str(e)}"})
+        finally:
+            lease.release()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS, background=BackgroundTask(lease.release))
 
-# Knowledge Base: ```json
-{KNOWLEDGE_BASE_STR}
-```
+@app.post("/refine_proposal/stream/")
+async def refine_proposal_stream(request: RefinementRequest):
+    if KNOWLEDGE_BASE.get().is_empty:
+        logging.error("知識ベースが空です。data/ディレクトリのJSONファイルを確認してください。")
+        raise HTTPException(status_code=500, detail="企画書修正中にエラー: 知識ベースが空です。")
 
-# User's Custom Prompt:
-{request.prompt}
+    prompt = generate_refine_prompt(request)
+    check_prompt_size(prompt, MAX_PROMPT_TOKENS, "refine_proposal")
+    lease = await UPSTREAM_SCHEDULER.acquire(PRO_MODEL, PRIORITY_BULK)
 
-Please provide a comprehensive and helpful response based on the user's request and the available knowledge base.
-"""
+    async def event_stream():
+        # JSON応答 {type, content} を受信しながら分解し、type を先に送ってから content を流す
+        parser = RefinementStreamParser()
+
+        def to_sse(events):
+            for kind, value in events:
+                if kind == "type":
+                    yield sse_event("type", {"type": value})
+                else:
+                    yield sse_event("chunk", {"text": value})
+
+        try:
+            logging.info(f"Geminiに修正/質問リクエスト (ストリーミング) を送信します... (モデル: {PRO_MODEL})")
+            record_queue_wait(PRO_MODEL, lease.wait_seconds)
+            started = time.perf_counter()
+            response = await start_stream(
+                "refine_proposal",
+                PRO_MODEL,
+                prompt,
+                generation_config=genai.types.GenerationConfig(response_mime_type="application/json")
+            )
+            async for chunk in timed_chunks(response, PRO_MODEL, started):
+                if chunk.text:
+                    for event in to_sse(parser.feed(chunk.text)):
+                        yield event
+            for event in to_sse(parser.finish()):
+                yield event
+            yield sse_event("done", {})
+        except json.JSONDecodeError as e:
+            # 途中で切れた・形式の崩れた応答は、送信済みの断片を完了扱いにしないよう error で終える
+            logging.error(f"/refine_proposal/stream/ JSONパースエラー: {e}")
+            yield sse_event("error", {"detail": "大変申し訳ありません、AIからの応答形式に問題があり解析できませんでした。少し時間を置いてから再度お試しください。"})
+        except Exception as e:
+            logging.exception("企画書修正/質問応答 (ストリーミング) 中にエラーが発生しました")
+            yield sse_event("error", {"detail": f"大変申し訳ありません、リクエストの処理中に予期せぬエラーが発生しました。({type(e).__name__})"})
+        finally:
+            lease.release()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS, background=BackgroundTask(lease.release))
+
+@app.post("/execute_custom_prompt/")
+async def execute_custom_prompt(request: CustomPromptRequest):
+    try:
+        snapshot = KNOWLEDGE_BASE.get()
+        cached_model, knowledge_base = await knowledge_base_for_model(FLASH_MODEL, snapshot)
+        enhanced_prompt = generate_custom_prompt(request, snapshot, knowledge_base=knowledge_base)
         
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        response = await model.generate_content_async(enhanced_prompt)
+        response = await call_gemini("execute_custom_prompt", FLASH_MODEL, PRIORITY_INTERACTIVE, enhanced_prompt, model=cached_model)
         return {"suggestion": response.text}
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"/execute_custom_prompt/ エラー: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _prompt_size(prompt: str) -> dict:
+    return {"chars": len(prompt), "estimated_tokens": estimate_tokens(prompt)}
+
+@app.post("/prompt_stats/")
+async def prompt_stats(request: UserPayload):
+    """知識ベース検索あり/なしでのプロンプトサイズを比較する (実際にGeminiは呼び出さない)"""
+    snapshot = KNOWLEDGE_BASE.get()
+    full_request = FullProposalRequest(**request.model_dump(), initial_suggestion="")
+    builders = {
+        "analyze_purpose": lambda kb: generate_initial_prompt(request, snapshot, knowledge_base=kb),
+        "generate_full_proposal": lambda kb: generate_full_proposal_prompt(full_request, snapshot, knowledge_base=kb),
+        "execute_custom_prompt": lambda kb: generate_custom_prompt(CustomPromptRequest(prompt=request.purpose, language=request.language), snapshot, knowledge_base=kb),
+    }
+    retrieved_kb = {
+        "analyze_purpose": select_knowledge_base_for(snapshot, request),
+        "generate_full_proposal": select_knowledge_base_for(snapshot, request),
+        "execute_custom_prompt": select_knowledge_base(snapshot, request.purpose),
+    }
+    stats = {}
+    for endpoint, build in builders.items():
+        full = _prompt_size(build(snapshot.text))
+        retrieved = _prompt_size(build(retrieved_kb[endpoint]))
+        stats[endpoint] = {
+            "full": full,
+            "retrieved": retrieved,
+            "saved_ratio": round(1 - retrieved["chars"] / full["chars"], 3) if full["chars"] else 0.0,
+        }
+    selection = snapshot.index.select(
+        f"{request.purpose} {request.project_type}",
+        budget=request.budget,
+        experience=request.experience_level,
+        top_k=KB_RETRIEVAL_TOP_K,
+        token_budget=KB_RETRIEVAL_TOKEN_BUDGET,
+    )
+    return {
+        "retrieval_enabled": KB_RETRIEVAL_ENABLED,
+        "top_k": KB_RETRIEVAL_TOP_K,
+        "token_budget": KB_RETRIEVAL_TOKEN_BUDGET,
+        "selected_entries": selection.names,
+        "prompts": stats,
+    }
+
+@app.get("/knowledge_base_stats/")
+def knowledge_base_stats():
+    """知識ベースの件数・カテゴリ・再読み込み状況を返す"""
+    KNOWLEDGE_BASE.get()
+    return KNOWLEDGE_BASE.stats()
+
+# --- 知識ベースの参照API ---
+# 一覧 (type / cost_tier / category で絞り込み、q で name・functions・use_cases を全文検索、カーソルでページ分割) と1件取得。
+# ETag は知識ベースの内容ハッシュと条件から計算するため、知識ベースが変わらない限り If-None-Match で 304 を返す。
+KB_API_DEFAULT_LIMIT = int(os.getenv("KB_API_DEFAULT_LIMIT", "20"))
+KB_API_MAX_LIMIT = int(os.getenv("KB_API_MAX_LIMIT", "100"))
+KB_API_CACHE_CONTROL = os.getenv("KB_API_CACHE_CONTROL", "public, max-age=300")
+KB_API_COMPRESSED_BODIES = CompressedBodyCache(max_entries=int(os.getenv("KB_API_COMPRESSED_CACHE_ENTRIES", "64")))
+
+@app.get("/knowledge_base/")
+def knowledge_base_catalog(request: Request):
+    """件数とカテゴリ・type・費用区分ごとの件数 (絞り込みに使える値の一覧)"""
+    snapshot = KNOWLEDGE_BASE.get()
+    return conditional_json_response(
+        request,
+        make_etag(snapshot.hash, "facets"),
+        lambda: json.dumps(catalog_for(snapshot).facets(), ensure_ascii=False),
+        KB_API_CACHE_CONTROL,
+    )
+
+@app.get("/knowledge_base/entries")
+def list_knowledge_base_entries(
+    request: Request,
+    type: Optional[str] = None,
+    cost_tier: Optional[str] = None,
+    category: Optional[str] = None,
+    q: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+):
+    if limit is None:
+        limit = KB_API_DEFAULT_LIMIT
+    if not 1 <= limit <= KB_API_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit は 1〜{KB_API_MAX_LIMIT} の範囲で指定してください。")
+    if cost_tier is not None and cost_tier not in COST_TIERS:
+        raise HTTPException(status_code=400, detail=f"cost_tier は {', '.join(COST_TIERS)} のいずれかを指定してください。")
+    snapshot = KNOWLEDGE_BASE.get()
+
+    def render() -> str:
+        catalog = catalog_for(snapshot)
+        positions = catalog.query(type=type, cost_tier=cost_tier, category=category, q=q)
+        try:
+            page, next_cursor = catalog.page(positions, limit, cursor)
+        except StaleCursorError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return catalog.render_page(page, len(positions), next_cursor)
+
+    etag = make_etag(snapshot.hash, "entries", type or "", cost_tier or "", category or "", q or "", str(limit), cursor or "")
+    return conditional_json_response(request, etag, render, KB_API_CACHE_CONTROL, KB_API_COMPRESSED_BODIES)
+
+@app.get("/knowledge_base/entries/{name:path}")
+def get_knowledge_base_entry(request: Request, name: str):
+    snapshot = KNOWLEDGE_BASE.get()
+    record = snapshot.get(name)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"知識ベースに '{name}' は見つかりません。")
+    return conditional_json_response(
+        request,
+        make_etag(snapshot.hash, "entry", record.name),
+        lambda: catalog_for(snapshot).render_entry(record),
+        KB_API_CACHE_CONTROL,
+        KB_API_COMPRESSED_BODIES,
+    )
+
+@app.get("/cache_stats/")
+def cache_stats():
+    """応答キャッシュのヒット/ミス統計を返す"""
+    if RESPONSE_CACHE is None:
+        return {"enabled": False}
+    return {"enabled": True, **RESPONSE_CACHE.stats()}
+
+@app.get("/session_stats/")
+def session_stats():
+    return SESSION_STORE.stats()
+
+@app.get("/rate_limit_stats/")
+def rate_limit_stats():
+    """レート制限の判定件数 (このワーカープロセスの値) とバケットの状況を返す"""
+    return RATE_LIMITER.stats()
+
+@app.get("/job_stats/")
+def job_stats():
+    """企画書生成ジョブの待ち行列の状況を返す (このワーカープロセスの値)"""
+    return PROPOSAL_JOBS.stats()
+
+def _upstream_gauges():
+    stats = UPSTREAM_SCHEDULER.stats()
+    breakers = RESILIENT_CALLER.stats()
+    jobs = PROPOSAL_JOBS.stats()
+    return [
+        ("ain_upstream_active", "実行中の上流呼び出し数", ("model",),
+         [((model,), stats["active_by_model"].get(model, 0)) for model in stats["model_limits"]]),
+        ("ain_upstream_queued", "実行枠を待っているリクエスト数", ("priority",),
+         [((str(priority),), stats["queued_by_priority"].get(priority, 0)) for priority in (PRIORITY_INTERACTIVE, PRIORITY_BULK)]),
+        ("ain_upstream_rejected", "混雑により 503 を返したリクエスト数 (起動後の累計)", (), [((), stats["rejected"])]),
+        ("ain_circuit_breaker_open", "サーキットブレーカーが開いている (半開を含む) 場合は 1", ("model",),
+         [((model,), 0 if breaker["state"] == "closed" else 1) for model, breaker in breakers.items()]),
+        ("ain_proposal_jobs_queued", "待ち行列にある企画書生成ジョブ数", (), [((), jobs["queued"])]),
+        ("ain_proposal_jobs_in_progress", "待機中・実行中の企画書生成ジョブ数", (), [((), jobs["in_progress"])]),
+        ("ain_knowledge_base_entries", "読み込み済みの知識ベースのエントリ数", (), [((), len(KNOWLEDGE_BASE.get().records))]),
+    ]
+
+REGISTRY.add_collector(_upstream_gauges)
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus形式のメトリクス (このワーカープロセスの値)"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/upstream_stats/")
+def upstream_stats():
+    """Gemini呼び出しの同時実行数・待ち行列の状況を返す"""
+    return {
+        **UPSTREAM_SCHEDULER.stats(),
+        "circuit_breakers": RESILIENT_CALLER.stats(),
+        "context_cache": KNOWLEDGE_CONTEXT_CACHE.stats(),
+    }
+
 @app.get("/")
 def read_root():
     return {"message": "AI Navigator (AIN) Backend v9.0 is running with enhanced features."}
\ No newline at end of file
@@ -0,0 +1,341 @@
+# app/metrics.py
+# リクエストごとの計測
+# プロンプトの組み立て時間とサイズ、上流の待ち時間、モデルの応答時間 (最初のトークンまで/全体)、
+# 応答サイズ、再試行回数、キャッシュのヒット/ミスをリクエスト単位で集計し、
+# 完了時に Prometheus 形式のヒストグラム (/metrics) と構造化ログ (JSON 1行) に出力する。
+# 値はワーカープロセスごとに保持する (gunicorn の各ワーカーが自分の値を返す)。
+
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from app.retrieval import estimate_tokens
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+SIZE_BUCKETS = (256, 1024, 4096, 8192, 16384, 32768, 65536, 131072, 262144, 524288)
+
+metrics_logger = logging.getLogger("ain.metrics")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+_INF_LABEL = 'le="+Inf"'
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルの組 -> (バケットごとの件数, 合計, 件数)
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, _INF_LABEL)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Any] = []
+        # 描画のたびに呼び出して、その時点の値をゲージとして返す関数 ((名前, 説明, ラベル名, [(ラベル値, 値)]) のリスト)
+        self._collectors: List[Callable[[], List[Tuple[str, str, Sequence[str], List[Tuple[Sequence[str], float]]]]]] = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], List[Tuple[str, str, Sequence[str], List[Tuple[Sequence[str], float]]]]]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                gauges = collector()
+            except Exception as e:
+                logging.warning(f"メトリクスの収集に失敗しました: {e}")
+                continue
+            for name, help, labelnames, samples in gauges:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} gauge")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = REGISTRY.counter("ain_requests_total", "処理したHTTPリクエスト数", ("endpoint", "method", "status"))
+REQUEST_DURATION = REGISTRY.histogram("ain_request_duration_seconds", "リクエスト全体の処理時間 (ストリーミングは最後のチャンクまで)", ("endpoint",))
+RESPONSE_BYTES = REGISTRY.histogram("ain_response_bytes", "応答本文のサイズ (バイト)", ("endpoint",), SIZE_BUCKETS)
+PROMPT_BUILD = REGISTRY.histogram("ain_prompt_build_seconds", "プロンプトの組み立て時間 (知識ベース検索を含む)", ("endpoint",), FAST_BUCKETS)
+PROMPT_CHARS = REGISTRY.histogram("ain_prompt_chars", "プロンプトの文字数", ("endpoint",), SIZE_BUCKETS)
+PROMPT_TOKENS = REGISTRY.histogram("ain_prompt_estimated_tokens", "プロンプトの推定トークン数", ("endpoint",), SIZE_BUCKETS)
+QUEUE_WAIT = REGISTRY.histogram("ain_upstream_queue_wait_seconds", "上流の実行枠を確保するまでの待ち時間", ("endpoint", "model"))
+MODEL_FIRST_TOKEN = REGISTRY.histogram("ain_model_time_to_first_token_seconds", "モデル呼び出しから最初のチャンクを受信するまでの時間 (非ストリーミングは応答全体)", ("endpoint", "model"))
+MODEL_LATENCY = REGISTRY.histogram("ain_model_latency_seconds", "モデル呼び出し1回あたりの応答時間", ("endpoint", "model"))
+MODEL_CALLS = REGISTRY.counter("ain_model_calls_total", "モデル呼び出し回数 (再試行を含む)", ("endpoint", "model", "outcome"))
+MODEL_RETRIES = REGISTRY.counter("ain_model_retries_total", "一時的なエラーによる再試行・フォールバックの回数", ("endpoint", "model"))
+CACHE_LOOKUPS = REGISTRY.counter("ain_response_cache_lookups_total", "応答キャッシュの参照結果", ("endpoint", "result"))
+
+# 構造化ログに出さないパス (監視からの定期アクセス)
+_QUIET_PATHS = {"/metrics"}
+
+
+@dataclass
+class ModelCall:
+    model: str
+    latency: float
+    first_token: Optional[float]
+    ok: bool
+
+
+@dataclass
+class RequestMetrics:
+    # HTTPリクエスト以外 (バックグラウンド処理など) で使う場合のエンドポイント名
+    name: str = "unmatched"
+    method: str = ""
+    path: str = ""
+    scope: Optional[Dict[str, Any]] = field(default=None, repr=False)
+    started: float = field(default_factory=time.perf_counter)
+    status: int = 0
+    prompt_build_seconds: float = 0.0
+    prompt_chars: int = 0
+    prompt_tokens: int = 0
+    prompts: int = 0
+    queue_wait_seconds: float = 0.0
+    model_calls: List[ModelCall] = field(default_factory=list)
+    retries: int = 0
+    cache: Optional[str] = None
+    response_bytes: int = 0
+
+    @property
+    def endpoint(self) -> str:
+        # ルーティング後はマッチしたルートのパス (パスパラメータを含まない形) をラベルにする
+        route = self.scope.get("route") if self.scope is not None else None
+        return getattr(route, "path", None) or self.name
+
+    def to_log(self, duration: float) -> Dict[str, Any]:
+        record: Dict[str, Any] = {
+            "endpoint": self.endpoint,
+            "method": self.method,
+            "status": self.status,
+            "duration_ms": round(duration * 1000, 1),
+            "response_bytes": self.response_bytes,
+        }
+        if self.prompts:
+            record.update({
+                "prompt_build_ms": round(self.prompt_build_seconds * 1000, 3),
+                "prompt_chars": self.prompt_chars,
+                "prompt_tokens": self.prompt_tokens,
+            })
+        if self.model_calls:
+            record.update({
+                "queue_wait_ms": round(self.queue_wait_seconds * 1000, 1),
+                "models": sorted({call.model for call in self.model_calls}),
+                "model_calls": len(self.model_calls),
+                "model_latency_ms": round(sum(call.latency for call in self.model_calls) * 1000, 1),
+                "first_token_ms": next(
+                    (round(call.first_token * 1000, 1) for call in self.model_calls if call.ok and call.first_token is not None), None
+                ),
+                "retries": self.retries,
+            })
+        if self.cache is not None:
+            record["cache"] = self.cache
+        return record
+
+    def finish(self) -> None:
+        duration = time.perf_counter() - self.started
+        endpoint = self.endpoint
+        REQUESTS.inc(endpoint, self.method, str(self.status))
+        REQUEST_DURATION.observe(duration, endpoint)
+        RESPONSE_BYTES.observe(self.response_bytes, endpoint)
+        if self.prompts:
+            PROMPT_BUILD.observe(self.prompt_build_seconds, endpoint)
+            PROMPT_CHARS.observe(self.prompt_chars, endpoint)
+            PROMPT_TOKENS.observe(self.prompt_tokens, endpoint)
+        if self.path not in _QUIET_PATHS:
+            metrics_logger.info(f"request_metrics {json.dumps(self.to_log(duration), ensure_ascii=False)}")
+
+
+_current: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar("request_metrics", default=None)
+
+
+def current() -> Optional[RequestMetrics]:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def track(name: str, method: str = "JOB"):
+    """HTTPリクエスト以外の処理 (バックグラウンドのジョブなど) を1件のリクエストとして計測する。"""
+    metrics = RequestMetrics(name=name, method=method)
+    token = _current.set(metrics)
+    try:
+        yield metrics
+        metrics.status = metrics.status or 200
+    except Exception as e:
+        metrics.status = metrics.status or getattr(e, "status_code", 500)
+        raise
+    finally:
+        metrics.finish()
+        _current.reset(token)
+
+
+def _endpoint() -> str:
+    metrics = _current.get()
+    return metrics.endpoint if metrics is not None else "background"
+
+
+def timed_prompt(build: Callable[..., str]) -> Callable[..., str]:
+    """プロンプト生成関数の所要時間とプロンプトのサイズを記録するデコレータ。"""
+    @functools.wraps(build)
+    def wrapper(*args, **kwargs) -> str:
+        started = time.perf_counter()
+        prompt = build(*args, **kwargs)
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.prompt_build_seconds += time.perf_counter() - started
+            metrics.prompt_chars += len(prompt)
+            metrics.prompt_tokens += estimate_tokens(prompt)
+            metrics.prompts += 1
+        return prompt
+    return wrapper
+
+
+def record_queue_wait(model: str, seconds: float) -> None:
+    QUEUE_WAIT.observe(seconds, _endpoint(), model)
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.queue_wait_seconds += seconds
+
+
+def record_model_call(model: str, latency: float, first_token: Optional[float] = None, ok: bool = True) -> None:
+    """モデル呼び出し1回分を記録する。非ストリーミングでは応答全体の到着が最初のトークンになる。"""
+    endpoint = _endpoint()
+    MODEL_CALLS.inc(endpoint, model, "ok" if ok else "error")
+    if ok:
+        MODEL_LATENCY.observe(latency, endpoint, model)
+        MODEL_FIRST_TOKEN.observe(latency if first_token is None else first_token, endpoint, model)
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.model_calls.append(ModelCall(model, latency, latency if first_token is None else first_token, ok))
+
+
+def record_retries(model: str, retries: int) -> None:
+    if retries <= 0:
+        return
+    MODEL_RETRIES.inc(_endpoint(), model, amount=retries)
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.retries += retries
+
+
+def record_cache(hit: bool) -> None:
+    result = "hit" if hit else "miss"
+    CACHE_LOOKUPS.inc(_endpoint(), result)
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.cache = result
+
+
+class MetricsMiddleware:
+    """リクエストごとに RequestMetrics を用意し、応答の送信完了 (ストリーミングでは最後のチャンク) で記録する。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        metrics = RequestMetrics(method=scope.get("method", ""), path=scope.get("path", ""), scope=scope)
+        token = _current.set(metrics)
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                metrics.status = message["status"]
+            elif message["type"] == "http.response.body":
+                metrics.response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        except Exception:
+            metrics.status = metrics.status or 500
+            raise
+        finally:
+            metrics.finish()
+            _current.reset(token)
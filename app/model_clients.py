@@ -0,0 +1,230 @@
+# app/model_clients.py
+# モデルクライアントの差し替え
+# エンドポイントが使うのは generate_content_async(prompt, stream=..., request_options=..., generation_config=...)
+# と model_name だけなので、同じ形のクライアントを MODEL_BACKEND で切り替えられるようにする。
+#   gemini (既定): google.generativeai.GenerativeModel
+#   fake: Geminiを呼ばずにローカルで応答する偽モデル (負荷試験・ベンチマーク用。APIキー不要)
+# 偽モデルの応答時間・ストリーミングのチャンク間隔・エラー注入・応答内容は FAKE_GEMINI_* 環境変数で指定する。
+
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import re
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Protocol
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+
+class ModelClient(Protocol):
+    model_name: str
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, request_options: Optional[dict] = None, generation_config: Any = None, **kwargs) -> Any:
+        ...
+
+
+@dataclass(frozen=True)
+class LatencyDistribution:
+    """応答時間の分布 (秒)。"fixed:0.5" "uniform:0.2,1.5" "normal:1.0,0.2" "lognormal:1.0,0.5" の形式で指定する。
+
+    lognormal は中央値と対数の標準偏差で指定する (裾の重い実際の応答時間に近い)。
+    """
+
+    kind: str = "fixed"
+    a: float = 0.0
+    b: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyDistribution":
+        kind, _, params = spec.strip().partition(":")
+        if not params:  # "0.5" のように数値だけの場合は固定値
+            kind, params = "fixed", kind
+        values = [float(v) for v in params.split(",") if v.strip()]
+        if kind not in ("fixed", "uniform", "normal", "lognormal") or not values:
+            raise ValueError(f"不正な応答時間の分布です: {spec}")
+        return cls(kind, values[0], values[1] if len(values) > 1 else 0.0)
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "uniform":
+            value = rng.uniform(self.a, self.b)
+        elif self.kind == "normal":
+            value = rng.gauss(self.a, self.b)
+        elif self.kind == "lognormal":
+            value = rng.lognormvariate(math.log(self.a), self.b) if self.a > 0 else 0.0
+        else:
+            value = self.a
+        return max(0.0, value)
+
+
+_DEFAULT_SUGGESTION = """### おすすめの構成
+- **フロントエンド**: Next.js + Vercel (無料枠で公開可能)
+- **バックエンド**: Supabase (認証・データベースを一括で用意)
+- **AI**: gemini-1.5-flash (低コストで高速)
+
+### 理由
+予算と開発期間を考慮し、運用の手間が少ないマネージドサービスを中心に選定しました。
+"""
+
+_DEFAULT_PROPOSAL = "".join(
+    f"## {number}. {title}\n\n" + f"{title}についての説明です。" * 20 + "\n\n"
+    for number, title in enumerate(
+        ["プロジェクト概要", "目的と背景", "機能要件", "技術スタック", "システム構成", "開発スケジュール", "費用見積もり", "リスクと対策"],
+        start=1,
+    )
+)
+
+DEFAULT_CANNED_OUTPUTS = {
+    # flash 系エンドポイント (/analyze_purpose/, /generate_prompt/, /execute_custom_prompt/)
+    "suggestion": _DEFAULT_SUGGESTION,
+    # /generate_full_proposal/
+    "proposal": _DEFAULT_PROPOSAL,
+    # /refine_proposal/ (全体再生成モード)
+    "refine": json.dumps({"type": "proposal", "content": _DEFAULT_PROPOSAL}, ensure_ascii=False),
+    # /refine_proposal/ (差分修正モード)
+    "refine_sections": json.dumps(
+        {
+            "type": "proposal",
+            "content": "技術スタックを更新しました。",
+            "patches": [{"op": "replace", "section_id": "s4", "content": "## 4. 技術スタック\n\n更新後の技術スタックです。\n\n"}],
+        },
+        ensure_ascii=False,
+    ),
+}
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+@dataclass
+class FakeBackendConfig:
+    # 最初のチャンクが返るまでの時間 (非ストリーミングではこれにチャンク間隔の合計を足した時間で応答する)
+    latency: LatencyDistribution = field(default_factory=lambda: LatencyDistribution("lognormal", 0.8, 0.4))
+    # モデル名に含まれる語 ("pro" / "flash") ごとの latency の上書き
+    model_latency: Dict[str, LatencyDistribution] = field(default_factory=dict)
+    chunk_interval: LatencyDistribution = field(default_factory=lambda: LatencyDistribution("fixed", 0.05))
+    chunk_chars: int = 80
+    rate_limit_rate: float = 0.0  # 429 (ResourceExhausted) を返す割合
+    timeout_rate: float = 0.0  # 応答せずにタイムアウトさせる割合
+    timeout_seconds: float = 30.0  # タイムアウトさせる場合に待つ時間 (リクエストのtimeoutが短ければそちら)
+    malformed_json_rate: float = 0.0  # JSON応答を途中で切って返す割合
+    canned: Dict[str, str] = field(default_factory=lambda: dict(DEFAULT_CANNED_OUTPUTS))
+    seed: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> "FakeBackendConfig":
+        config = cls()
+        if os.getenv("FAKE_GEMINI_LATENCY"):
+            config.latency = LatencyDistribution.parse(os.environ["FAKE_GEMINI_LATENCY"])
+        for key in ("pro", "flash"):
+            spec = os.getenv(f"FAKE_GEMINI_{key.upper()}_LATENCY")
+            if spec:
+                config.model_latency[key] = LatencyDistribution.parse(spec)
+        if os.getenv("FAKE_GEMINI_CHUNK_INTERVAL"):
+            config.chunk_interval = LatencyDistribution.parse(os.environ["FAKE_GEMINI_CHUNK_INTERVAL"])
+        config.chunk_chars = int(os.getenv("FAKE_GEMINI_CHUNK_CHARS", str(config.chunk_chars)))
+        config.rate_limit_rate = _env_float("FAKE_GEMINI_429_RATE", config.rate_limit_rate)
+        config.timeout_rate = _env_float("FAKE_GEMINI_TIMEOUT_RATE", config.timeout_rate)
+        config.timeout_seconds = _env_float("FAKE_GEMINI_TIMEOUT_SECONDS", config.timeout_seconds)
+        config.malformed_json_rate = _env_float("FAKE_GEMINI_MALFORMED_JSON_RATE", config.malformed_json_rate)
+        if os.getenv("FAKE_GEMINI_SEED"):
+            config.seed = int(os.environ["FAKE_GEMINI_SEED"])
+        canned_path = os.getenv("FAKE_GEMINI_CANNED_FILE")
+        if canned_path:
+            # {"suggestion": "...", "proposal": "...", "refine": "...", "refine_sections": "..."} の一部または全部
+            with open(canned_path, "r", encoding="utf-8") as f:
+                config.canned.update(json.load(f))
+        return config
+
+    def latency_for(self, model_name: str) -> LatencyDistribution:
+        for key, distribution in self.model_latency.items():
+            if key in model_name:
+                return distribution
+        return self.latency
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeStreamResponse:
+    """generate_content_async(stream=True) の戻り値と同じく、async for でチャンクを返す。"""
+
+    def __init__(self, chunks: List[str], intervals: List[float]):
+        self._chunks = chunks
+        self._intervals = intervals
+
+    async def _iterate(self) -> AsyncIterator[FakeResponse]:
+        for index, chunk in enumerate(self._chunks):
+            if index:
+                await asyncio.sleep(self._intervals[index])
+            yield FakeResponse(chunk)
+
+    def __aiter__(self) -> AsyncIterator[FakeResponse]:
+        return self._iterate()
+
+
+class FakeGenerativeModel:
+    def __init__(self, model_name: str, config: FakeBackendConfig, rng: random.Random):
+        self.model_name = model_name
+        self.config = config
+        self._rng = rng
+
+    def _canned_text(self, prompt: str, generation_config: Any) -> str:
+        mime_type = getattr(generation_config, "response_mime_type", None)
+        if mime_type is None and isinstance(generation_config, dict):
+            mime_type = generation_config.get("response_mime_type")
+        if mime_type == "application/json":
+            if '"results"' in prompt:
+                # 一括処理のオフラインモード: 一覧の各要件に同じ提案を返す
+                ids = re.findall(r'"id": "([^"]+)"', prompt)
+                text = json.dumps({"results": [{"id": i, "suggestion": self.config.canned["suggestion"]} for i in ids]}, ensure_ascii=False)
+            else:
+                text = self.config.canned["refine_sections" if '"patches"' in prompt else "refine"]
+            if self._rng.random() < self.config.malformed_json_rate:
+                return text[: max(1, len(text) // 2)]
+            return text
+        return self.config.canned["proposal" if "pro" in self.model_name else "suggestion"]
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, request_options: Optional[dict] = None, generation_config: Any = None, **kwargs) -> Any:
+        timeout = (request_options or {}).get("timeout")
+        if self._rng.random() < self.config.rate_limit_rate:
+            raise google_exceptions.ResourceExhausted("偽モデル: レート制限 (注入されたエラー)")
+
+        first_chunk = self.config.latency_for(self.model_name).sample(self._rng)
+        if self._rng.random() < self.config.timeout_rate:
+            first_chunk = math.inf
+        text = self._canned_text(prompt, generation_config)
+        size = max(1, self.config.chunk_chars)
+        chunks = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        intervals = [0.0] + [self.config.chunk_interval.sample(self._rng) for _ in chunks[1:]]
+
+        wait = first_chunk if stream else first_chunk + sum(intervals)
+        limit = self.config.timeout_seconds if math.isinf(wait) else None
+        if timeout is not None:
+            limit = timeout if limit is None else min(limit, timeout)
+        if limit is not None and wait > limit:
+            await asyncio.sleep(limit)
+            raise google_exceptions.DeadlineExceeded("偽モデル: 応答がタイムアウトしました")
+        await asyncio.sleep(wait)
+        if stream:
+            return FakeStreamResponse(chunks, intervals)
+        return FakeResponse(text)
+
+
+def create_model_factory(backend: str) -> Callable[[str], ModelClient]:
+    """MODEL_BACKEND に応じて、モデル名からクライアントを作る関数を返す。"""
+    backend = backend.lower()
+    if backend == "fake":
+        config = FakeBackendConfig.from_env()
+        rng = random.Random(config.seed)
+        logging.warning("MODEL_BACKEND=fake: Geminiは呼び出さず、ローカルの偽モデルで応答します。")
+        return lambda model_name: FakeGenerativeModel(model_name, config, rng)
+    if backend != "gemini":
+        logging.warning(f"不明なモデルバックエンド '{backend}' が指定されたため、gemini を使用します。")
+    return genai.GenerativeModel
@@ -0,0 +1,369 @@
+# app/prompts.py
+# プロンプトテンプレート
+# 各テンプレートは「全リクエストで共通の静的な前半 (役割・ルール・出力フォーマット)」
+# 「知識ベース」「リクエストごとの後半 (日付・ユーザー要件など)」の順に組み立てる。
+# 前半はモジュール読み込み時に一度だけ組み立て、後半は str.format_map で埋めるだけにする。
+# 共通部分を先頭に置くことで、Geminiのコンテキストキャッシュや暗黙的なプレフィックスキャッシュが効きやすくなる。
+
+import datetime
+from typing import Dict, Optional
+
+LANGUAGE_INSTRUCTIONS = {"en": "Please respond in English."}
+DEFAULT_LANGUAGE_INSTRUCTION = "日本語で回答してください。"
+
+# コンテキストキャッシュに知識ベースを載せている場合に、プロンプト本文へ入れる案内
+CACHED_KNOWLEDGE_BASE_NOTE = "(知識ベースはシステム指示として提供済みです。そちらを参照してください。)"
+
+
+def language_instruction(language: Optional[str]) -> str:
+    return LANGUAGE_INSTRUCTIONS.get(language or "", DEFAULT_LANGUAGE_INSTRUCTION)
+
+
+_today_cache: Dict[datetime.date, str] = {}
+
+
+def today() -> str:
+    """プロンプトに埋め込む日付 (日付が変わるまで同じ文字列を使い回す)。"""
+    date = datetime.date.today()
+    text = _today_cache.get(date)
+    if text is None:
+        _today_cache.clear()
+        text = _today_cache[date] = date.strftime("%Y年%m月%d日")
+    return text
+
+
+class PromptTemplate:
+    def __init__(self, name: str, prefix: str, body: str, knowledge_base_label: Optional[str] = None):
+        self.name = name
+        self.prefix = prefix
+        self.body = body
+        # None のテンプレートは知識ベースを含まない
+        self.knowledge_base_label = knowledge_base_label
+        self._static_prefixes: Dict[str, str] = {}
+
+    def knowledge_base_section(self, knowledge_base: str) -> str:
+        return f"{self.knowledge_base_label} ```json\n{knowledge_base}\n```\n"
+
+    def static_prefix(self, knowledge_base: Optional[str] = None) -> str:
+        """共通部分 (+ 知識ベース) を返す。同じ知識ベース文字列に対しては一度だけ連結する。"""
+        if knowledge_base is None or self.knowledge_base_label is None:
+            return self.prefix
+        # 文字列のハッシュ値は文字列オブジェクトにキャッシュされるため、同じ文字列なら検索は安価
+        cached = self._static_prefixes.get(knowledge_base)
+        if cached is None:
+            cached = self.prefix + self.knowledge_base_section(knowledge_base)
+            # 現在の知識ベース全体 (とコンテキストキャッシュ用の案内) だけを保持すればよい。再読み込み後は古いものを捨てる
+            if len(self._static_prefixes) >= 4:
+                self._static_prefixes.clear()
+            self._static_prefixes[knowledge_base] = cached
+        return cached
+
+    def render(self, knowledge_base: Optional[str] = None, static_knowledge_base: bool = False, **fields) -> str:
+        """プロンプトを組み立てる。
+
+        static_knowledge_base=True は knowledge_base がリクエスト間で共通の文字列
+        (知識ベース全体など) であることを示し、連結済みの前半を再利用する。
+        """
+        if static_knowledge_base:
+            head = self.static_prefix(knowledge_base)
+        elif knowledge_base is not None and self.knowledge_base_label is not None:
+            head = self.prefix + self.knowledge_base_section(knowledge_base)
+        else:
+            head = self.prefix
+        return head + self.body.format_map(fields)
+
+
+INITIAL_PROMPT = PromptTemplate(
+    name="analyze_purpose",
+    knowledge_base_label="# 知識ベース:",
+    prefix="""
+# 役割: あなたは、世界トップクラスのソリューションアーキテクトです。ユーザーの要件から最適な技術スタックを提案します。
+
+# 指示: 後述のユーザー要件と知識ベースに基づき、最適な技術スタック構成案を提案してください。AIモデルだけでなく、フレームワーク、DB等のAI以外のツールも網羅的に考慮し、なぜそれを選んだのか理由を明確に記述してください。
+
+# 提案フォーマット (Markdown)
+---
+### **ご提案する技術スタック**
+**1. 構成概要と選定思想**
+**2. フロントエンド**
+- **推奨ツール**:
+- **選定理由**:
+**3. バックエンド**
+- **推奨ツール**:
+- **選定理由**:
+**4. データベース**
+- **推奨ツール**:
+- **選定理由**:
+**5. 主要なAIモデル / API**
+- **推奨モデル**:
+- **選定理由**:
+**6. CI/CDとホスティング**
+- **推奨ツール**:
+- **選定理由**:
+**7. 監視・分析**
+- **推奨ツール**:
+- **選定理由**:
+**8. 開発と運用のための推奨ステップ**
+(プロジェクトを始めるための具体的な初期ステップを5〜7個程度記述)
+
+""",
+    body="""# 現在の日付: {today}
+# ユーザー要件:
+- **目的**: {purpose}
+- **プロジェクト種類**: {project_type}
+- **月額予算**: {budget}円 以下
+- **開発経験**: {experience_level}
+- **週の開発時間**: {weekly_hours}
+- **開発期間**: {development_time}ヶ月 (ユーザー入力があれば考慮)
+- **言語設定**: {language}
+
+{language_instruction}
+""",
+)
+
+# 一括処理のオフラインモード: 条件の近い複数のユーザー要件を1回の呼び出しでまとめて提案する
+BATCH_INITIAL_PROMPT = PromptTemplate(
+    name="analyze_purpose_batch",
+    knowledge_base_label=INITIAL_PROMPT.knowledge_base_label,
+    prefix=INITIAL_PROMPT.prefix + """# 一括処理の指示:
+後述の「ユーザー要件の一覧」に含まれる各要件について、それぞれ独立に上記の提案フォーマットで提案を作成してください。
+要件どうしで内容を混同しないでください。
+
+# 出力フォーマット (JSON):
+必ず以下のJSON形式で、一覧のすべての id について応答してください。
+{
+  "results": [
+    {"id": "要件のid", "suggestion": "その要件に対する提案 (Markdown)"}
+  ]
+}
+
+""",
+    body="""# 現在の日付: {today}
+# ユーザー要件の一覧 (JSON):
+{profiles}
+
+{language_instruction}
+""",
+)
+
+PROMPT_CREATION_PROMPT = PromptTemplate(
+    name="generate_prompt",
+    prefix="""
+# 役割: あなたは、プロンプトエンジニアリングの専門家です。ユーザーの要件から、AIシステムに送信するための最適化されたプロンプトを生成します。
+
+# 指示: 後述のユーザー要件を基に、AIシステムに送信するための包括的で効果的なプロンプトを生成してください。
+
+生成するプロンプトには以下の要素を含めてください：
+1. 明確なプロジェクトコンテキストと目標
+2. 技術的要件と制約
+3. 予算とタイムラインの考慮事項
+4. 経験レベルに応じた推奨事項の要求
+5. 具体的な技術スタック推奨の依頼
+6. 実装ステップとベストプラクティスの要求
+
+生成されたプロンプトは、そのままAIシステムに送信して包括的な技術スタック推奨を得られるように構成してください。
+
+# 出力フォーマット:
+生成されたプロンプトのみを出力してください（説明文は不要）。
+
+""",
+    body="""# 現在の日付: {today}
+
+# ユーザー要件:
+- **目的**: {purpose}
+- **プロジェクト種類**: {project_type}
+- **月額予算**: {budget}円 以下
+- **開発経験**: {experience_level}
+- **週の開発時間**: {weekly_hours}
+- **開発期間**: {development_time}ヶ月
+- **言語設定**: {language}
+
+{language_instruction}
+""",
+)
+
+FULL_PROPOSAL_PROMPT = PromptTemplate(
+    name="generate_full_proposal",
+    knowledge_base_label="# 知識ベース:",
+    prefix="""
+# 役割: あなたは、経験豊富なシニアプロジェクトマネージャー兼AIコンサルタントです。
+
+# 指示:
+後述のユーザー要件・知識ベース・初期提案を基に、投資家や経営層にも提出できる、最高品質のプロジェクト企画書を作成してください。
+以下のフォーマットと項目を**すべて**含め、具体的かつ論理的に記述してください。
+特に「6. 開発フェーズ別具体的なタスクリスト」は、ユーザーが次に行うべきアクションを明確に理解できるよう、極めて詳細に記述してください。
+
+# 企画書フォーマット (Markdown)
+---
+### **プロジェクト名案**
+- 案1: (キャッチーで覚えやすい名前)
+- 案2: (プロジェクト内容を的確に表す名前)
+- 案3: (先進性を感じさせる名前)
+### **1. 目的と背景**
+(ユーザーの「実現したいこと」をより詳細に、その背景にある課題と機会を記述)
+### **2. ターゲットユーザーと課題**
+### **3. ソリューション概要**
+(AINが提案した技術スタックと、それがどのようにユーザーの課題を解決するかを具体的な機能として記述)
+### **4. 技術スタック**
+(主要なAIモデル/API、フレームワーク、DB、クラウド、CI/CD、監視など、AINが提案した具体的なツールとその選定理由を簡潔にまとめる)
+### **5. 開発ロードマップと期間**
+(プロジェクト全体をフェーズ分けし、各フェーズの目標、主要な成果物、期間の目安を記述。ユーザーの「週に使える開発時間」と「開発経験レベル」を考慮した現実的な期間を設定。)
+### **6. 開発フェーズ別具体的なタスクリスト**
+(【最重要】「フェーズ1: 環境構築と基盤作成」「フェーズ2: コア機能実装」「フェーズ3: UI/UX改善とデプロイ」のようにフェーズ分けし、各タスクに[期間目安][スキルレベル][関連ツール]を付記し、「**💡このタスクで行き詰まったら、AINに『[タスク名]についてもっと詳しく教えて』と聞いてみてください。**」という次の対話への誘導を必ず含めること)
+### **7. 開発体制**
+(推奨されるチーム構成と役割、あるいは個人で進める場合の推奨事項を記述)
+### **8. リスク分析と対策**
+(技術的リスク、運用リスク、スケジュールリスクなどを挙げ、それぞれの対策を記述)
+### **9. 費用概算とROI（投資対効果）予測**
+(提案された技術スタックに基づく月額費用概算を具体的に記述。ROI予測は、費用対効果やビジネスインパクトを簡潔に予測。ユーザーの予算制約を考慮し、無料枠での可能性や、予算超過時の注意点を明記。)
+### **10. 競合分析と差別化**
+(類似の既存サービスや代替アプローチを挙げ、本プロジェクトの独自性や優位性を記述)
+### **11. 類似プロジェクト事例**
+(あなたの知識を基に、ユーザーの目的に近い実在のオープンソースプロジェクトや有名サービスの事例を2〜3個提示し、参考にできる点や、本プロジェクトとの違いを記述)
+### **12. 最新AIトレンドのハイライト**
+(このプロジェクトに関連する最先端のAI技術や研究動向（例：リアルタイム音声対話、エージェント技術、マルチモーダルLLMの活用事例など）を簡潔に紹介し、本プロジェクトの先進性をアピール。具体的な技術名も記述。)
+### **13. 成功指標 (KPI)**
+### **14. 今後の展望**
+(将来的な機能拡張、ビジネスモデル（フリーミアム、サブスクなど）、チーム開発支援、自動情報収集など、長期的なビジョンを記述)
+### **15. 3段階のスケーリング案**
+- **最小構成 (MVP)**:
+- **標準構成**:
+- **理想構成**:
+
+""",
+    body="""# 現在の日付: {today}
+# ユーザー要件:
+- 目的: {purpose}
+- 予算: {budget}円/月 以下
+- 経験: {experience_level}
+- 時間: {weekly_hours}/週
+- プロジェクト種類: {project_type}
+- 開発期間: {development_time}ヶ月 (ユーザー入力があれば考慮)
+- 言語設定: {language}
+
+# 初期提案 (AINによる技術スタック提案):
+{initial_suggestion}
+
+{language_instruction}
+""",
+)
+
+_REFINE_ROLE = """
+# 役割:
+あなたは「AIアドバイザー」です。ユーザーからの指示を分析し、以下のルールに従って応答を生成してください。
+"""
+
+REFINE_PROMPT = PromptTemplate(
+    name="refine_proposal",
+    prefix=_REFINE_ROLE + """
+# ルール:
+1.  まず、ユーザーの指示が「現在の企画書」に直接関連する「修正依頼」か「質問」かを判断します。
+2.  **修正依頼の場合**: 企画書を指示通りに修正し、修正後の企画書全体を生成します。応答タイプは "proposal" とします。
+3.  **質問の場合**: 企画書は変更せず、その質問に対する回答のみを生成します。応答タイプは "answer" とします。
+4.  **企画書に関係ない場合**: 「申し訳ありませんが、そのご質問にはお答えできません。企画書に関する内容でお願いします。」という固定の文章を生成します。応答タイプは "rejection" とします。
+5.  生成するテキストの最後に、`(AINからのアドバイス：無料版でのご相談はあと数回可能です。より専門的なコンサルティングや無制限の修正はProプランをご検討ください。)` というメッセージを**含めないでください**。
+
+# 出力フォーマット (JSON):
+必ず以下のJSON形式で応答してください。
+{
+  "type": "proposal" | "answer" | "rejection",
+  "content": "ここに生成したテキスト（企画書全体、回答、または拒否メッセージ）を入れる"
+}
+
+""",
+    body="""{language_instruction}
+
+---
+# 入力情報
+
+## 現在の企画書:
+```markdown
+{current_proposal}
+```
+
+## ユーザーの初期要件:
+```json
+{user_payload_json}
+```
+
+{conversation}## ユーザーからの今回の指示:
+「{refinement_request}」
+
+---
+# あなたの応答 (JSON形式で):
+""",
+)
+
+SECTION_REFINE_PROMPT = PromptTemplate(
+    name="refine_proposal_sections",
+    prefix=_REFINE_ROLE + """
+# ルール:
+1.  まず、ユーザーの指示が「現在の企画書」に直接関連する「修正依頼」か「質問」かを判断します。
+2.  **修正依頼の場合**: 企画書全体は再生成せず、変更が必要なセクションだけをパッチとして返します。応答タイプは "proposal" とし、content には変更内容の短い要約を入れます。
+3.  **質問の場合**: 企画書は変更せず、その質問に対する回答のみを生成します。応答タイプは "answer" とし、patches は空にします。
+4.  **企画書に関係ない場合**: 「申し訳ありませんが、そのご質問にはお答えできません。企画書に関する内容でお願いします。」という固定の文章を生成します。応答タイプは "rejection" とします。
+5.  パッチの content には、見出し行を含むセクション全体の Markdown を入れてください。本文を提示していないセクションを変更する場合も、セクション全体を書き直してください。
+
+# 出力フォーマット (JSON):
+必ず以下のJSON形式で応答してください。
+{
+  "type": "proposal" | "answer" | "rejection",
+  "content": "変更内容の要約、回答、または拒否メッセージ",
+  "patches": [
+    {"op": "replace" | "insert_after" | "delete", "section_id": "s3", "content": "見出しを含むセクション全体のMarkdown"}
+  ]
+}
+
+""",
+    body="""{language_instruction}
+
+---
+# 入力情報
+
+## 企画書の目次 (セクションID: 見出し):
+{outline}
+
+## 修正対象と思われるセクションの本文:
+{target_sections}
+
+## ユーザーの初期要件:
+- 目的: {purpose}
+- プロジェクト種類: {project_type}
+- 予算: {budget}円/月 以下
+- 経験: {experience_level}
+
+{conversation}## ユーザーからの今回の指示:
+「{refinement_request}」
+
+---
+# あなたの応答 (JSON形式で):
+""",
+)
+
+CUSTOM_PROMPT = PromptTemplate(
+    name="execute_custom_prompt",
+    knowledge_base_label="# Knowledge Base:",
+    prefix="""
+Please provide a comprehensive and helpful response based on the user's request and the available knowledge base.
+
+""",
+    body="""
+# User's Custom Prompt:
+{prompt}
+
+{language_instruction}
+""",
+)
+
+TEMPLATES = {
+    template.name: template
+    for template in (
+        INITIAL_PROMPT,
+        BATCH_INITIAL_PROMPT,
+        PROMPT_CREATION_PROMPT,
+        FULL_PROPOSAL_PROMPT,
+        REFINE_PROMPT,
+        SECTION_REFINE_PROMPT,
+        CUSTOM_PROMPT,
+    )
+}
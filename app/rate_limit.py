@@ -0,0 +1,385 @@
+# app/rate_limit.py
+# クライアントごとのレート制限と受け付け制御
+# Geminiを呼び出すエンドポイントごとにトークンバケットを用意し、クライアント (APIキーまたはIPアドレス) 単位で
+# 消費する。1回あたりの消費量はモデルの費用に合わせて重み付けする (pro は flash の数倍)。
+# 判定はルーティングや本文の読み込みより前 (ASGIミドルウェア) で行い、超過時はすぐに 429 + Retry-After を返す。
+# リクエスト本文の大きさも同じ場所で制限する。
+# バケットはメモリ (ワーカーごと) または SQLite (gunicornの全ワーカーで共有) に保存する。
+
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from fastapi import HTTPException
+
+from app import metrics
+from app.metrics import REGISTRY
+from app.retrieval import estimate_tokens
+
+RATE_LIMIT_DECISIONS = REGISTRY.counter(
+    "ain_rate_limit_decisions_total", "レート制限の判定結果 (admitted / rejected)", ("endpoint", "decision")
+)
+PAYLOAD_REJECTIONS = REGISTRY.counter(
+    "ain_payload_too_large_total", "本文またはプロンプトが大きすぎるため 413 を返したリクエスト数", ("endpoint", "kind")
+)
+
+
+@dataclass(frozen=True)
+class RateLimitRule:
+    bucket: str  # バケット名 (エンドポイントごと)
+    cost: float  # 1リクエスト (charged_by_endpoint の場合は1単位) で消費するトークン数
+    capacity: float  # バケットの容量 (連続して受け付けられる量)
+    refill_per_second: float
+    # クエリパラメータを受け取り、Geminiを呼ばないリクエスト (/analyze_purpose/?mode=fast など) なら True を返す
+    exempt: Optional[Callable[[Dict[str, str]], bool]] = None
+    # 消費量が本文の内容で決まるエンドポイント (一括処理など)。ミドルウェアでは消費せず、エンドポイントが charge() で
+    # 単位数 (Geminiの呼び出し回数など) × cost を消費する
+    charged_by_endpoint: bool = False
+
+
+@dataclass
+class Decision:
+    allowed: bool
+    remaining: float
+    retry_after: float  # 拒否した場合、必要なトークンが貯まるまでの秒数
+
+
+def _refill(tokens: float, updated: float, now: float, rule: RateLimitRule) -> float:
+    return min(rule.capacity, tokens + max(0.0, now - updated) * rule.refill_per_second)
+
+
+def _decide(tokens: float, rule: RateLimitRule) -> Tuple[Decision, float]:
+    """(判定, 消費後のトークン数) を返す。容量より大きい消費は容量いっぱいで受け付ける。"""
+    cost = min(rule.cost, rule.capacity)
+    if tokens >= cost:
+        return Decision(True, tokens - cost, 0.0), tokens - cost
+    wait = (cost - tokens) / rule.refill_per_second if rule.refill_per_second > 0 else math.inf
+    return Decision(False, tokens, wait), tokens
+
+
+class MemoryBucketStore:
+    """ワーカープロセス内のバケット。gunicorn では各ワーカーが別々に数える。"""
+
+    def __init__(self, max_buckets: int = 100000):
+        self.max_buckets = max_buckets
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rule: RateLimitRule) -> Decision:
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (rule.capacity, now))
+            decision, tokens = _decide(_refill(tokens, updated, now, rule), rule)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_buckets:
+                # 満タンまで回復したバケットは初期状態と同じなので捨てる
+                self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < rule.capacity / max(rule.refill_per_second, 1e-9)}
+        return decision
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "buckets": len(self._buckets)}
+
+
+class SQLiteBucketStore:
+    """SQLiteファイルに保存するバケット。同じファイルを使う全ワーカーで残量を共有する。"""
+
+    # この回数ごとに、満タンまで回復した古い行を削除する
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str, table: str = "rate_limit_buckets"):
+        self.path = path
+        self.table = table
+        self._operations = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._connect().execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key: str, rule: RateLimitRule) -> Decision:
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(f"SELECT tokens, updated FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            tokens = rule.capacity if row is None else _refill(row[0], row[1], now, rule)
+            decision, tokens = _decide(tokens, rule)
+            full_at = now + (rule.capacity - tokens) / rule.refill_per_second if rule.refill_per_second > 0 else math.inf
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                (key, tokens, now, full_at),
+            )
+            self._operations += 1
+            if self._operations % self.PRUNE_EVERY == 0:
+                conn.execute(f"DELETE FROM {self.table} WHERE full_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return decision
+
+    def stats(self) -> Dict[str, Any]:
+        (count,) = self._connect().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        return {"backend": "sqlite", "path": self.path, "table": self.table, "buckets": count}
+
+
+def create_bucket_store(backend: str, sqlite_path: str):
+    """設定に応じてバケットの保存先を作る。backend が 'off' の場合は None (レート制限なし。本文の上限は有効)。"""
+    backend = backend.lower()
+    if backend in ("off", "none", "disabled", ""):
+        return None
+    if backend == "sqlite":
+        return SQLiteBucketStore(sqlite_path)
+    if backend != "memory":
+        logging.warning(f"不明なレート制限バックエンド '{backend}' が指定されたため、memory を使用します。")
+    return MemoryBucketStore()
+
+
+def retry_after_seconds(decision: Decision) -> int:
+    return max(1, math.ceil(decision.retry_after)) if math.isfinite(decision.retry_after) else 3600
+
+
+def _too_many_requests_detail(retry_after: int) -> str:
+    return f"リクエストが多すぎます。{retry_after}秒ほど待ってから再度お試しください。"
+
+
+class RateLimitedError(HTTPException):
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=429,
+            detail=_too_many_requests_detail(retry_after),
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.retry_after = retry_after
+
+
+class RequestCostTooLargeError(HTTPException):
+    def __init__(self, cost: float, capacity: float):
+        super().__init__(
+            status_code=413,
+            detail=f"一度に処理できる量を超えています。(消費 {cost:g} / 上限 {capacity:g}) 分割して送信してください。",
+        )
+
+
+class PromptTooLargeError(HTTPException):
+    def __init__(self, tokens: int, limit: int):
+        super().__init__(
+            status_code=413,
+            detail=f"入力が長すぎるため処理できません。(推定 {tokens:,} トークン / 上限 {limit:,} トークン)",
+        )
+
+
+def check_prompt_size(prompt: str, limit: int, endpoint: str) -> None:
+    """Geminiに送る前にプロンプトの推定トークン数を確認する (limit が 0 以下なら無制限)。"""
+    if limit <= 0:
+        return
+    tokens = estimate_tokens(prompt)
+    if tokens > limit:
+        current = metrics.current()
+        PAYLOAD_REJECTIONS.inc(current.endpoint if current is not None else endpoint, "prompt")
+        raise PromptTooLargeError(tokens, limit)
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        store,
+        rules: Dict[str, RateLimitRule],
+        api_keys: Iterable[str] = (),
+        trust_forwarded: bool = False,
+        forwarded_hops: int = 1,
+        max_body_bytes: int = 256 * 1024,
+    ):
+        self.store = store
+        self.rules = rules
+        # パスパラメータを含むルール ("/proposal_sessions/{session_id}/refine" など) は正規表現で照合する
+        self._patterns = [
+            (re.compile("^" + re.sub(r"\\{[^}]+\\}", "[^/]+", re.escape(path)) + "$"), rule)
+            for path, rule in rules.items()
+            if "{" in path
+        ]
+        self.api_keys = frozenset(k for k in api_keys if k)
+        self.trust_forwarded = trust_forwarded
+        self.forwarded_hops = max(1, forwarded_hops)
+        self.max_body_bytes = max_body_bytes
+        self.admitted = 0
+        self.rejected = 0
+
+    def client_id(self, scope) -> str:
+        """登録済みのAPIキー (X-API-Key) があればキー単位、無ければIPアドレス単位で数える。"""
+        api_key = _header(scope, b"x-api-key")
+        if api_key and api_key in self.api_keys:
+            return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+        if self.trust_forwarded:
+            # 左側の値はクライアントが自由に付けられるため、信頼するプロキシ (forwarded_hops 段) が追加した値を使う
+            forwarded = [part.strip() for part in (_header(scope, b"x-forwarded-for") or "").split(",") if part.strip()]
+            if forwarded:
+                return "ip:" + forwarded[-min(self.forwarded_hops, len(forwarded))]
+        client = scope.get("client")
+        return "ip:" + (client[0] if client else "unknown")
+
+    def rule_for(self, path: str) -> Optional[RateLimitRule]:
+        rule = self.rules.get(path)
+        if rule is None:
+            rule = next((rule for pattern, rule in self._patterns if pattern.match(path)), None)
+        return rule
+
+    def check(self, scope) -> Tuple[Optional[RateLimitRule], Optional[Decision]]:
+        rule = self.rule_for(scope.get("path", ""))
+        if rule is None or self.store is None or scope.get("method") != "POST":
+            return None, None
+        if rule.charged_by_endpoint:
+            return rule, None
+        if rule.exempt is not None:
+            query = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+            if rule.exempt(query):
+                return rule, None
+        return rule, self._take(scope, rule)
+
+    def charge(self, scope, bucket: str, units: int) -> None:
+        """charged_by_endpoint のルールで、本文から計算した units × cost を消費する。足りなければ RateLimitedError (429)。"""
+        rule = self.rules[bucket]
+        cost = units * rule.cost
+        if self.store is None or cost <= 0:
+            return
+        if cost > rule.capacity:
+            # 容量を超える量は、待っても受け付けられない
+            PAYLOAD_REJECTIONS.inc(rule.bucket, "cost")
+            raise RequestCostTooLargeError(cost, rule.capacity)
+        decision = self._take(scope, replace(rule, cost=cost))
+        if decision is not None and not decision.allowed:
+            raise RateLimitedError(retry_after_seconds(decision))
+
+    def _take(self, scope, rule: RateLimitRule) -> Optional[Decision]:
+        try:
+            decision = self.store.take(f"{self.client_id(scope)}|{rule.bucket}", rule)
+        except Exception as e:
+            # 保存先の障害でサービス全体を止めないよう、判定できない場合は受け付ける
+            logging.error(f"レート制限の判定に失敗したため、リクエストを受け付けます: {e}")
+            return None
+        if decision.allowed:
+            self.admitted += 1
+        else:
+            self.rejected += 1
+        RATE_LIMIT_DECISIONS.inc(rule.bucket, "admitted" if decision.allowed else "rejected")
+        return decision
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "max_body_bytes": self.max_body_bytes,
+            "rules": {
+                path: {
+                    "cost": rule.cost,
+                    "capacity": rule.capacity,
+                    "refill_per_second": rule.refill_per_second,
+                    "exempt_by_query": rule.exempt is not None,
+                    "charged_by_endpoint": rule.charged_by_endpoint,
+                }
+                for path, rule in self.rules.items()
+            },
+            "store": self.store.stats() if self.store is not None else {"backend": "off"},
+        }
+
+
+async def _send_json(send, status: int, detail: str, headers: Iterable[Tuple[bytes, bytes]] = ()) -> None:
+    body = json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("ascii")), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    """対象のエンドポイントで、本文の大きさとレート制限を本文の読み込み・ルーティングより前に判定する。"""
+
+    def __init__(self, app, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limiter = self.limiter
+        # ルーティング前に応答するため、計測上のエンドポイント名はルールのパス (パスパラメータを含まない形) にする
+        matched = limiter.rule_for(scope.get("path", ""))
+        path = matched.bucket if matched is not None else "unmatched"
+
+        content_length = _header(scope, b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limiter.max_body_bytes:
+            await self._reject_body(path, send)
+            return
+
+        rule, decision = limiter.check(scope)
+        if rule is not None:
+            self._label(rule.bucket)
+        if decision is not None and not decision.allowed:
+            retry_after = retry_after_seconds(decision)
+            await _send_json(send, 429, _too_many_requests_detail(retry_after), [(b"retry-after", str(retry_after).encode("ascii"))])
+            return
+
+        if content_length is None and scope.get("method") in ("POST", "PUT", "PATCH"):
+            # Content-Length の無い (chunked) 本文は、上限まで先に読み込んでから渡す
+            messages = []
+            received = 0
+            while True:
+                message = await receive()
+                messages.append(message)
+                if message["type"] != "http.request":
+                    break
+                received += len(message.get("body", b""))
+                if received > limiter.max_body_bytes:
+                    await self._reject_body(path, send)
+                    return
+                if not message.get("more_body", False):
+                    break
+
+            async def replay():
+                return messages.pop(0) if messages else await receive()
+
+            await self.app(scope, replay, send)
+            return
+
+        await self.app(scope, receive, send)
+
+    async def _reject_body(self, path: str, send) -> None:
+        self._label(path)
+        PAYLOAD_REJECTIONS.inc(path, "body")
+        await _send_json(send, 413, f"リクエストが大きすぎます。(上限: {self.limiter.max_body_bytes:,}バイト)")
+
+    @staticmethod
+    def _label(path: str) -> None:
+        current = metrics.current()
+        if current is not None:
+            current.name = path
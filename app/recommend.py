@@ -0,0 +1,283 @@
+# app/recommend.py
+# LLMを使わないローカルの推薦 (/analyze_purpose/?mode=fast)
+# 知識ベースの構造化データだけでカテゴリごとにツールを順位付けする。
+#   予算: 月額予算と cost_tier / 無料枠 (free_tier_details) の有無
+#   経験: experience_level と learning_difficulty
+#   用途: purpose / project_type と use_cases / functions のキーワード一致 (IDFで重み付け)
+# 同じ入力には常に同じ結果を返す。mode=hybrid では、ここで絞り込んだ候補だけをGeminiに渡す。
+
+import math
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from app.knowledge_base import KnowledgeRecord, KnowledgeSnapshot
+from app.retrieval import experience_level, tokenize
+
+# キーワード一致に使うフィールド (00_ai_models.json は use_case / features)
+_KEYWORD_FIELDS = ("use_cases", "functions", "use_case", "features")
+
+# スコアの重み (合計 1.0)
+KEYWORD_WEIGHT = 0.4
+BUDGET_WEIGHT = 0.3
+DIFFICULTY_WEIGHT = 0.3
+
+# この金額 (円/月) 未満は小規模予算として扱い、有料・従量課金のツールを下げる
+SMALL_BUDGET = 10000
+
+# 費用区分ごとの予算適合度: (予算ゼロ, 小規模予算, それ以上)。None は候補から除外する
+_BUDGET_FIT = {
+    "無料": (1.0, 1.0, 1.0),
+    "フリーミアム": (0.8, 0.9, 0.9),
+    "従量課金": (0.2, 0.5, 0.8),
+    "有料": (None, 0.2, 0.7),
+}
+# 無料枠がある場合の加点 (従量課金・有料でも小さく試せる)
+_FREE_TIER_BONUS = 0.15
+
+# 1段階難しいごとの減点
+_DIFFICULTY_PENALTY = 0.4
+
+# カテゴリ (data/ のファイル名) の表示名。type はファイルをまたいで "ツール" "プラットフォーム" などが重複するため使わない
+CATEGORY_LABELS = {
+    "ai_models": "AIモデル",
+    "project_management": "プロジェクト管理",
+    "vcs_hosting": "バージョン管理",
+    "monitoring_analytics": "監視・分析",
+    "security_auth": "認証・セキュリティ",
+    "cicd": "CI/CD",
+    "cloud_hosting": "ホスティング",
+    "databases": "データベース",
+    "containerization": "コンテナ",
+    "testing_frameworks": "テスト",
+    "documentation_collaboration": "ドキュメント・コラボレーション",
+}
+# language=en のマークダウン用
+CATEGORY_LABELS_EN = {
+    "ai_models": "AI models",
+    "project_management": "Project management",
+    "vcs_hosting": "Version control",
+    "monitoring_analytics": "Monitoring & analytics",
+    "security_auth": "Auth & security",
+    "cicd": "CI/CD",
+    "cloud_hosting": "Hosting",
+    "databases": "Databases",
+    "containerization": "Containers",
+    "testing_frameworks": "Testing",
+    "documentation_collaboration": "Docs & collaboration",
+}
+COST_TIER_LABELS_EN = {
+    "無料": "free",
+    "フリーミアム": "freemium",
+    "従量課金": "pay-as-you-go",
+    "有料": "paid",
+}
+# 難易度 (retrieval.difficulty_level の値) の上限と英語の表示名
+_DIFFICULTY_LABELS_EN = (
+    (0.75, "very easy"),
+    (1.25, "easy"),
+    (1.75, "easy to moderate"),
+    (2.25, "moderate"),
+    (2.75, "moderate to advanced"),
+)
+
+
+def _text_values(value) -> List[str]:
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list):
+        return [str(v) for v in value]
+    return []
+
+
+def free_tier(record: KnowledgeRecord) -> Optional[str]:
+    """無料枠の説明を返す。無料枠が無い (「なし」で始まる) 場合は None。"""
+    detail = record.data.get("free_tier_details")
+    if detail is None and isinstance(record.data.get("pricing"), dict):
+        detail = record.data["pricing"].get("free_tier")
+    if not isinstance(detail, str) or not detail.strip() or detail.startswith("なし"):
+        return None
+    return detail
+
+
+def budget_fit(record: KnowledgeRecord, budget: Optional[int]) -> Optional[float]:
+    if budget is None:
+        band = 2
+    elif budget <= 0:
+        band = 0
+    else:
+        band = 1 if budget < SMALL_BUDGET else 2
+    fit = _BUDGET_FIT.get(record.cost_tier, _BUDGET_FIT["フリーミアム"])[band]
+    if fit is None:
+        return None
+    if record.cost_tier in ("従量課金", "有料") and free_tier(record):
+        fit = min(1.0, fit + _FREE_TIER_BONUS)
+    return fit
+
+
+def difficulty_label_en(level: float) -> str:
+    for upper, label in _DIFFICULTY_LABELS_EN:
+        if level <= upper:
+            return label
+    return "advanced"
+
+
+def difficulty_fit(record: KnowledgeRecord, level: float) -> float:
+    # 経験より易しいツールは減点しない
+    return max(0.0, 1.0 - _DIFFICULTY_PENALTY * max(0.0, record.difficulty - level))
+
+
+@dataclass
+class _Candidate:
+    record: KnowledgeRecord
+    terms: FrozenSet[str]
+    phrases: List[Tuple[str, FrozenSet[str]]]  # 理由の表示に使う use_cases / functions の原文とその語
+
+
+@dataclass
+class Recommendation:
+    name: str
+    category: str
+    type: str
+    score: float
+    keyword_score: float
+    budget_score: float
+    difficulty_score: float
+    cost_tier: str
+    learning_difficulty: str
+    normalized_cost_tier: str  # COST_TIERS のいずれか
+    difficulty_level: float
+    matched_use_cases: List[str] = field(default_factory=list)
+    free_tier: Optional[str] = None
+    official_website: Optional[str] = None
+
+
+@dataclass
+class RecommendationResult:
+    categories: Dict[str, List[Recommendation]]
+    total_entries: int
+
+    @property
+    def names(self) -> List[str]:
+        return [item.name for items in self.categories.values() for item in items]
+
+    def to_dict(self, language: Optional[str] = "ja") -> List[dict]:
+        labels = CATEGORY_LABELS_EN if (language or "ja").lower().startswith("en") else CATEGORY_LABELS
+        return [
+            {
+                "category": category,
+                "label": labels.get(category, category),
+                "items": [item.__dict__ for item in items],
+            }
+            for category, items in self.categories.items()
+        ]
+
+
+class Recommender:
+    """知識ベースのスナップショットごとに1つ作る (キーワードの索引を作成時に構築する)。"""
+
+    def __init__(self, snapshot: KnowledgeSnapshot):
+        self.snapshot = snapshot
+        self.candidates: List[_Candidate] = []
+        doc_freqs: Counter = Counter()
+        for record in snapshot.records:
+            phrases = [(p, frozenset(tokenize(p))) for key in _KEYWORD_FIELDS for p in _text_values(record.data.get(key))]
+            terms = frozenset().union(*(phrase_terms for _, phrase_terms in phrases))
+            doc_freqs.update(terms)
+            self.candidates.append(_Candidate(record, terms, phrases))
+        n = len(self.candidates)
+        self._idf = {term: math.log(1 + n / df) for term, df in doc_freqs.items()}
+
+    def _keyword_fit(self, query_terms: FrozenSet[str], candidate: _Candidate) -> float:
+        """クエリの語のうち、エントリの用途・機能に含まれる語の割合 (IDFで重み付け)。"""
+        total = sum(self._idf.get(t, 0.0) for t in query_terms)
+        if not total:
+            return 0.0
+        return sum(self._idf[t] for t in query_terms if t in candidate.terms) / total
+
+    def recommend(self, query: str, budget: Optional[int] = None, experience: Optional[str] = None, top_k: int = 3) -> RecommendationResult:
+        query_terms = frozenset(tokenize(query))
+        level = experience_level(experience)
+        ranked: Dict[str, List[Recommendation]] = {c: [] for c in self.snapshot.categories}
+        for candidate in self.candidates:
+            record = candidate.record
+            budget_score = budget_fit(record, budget)
+            if budget_score is None:
+                continue
+            keyword_score = self._keyword_fit(query_terms, candidate)
+            difficulty_score = difficulty_fit(record, level)
+            score = KEYWORD_WEIGHT * keyword_score + BUDGET_WEIGHT * budget_score + DIFFICULTY_WEIGHT * difficulty_score
+            matched = [p for p, phrase_terms in candidate.phrases if phrase_terms & query_terms] if keyword_score else []
+            ranked[record.category].append(Recommendation(
+                name=record.name,
+                category=record.category,
+                type=record.type,
+                score=round(score, 4),
+                keyword_score=round(keyword_score, 4),
+                budget_score=round(budget_score, 4),
+                difficulty_score=round(difficulty_score, 4),
+                cost_tier=record.cost_tier_detail,
+                learning_difficulty=str(record.data.get("learning_difficulty") or record.data.get("difficulty") or ""),
+                normalized_cost_tier=record.cost_tier,
+                difficulty_level=record.difficulty,
+                matched_use_cases=matched[:3],
+                free_tier=free_tier(record),
+                official_website=record.data.get("official_website"),
+            ))
+        # 同点の場合は知識ベースでの並び順 (sort は安定) を保つ
+        for items in ranked.values():
+            items.sort(key=lambda item: -item.score)
+            del items[top_k:]
+        return RecommendationResult(categories=ranked, total_entries=len(self.candidates))
+
+    def render_shortlist(self, result: RecommendationResult) -> str:
+        """推薦結果のエントリだけをプロンプト用の知識ベース (JSON配列) にする。並びは知識ベースの順。"""
+        chosen = {(item.category, item.name) for items in result.categories.values() for item in items}
+        return "[" + ", ".join(r.serialized for r in self.snapshot.records if (r.category, r.name) in chosen) + "]"
+
+
+def render_markdown(result: RecommendationResult, language: Optional[str] = "ja") -> str:
+    """LLMの初期提案と同じくマークダウンで、カテゴリごとの推薦を表示する。
+
+    language=en の場合、カテゴリ・費用区分・難易度は英語の表示名にする。用途は知識ベースの原文 (日本語) のため表示しない。
+    """
+    english = (language or "ja").lower().startswith("en")
+    lines = ["### Recommended stack" if english else "### おすすめの構成", ""]
+    for category, items in result.categories.items():
+        if not items:
+            continue
+        best = items[0]
+        if english:
+            label = CATEGORY_LABELS_EN.get(category, category)
+            reasons = [COST_TIER_LABELS_EN.get(best.normalized_cost_tier, best.normalized_cost_tier)]
+            reasons.append("difficulty: " + difficulty_label_en(best.difficulty_level))
+        else:
+            label = CATEGORY_LABELS.get(category, category)
+            reasons = [best.cost_tier]
+            if best.learning_difficulty:
+                reasons.append("難易度: " + best.learning_difficulty)
+            if best.matched_use_cases:
+                reasons.append("用途: " + " / ".join(best.matched_use_cases))
+        lines.append(f"- **{label}**: {best.name} ({', '.join(reasons)})")
+        alternatives = [item.name for item in items[1:]]
+        if alternatives:
+            lines.append(("  - Alternatives: " if english else "  - 代替案: ") + ", ".join(alternatives))
+    lines.append("")
+    lines.append(
+        "_Ranked locally from the knowledge base by budget, experience and keyword match._"
+        if english
+        else "_予算・経験・用途のキーワード一致から知識ベースをもとに自動で順位付けした結果です。_"
+    )
+    return "\n".join(lines) + "\n"
+
+
+_recommender: Optional[Recommender] = None
+
+
+def recommender_for(snapshot: KnowledgeSnapshot) -> Recommender:
+    """スナップショットが差し替わった (知識ベースが再読み込みされた) 場合だけ作り直す。"""
+    global _recommender
+    current = _recommender
+    if current is None or current.snapshot is not snapshot:
+        current = _recommender = Recommender(snapshot)
+    return current
@@ -0,0 +1,236 @@
+# app/resilience.py
+# Gemini呼び出しの耐障害ラッパー
+# - 一時的なエラー (レート制限・タイムアウト・5xx) のみをジッター付き指数バックオフで再試行
+# - エンドポイントごとの全体の締め切り (deadline)
+# - pro の締め切りが危うくなったら flash にフォールバック
+# - 上流が落ちている間はサーキットブレーカーで即座に失敗させる
+# invoke(model_name, timeout) を差し替えれば、ローカルの偽モデルに対してもテストできる。
+
+import asyncio
+import random
+import time
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from typing import Any, AsyncContextManager, Awaitable, Callable, Dict, Optional
+
+from fastapi import HTTPException
+
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """再試行すれば成功する可能性のあるエラーかどうか。"""
+    if isinstance(exc, HTTPException):
+        # UpstreamBusyError などアプリ側で判断済みのもの
+        return False
+    if isinstance(exc, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    # google.api_core.exceptions.GoogleAPICallError は HTTPステータスを code に持つ
+    code = getattr(exc, "code", None)
+    return isinstance(code, int) and code in RETRYABLE_STATUS_CODES
+
+
+class UpstreamDeadlineError(HTTPException):
+    def __init__(self, deadline: float):
+        super().__init__(
+            status_code=504,
+            detail=f"AIの応答が制限時間 ({deadline:.0f}秒) 内に得られませんでした。少し時間を置いてから再度お試しください。",
+        )
+
+
+class CircuitOpenError(HTTPException):
+    def __init__(self, model_name: str, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail=f"AIサービスが一時的に利用できません。{retry_after}秒ほど待ってから再度お試しください。(モデル: {model_name})",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.model_name = model_name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """連続した失敗が閾値に達したら一定時間呼び出しを遮断する。
+
+    遮断時間が過ぎると1件だけ試行を通し (half-open)、成功すれば復帰、失敗すれば再び遮断する。
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self._clock() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        if self.opened_at is None:
+            return 0
+        return max(1, int(self.reset_timeout - (self._clock() - self.opened_at)) + 1)
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._trial_in_flight or self.failures >= self.failure_threshold:
+            self.opened_at = self._clock()
+        self._trial_in_flight = False
+
+    def record_ignored(self) -> None:
+        """上流の健全性と無関係な結果 (入力エラーや混雑による拒否など)。"""
+        self._trial_in_flight = False
+
+
+@dataclass
+class CallResult:
+    value: Any
+    model_name: str
+    attempts: int
+    fallback_used: bool
+
+
+class ResilientCaller:
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        sleep: Callable[[float], Awaitable[None]] = asyncio.sleep,
+        clock: Callable[[], float] = time.monotonic,
+        rng: Callable[[], float] = random.random,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._sleep = sleep
+        self._clock = clock
+        self._rng = rng
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, model_name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model_name)
+        if breaker is None:
+            breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout, clock=self._clock)
+            self._breakers[model_name] = breaker
+        return breaker
+
+    def backoff(self, attempt: int) -> float:
+        """attempt 回目の失敗後の待ち時間 (full jitter)。"""
+        return min(self.max_delay, self.base_delay * (2 ** (attempt - 1))) * self._rng()
+
+    async def call(
+        self,
+        invoke: Callable[[str, float], Awaitable[Any]],
+        model_name: str,
+        deadline: float,
+        fallback_model: Optional[str] = None,
+        fallback_reserve: float = 0.0,
+        slot: Optional[Callable[[str], AsyncContextManager[Any]]] = None,
+    ) -> CallResult:
+        """invoke(モデル名, 1回の試行のタイムアウト秒) を締め切りまで再試行する。
+
+        fallback_model を指定すると、締め切りまでの残りが fallback_reserve 秒を切ったとき、
+        主モデルの再試行回数を使い切ったとき、または主モデルのサーキットが開いているときに
+        フォールバック先で試行する。主モデルの各試行はフォールバック用の時間を残して打ち切る。
+        slot(モデル名) を渡すと、各試行の前に実行枠を確保する。枠を待つ時間は締め切りには含めるが、
+        試行のタイムアウトやサーキットブレーカーの失敗には数えない (混雑は上流の不調ではないため)。
+        """
+        start = self._clock()
+        attempts: Dict[str, int] = {}
+        last_exc: Optional[BaseException] = None
+
+        while True:
+            remaining = deadline - (self._clock() - start)
+            if remaining <= 0:
+                raise UpstreamDeadlineError(deadline)
+
+            current = model_name
+            if fallback_model and (attempts.get(model_name, 0) >= self.max_attempts or remaining <= fallback_reserve):
+                current = fallback_model
+            if attempts.get(current, 0) >= self.max_attempts:
+                raise last_exc  # type: ignore[misc]
+            if not self.breaker(current).allow():
+                if not fallback_model or current == fallback_model:
+                    raise CircuitOpenError(current, self.breaker(current).retry_after())
+                # 主モデルのサーキットが開いている間はフォールバック先で生成する
+                current = fallback_model
+                if attempts.get(current, 0) >= self.max_attempts:
+                    raise last_exc  # type: ignore[misc]
+                if not self.breaker(current).allow():
+                    raise CircuitOpenError(current, self.breaker(current).retry_after())
+
+            breaker = self.breaker(current)
+            async with AsyncExitStack() as stack:
+                if slot is not None:
+                    try:
+                        await asyncio.wait_for(stack.enter_async_context(slot(current)), remaining)
+                    except asyncio.TimeoutError:
+                        breaker.record_ignored()
+                        raise UpstreamDeadlineError(deadline) from None
+                    except BaseException:
+                        breaker.record_ignored()
+                        raise
+                    remaining = deadline - (self._clock() - start)
+
+                timeout = remaining
+                if current != fallback_model and fallback_model:
+                    timeout = remaining - fallback_reserve
+                if timeout <= 0:
+                    # 枠を待つ間に試行の時間が無くなった。試行には数えず、締め切りとフォールバックの判定からやり直す
+                    breaker.record_ignored()
+                    continue
+                attempts[current] = attempts.get(current, 0) + 1
+                try:
+                    value = await asyncio.wait_for(invoke(current, timeout), timeout)
+                except asyncio.CancelledError:
+                    breaker.record_ignored()
+                    raise
+                except Exception as exc:
+                    if not is_retryable(exc):
+                        breaker.record_ignored()
+                        raise
+                    breaker.record_failure()
+                    last_exc = exc
+                else:
+                    breaker.record_success()
+                    return CallResult(
+                        value=value,
+                        model_name=current,
+                        attempts=sum(attempts.values()),
+                        fallback_used=current != model_name,
+                    )
+            # 実行枠を返してからバックオフする
+            delay = self.backoff(attempts[current])
+            remaining = deadline - (self._clock() - start)
+            if delay < remaining:
+                await self._sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            name: {"state": b.state, "consecutive_failures": b.failures}
+            for name, b in self._breakers.items()
+        }
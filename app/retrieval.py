@@ -0,0 +1,248 @@
+# app/retrieval.py
+# 知識ベース検索インデックス
+# プロンプトに知識ベース全体 (約147KB) を埋め込む代わりに、ユーザー要件に関連する
+# エントリだけをカテゴリごとに選び出す。インデックスは起動時に一度だけ構築する。
+
+import json
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 英数字は単語単位、日本語 (かな・漢字) は文字bigram単位でトークン化する
+_ASCII_WORD_RE = re.compile(r"[a-z0-9][a-z0-9+#.\-]*")
+_CJK_RUN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uff66-\uff9f]+")
+
+# 検索対象にするフィールド (data/*.json と 00_ai_models.json の両方の形式に対応)
+_TEXT_FIELDS = ("name", "type", "category_details", "functions", "use_cases", "use_case", "features", "remarks")
+
+# cost_tier (AIモデルは pricing.model) の先頭の語で費用ランクを決める: 0=無料 … 3=有料
+_COST_TIER_PREFIXES = (
+    ("基本無料", 0),
+    ("無料", 0),
+    ("オープンソース", 0),
+    ("フリーミアム", 1),
+    ("従量課金", 2),
+    ("有料", 3),
+)
+_DEFAULT_COST_RANK = 1
+# 費用ランクごとの正規化した cost_tier 名 (知識ベースの絞り込みに使う)
+COST_TIERS = ("無料", "フリーミアム", "従量課金", "有料")
+
+# learning_difficulty / difficulty に含まれる語の難易度 (複数含まれる場合は平均)
+_DIFFICULTY_KEYWORDS = (
+    ("非常に容易", 0.5),
+    ("容易", 1.0),
+    ("初心者", 1.0),
+    ("中程度", 2.0),
+    ("中級者", 2.0),
+    ("高度", 3.0),
+    ("上級者", 3.0),
+)
+_DEFAULT_DIFFICULTY = 2.0
+
+_EXPERIENCE_LEVELS = {
+    "beginner": 1.0, "初心者": 1.0,
+    "intermediate": 2.0, "中級者": 2.0,
+    "advanced": 3.0, "上級者": 3.0,
+}
+
+# BM25のパラメータ
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    text = text.lower()
+    tokens = _ASCII_WORD_RE.findall(text)
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """おおよそのトークン数を見積もる (ASCIIは4文字で1トークン、それ以外は1文字1トークン)。"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def category_from_filename(filename: str) -> str:
+    """'07_databases.json' -> 'databases'"""
+    stem = filename.rsplit(".", 1)[0]
+    return re.sub(r"^\d+_", "", stem)
+
+
+def cost_rank(entry: dict) -> int:
+    tier = entry.get("cost_tier")
+    if not tier and isinstance(entry.get("pricing"), dict):
+        tier = entry["pricing"].get("model")
+    if not isinstance(tier, str):
+        return _DEFAULT_COST_RANK
+    for prefix, rank in _COST_TIER_PREFIXES:
+        if tier.startswith(prefix):
+            return rank
+    return _DEFAULT_COST_RANK
+
+
+def difficulty_level(entry: dict) -> float:
+    text = entry.get("learning_difficulty") or entry.get("difficulty")
+    if not isinstance(text, str):
+        return _DEFAULT_DIFFICULTY
+    levels = []
+    for keyword, level in _DIFFICULTY_KEYWORDS:
+        if keyword in text:
+            levels.append(level)
+            text = text.replace(keyword, "")
+    return sum(levels) / len(levels) if levels else _DEFAULT_DIFFICULTY
+
+
+def experience_level(value: Optional[str]) -> float:
+    if not value:
+        return _DEFAULT_DIFFICULTY
+    return _EXPERIENCE_LEVELS.get(value.strip().lower(), _DEFAULT_DIFFICULTY)
+
+
+def _entry_text(entry: dict) -> str:
+    parts = []
+    for key in _TEXT_FIELDS:
+        value = entry.get(key)
+        if isinstance(value, str):
+            parts.append(value)
+        elif isinstance(value, list):
+            parts.extend(str(v) for v in value)
+    return " ".join(parts)
+
+
+@dataclass
+class IndexedEntry:
+    category: str
+    name: str
+    entry: dict
+    serialized: str  # 起動時に一度だけシリアライズしたJSON
+    estimated_tokens: int
+    term_freqs: Counter
+    length: int
+    cost_rank: int
+    difficulty: float
+
+
+@dataclass
+class RetrievalResult:
+    entries: List[IndexedEntry] = field(default_factory=list)
+    total_entries: int = 0
+
+    @property
+    def names(self) -> List[str]:
+        return [e.name for e in self.entries]
+
+    @property
+    def estimated_tokens(self) -> int:
+        return sum(e.estimated_tokens for e in self.entries)
+
+    def render(self) -> str:
+        # json.dumps(list, ensure_ascii=False) と同じ区切り文字で連結する
+        return "[" + ", ".join(e.serialized for e in self.entries) + "]"
+
+
+class KnowledgeIndex:
+    """data/*.json のエントリに対するインメモリ検索インデックス。"""
+
+    def __init__(self, items: Sequence[Tuple[str, dict]]):
+        self.entries: List[IndexedEntry] = []
+        doc_freqs: Counter = Counter()
+        for category, entry in items:
+            if not isinstance(entry, dict):
+                continue
+            serialized = json.dumps(entry, ensure_ascii=False)
+            term_freqs = Counter(tokenize(_entry_text(entry)))
+            doc_freqs.update(term_freqs.keys())
+            self.entries.append(IndexedEntry(
+                category=category,
+                name=str(entry.get("name", "")),
+                entry=entry,
+                serialized=serialized,
+                estimated_tokens=estimate_tokens(serialized),
+                term_freqs=term_freqs,
+                length=sum(term_freqs.values()),
+                cost_rank=cost_rank(entry),
+                difficulty=difficulty_level(entry),
+            ))
+        n = len(self.entries)
+        self._idf: Dict[str, float] = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()
+        }
+        self._avg_length = (sum(e.length for e in self.entries) / n) if n else 0.0
+        self.categories: List[str] = list(dict.fromkeys(e.category for e in self.entries))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _relevance(self, query_terms: Counter, item: IndexedEntry) -> float:
+        if not self._avg_length:
+            return 0.0
+        norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * item.length / self._avg_length)
+        score = 0.0
+        for term in query_terms:
+            tf = item.term_freqs.get(term)
+            if tf:
+                score += self._idf.get(term, 0.0) * tf * (_BM25_K1 + 1) / (tf + norm)
+        return score
+
+    def score(self, item: IndexedEntry, query_terms: Counter, budget: Optional[int], level: float) -> Optional[float]:
+        """エントリのスコアを返す。予算条件で除外される場合は None。"""
+        score = self._relevance(query_terms, item)
+        if budget is not None and budget <= 0:
+            # 予算ゼロでは有料ツールを除外し、従量課金は大きく減点する
+            if item.cost_rank >= 3:
+                return None
+            if item.cost_rank == 2:
+                score -= 1.0
+        score -= 0.1 * item.cost_rank
+        if item.difficulty > level:
+            score -= 0.5 * (item.difficulty - level)
+        return score
+
+    def select(
+        self,
+        query: str,
+        budget: Optional[int] = None,
+        experience: Optional[str] = None,
+        top_k: int = 3,
+        token_budget: Optional[int] = None,
+    ) -> RetrievalResult:
+        """カテゴリごとに上位 top_k 件を選び、token_budget の範囲に収める。
+
+        どのカテゴリも提案に必要なため、順位1位のエントリを全カテゴリから先に採用し、
+        次に2位、3位…と順に予算の許す限り追加する。
+        """
+        query_terms = Counter(tokenize(query))
+        level = experience_level(experience)
+
+        ranked: Dict[str, List[Tuple[float, int, IndexedEntry]]] = {c: [] for c in self.categories}
+        for position, item in enumerate(self.entries):
+            score = self.score(item, query_terms, budget, level)
+            if score is not None:
+                ranked[item.category].append((score, position, item))
+        for candidates in ranked.values():
+            candidates.sort(key=lambda c: (-c[0], c[1]))
+
+        chosen: List[Tuple[int, IndexedEntry]] = []
+        used_tokens = 0
+        for rank in range(top_k):
+            for category in self.categories:
+                candidates = ranked[category]
+                if rank >= len(candidates):
+                    continue
+                _, position, item = candidates[rank]
+                if token_budget is not None and used_tokens + item.estimated_tokens > token_budget:
+                    continue
+                chosen.append((position, item))
+                used_tokens += item.estimated_tokens
+
+        # 出力は元の知識ベースの並び順を保つ (カテゴリがまとまって読みやすい)
+        chosen.sort(key=lambda c: c[0])
+        return RetrievalResult(entries=[item for _, item in chosen], total_entries=len(self.entries))
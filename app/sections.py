@@ -0,0 +1,145 @@
+# app/sections.py
+# 企画書 (Markdown) をセクション単位に分割し、セクション単位のパッチを適用する
+# 差分修正モードでは、修正対象のセクションと目次だけをモデルに送り、
+# モデルが返したセクションごとの差し替えをサーバー側で企画書全体に反映する。
+
+import logging
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+
+from app.retrieval import tokenize
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*\S)\s*$")
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+# 「5.」「第5章」「セクション5」「section 5」のような番号指定。
+# 番号だけの形式は見出しの書き方と同じく行頭か区切りの直後に限り、「1.5倍」のような本文中の数値は拾わない
+_SECTION_NUMBER_RE = re.compile(
+    r"(?:セクション|項目|section\s*)(\d+)(?![.．]?\d)"
+    r"|(?:^|(?<=[\s、。,，(（「『第]))(\d+)\s*(?:[.．](?!\d)|章|番)",
+    re.IGNORECASE | re.MULTILINE,
+)
+_HEADING_NUMBER_RE = re.compile(r"^\**\s*(\d+)\s*[.．](?!\d)")
+
+MAX_TARGET_SECTIONS = 3
+
+
+@dataclass
+class Section:
+    id: str
+    heading: str  # 見出し行のテキスト (先頭の # を除く)。見出し前の前置き部分は空文字
+    text: str  # 見出し行を含むセクション全体の Markdown
+
+    @property
+    def number(self) -> str:
+        match = _HEADING_NUMBER_RE.match(self.heading.replace("**", "").strip())
+        return match.group(1) if match else ""
+
+
+def split_sections(markdown: str) -> List[Section]:
+    """見出し (コードブロック外の # 行) ごとに分割する。連結すると元の文字列に戻る。"""
+    sections: List[Section] = []
+    current_lines: List[str] = []
+    current_heading = ""
+    in_fence = False
+
+    def flush():
+        if current_lines:
+            sections.append(Section(id=f"s{len(sections)}", heading=current_heading, text="".join(current_lines)))
+
+    for line in markdown.splitlines(keepends=True):
+        if _FENCE_RE.match(line):
+            in_fence = not in_fence
+        match = None if in_fence else _HEADING_RE.match(line)
+        if match:
+            flush()
+            current_lines = []
+            current_heading = match.group(2).replace("**", "").strip()
+        current_lines.append(line)
+    flush()
+    return sections
+
+
+def render_sections(sections: List[Section]) -> str:
+    return "".join(section.text for section in sections)
+
+
+def outline(sections: List[Section]) -> str:
+    """モデルに渡す目次。本文は含めず、セクションIDと見出し、長さだけを示す。"""
+    lines = []
+    for section in sections:
+        heading = section.heading or "(前置き)"
+        lines.append(f"- {section.id}: {heading} ({len(section.text)}文字)")
+    return "\n".join(lines)
+
+
+def select_sections(sections: List[Section], instruction: str, limit: int = MAX_TARGET_SECTIONS) -> List[Section]:
+    """修正指示に関係するセクションを選ぶ。手掛かりが無ければ空リストを返す。"""
+    numbers = {a or b for a, b in _SECTION_NUMBER_RE.findall(instruction)}
+    query = set(tokenize(instruction))
+    scored = []
+    for position, section in enumerate(sections):
+        if not section.heading:
+            continue
+        score = 0.0
+        if section.number and section.number in numbers:
+            score += 10.0
+        heading_terms = set(tokenize(section.heading))
+        body_terms = set(tokenize(section.text))
+        score += 3.0 * len(query & heading_terms) + 0.2 * len(query & body_terms)
+        if score > 0:
+            scored.append((score, position, section))
+    if not scored:
+        return []
+    best = max(score for score, _, _ in scored)
+    chosen = [item for item in scored if item[0] >= best * 0.5]
+    chosen.sort(key=lambda item: (-item[0], item[1]))
+    chosen = sorted(chosen[:limit], key=lambda item: item[1])
+    return [section for _, _, section in chosen]
+
+
+def apply_patches(sections: List[Section], patches: List[Dict[str, Any]]) -> Tuple[List[Section], List[str]]:
+    """セクション単位のパッチを適用し、(新しいセクションのリスト, 実際に適用したセクションID) を返す。
+
+    パッチの形式: {"op": "replace" | "insert_after" | "delete", "section_id": "s3", "content": "..."}
+    存在しないセクションIDや不正なパッチは無視する。
+    """
+    by_id = {section.id: index for index, section in enumerate(sections)}
+    replacements: Dict[str, str] = {}
+    insertions: Dict[str, List[str]] = {}
+    deletions = set()
+    applied: List[str] = []
+    for patch in patches:
+        if not isinstance(patch, dict):
+            continue
+        op = patch.get("op", "replace")
+        section_id = patch.get("section_id")
+        content = patch.get("content", "")
+        if section_id not in by_id or not isinstance(content, str):
+            logging.warning(f"不正なセクションパッチを無視しました: op={op}, section_id={section_id}")
+            continue
+        if content and not content.endswith("\n"):
+            content += "\n"
+        if op == "replace":
+            replacements[section_id] = content
+        elif op == "insert_after":
+            insertions.setdefault(section_id, []).append(content)
+        elif op == "delete":
+            deletions.add(section_id)
+        else:
+            logging.warning(f"不明なパッチ操作を無視しました: {op}")
+            continue
+        if section_id not in applied:
+            applied.append(section_id)
+
+    patched: List[Section] = []
+    for section in sections:
+        if section.id not in deletions:
+            text = replacements.get(section.id, section.text)
+            # 置き換え後の本文が次の見出しと連結されないよう、末尾の改行を保つ
+            if text and section.text.endswith("\n\n") and not text.endswith("\n\n"):
+                text += "\n"
+            patched.append(Section(id=section.id, heading=section.heading, text=text))
+        for inserted in insertions.get(section.id, []):
+            patched.append(Section(id=f"{section.id}+", heading="", text=inserted))
+    return patched, applied
@@ -0,0 +1,118 @@
+# app/sessions.py
+# 企画書セッション
+# /generate_full_proposal/ で生成した企画書とユーザー要件をサーバー側に保持し、
+# 以降の修正リクエストはセッションIDと指示だけで送れるようにする。
+# 保存先は応答キャッシュと同じバックエンド (メモリ / SQLite) を使う。
+
+import asyncio
+import json
+import secrets
+import time
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from app.cache import MemoryCacheBackend, SQLiteCacheBackend
+
+# プロンプトに含める直近のやり取りの件数と、1件あたりの最大文字数
+MAX_HISTORY_TURNS = 6
+MAX_HISTORY_TEXT = 200
+
+
+def _truncate(text: str, limit: int = MAX_HISTORY_TEXT) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+@dataclass
+class ProposalSession:
+    id: str
+    user_payload: Dict[str, Any]
+    proposal: str
+    history: List[Dict[str, str]] = field(default_factory=list)
+    # MAX_HISTORY_TURNS より古いやり取りは件数と指示の要約だけを残す
+    earlier_turns: int = 0
+    earlier_summary: str = ""
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    def record_turn(self, instruction: str, response_type: str, content: str) -> None:
+        entry = {"request": _truncate(instruction), "type": response_type}
+        if response_type == "proposal":
+            self.proposal = content
+        else:
+            entry["response"] = _truncate(content)
+        self.history.append(entry)
+        while len(self.history) > MAX_HISTORY_TURNS:
+            oldest = self.history.pop(0)
+            self.earlier_turns += 1
+            self.earlier_summary = _truncate(f"{self.earlier_summary} / {oldest['request']}".strip(" /"), MAX_HISTORY_TEXT * 2)
+        self.updated_at = time.time()
+
+    def conversation_summary(self) -> str:
+        """修正プロンプトに含める、これまでのやり取りの要約。"""
+        lines = []
+        if self.earlier_turns:
+            lines.append(f"- (それ以前の{self.earlier_turns}件の指示: {self.earlier_summary})")
+        for entry in self.history:
+            line = f"- 指示: {entry['request']} → {entry['type']}"
+            if entry.get("response"):
+                line += f" ({entry['response']})"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+class SessionStore:
+    def __init__(self, backend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        # セッションIDごとのロックと、そのロックを待っているリクエスト数
+        self._locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+
+    @asynccontextmanager
+    async def locked(self, session_id: str) -> AsyncIterator[None]:
+        """同じセッションへの読み込み→修正→保存を直列化する (このプロセス内のリクエスト同士)。
+
+        同時に届いた修正リクエストが互いの結果を上書きしないよう、get() から save() までを囲んで使う。
+        """
+        lock, users = self._locks.get(session_id) or (asyncio.Lock(), 0)
+        self._locks[session_id] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[session_id]
+            if users <= 1:
+                del self._locks[session_id]
+            else:
+                self._locks[session_id] = (lock, users - 1)
+
+    def create(self, user_payload: Dict[str, Any], proposal: str) -> ProposalSession:
+        session = ProposalSession(id=secrets.token_urlsafe(16), user_payload=user_payload, proposal=proposal)
+        self.save(session)
+        return session
+
+    def get(self, session_id: str) -> Optional[ProposalSession]:
+        value = self.backend.get(session_id)
+        if value is None:
+            return None
+        return ProposalSession(**json.loads(value))
+
+    def save(self, session: ProposalSession) -> None:
+        # 保存のたびに有効期限を延長する
+        self.backend.set(session.id, json.dumps(asdict(session), ensure_ascii=False), self.ttl)
+
+    def delete(self, session_id: str) -> None:
+        self.backend.delete(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"ttl_seconds": self.ttl, **self.backend.stats()}
+
+
+def create_session_store(backend: str, ttl: float, max_sessions: int, max_bytes: int, sqlite_path: str) -> SessionStore:
+    if backend.lower() == "sqlite":
+        return SessionStore(
+            SQLiteCacheBackend(sqlite_path, max_entries=max_sessions, max_bytes=max_bytes, table="proposal_sessions"),
+            ttl=ttl,
+        )
+    return SessionStore(MemoryCacheBackend(max_entries=max_sessions, max_bytes=max_bytes), ttl=ttl)
@@ -0,0 +1,126 @@
+# app/streaming.py
+# Server-Sent Events (SSE) でGeminiの生成結果を逐次返すためのユーティリティ
+
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+_TYPE_RE = re.compile(r'"type"\s*:\s*"([^"\\]*)"')
+_CONTENT_START_RE = re.compile(r'"content"\s*:\s*"')
+_SIMPLE_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """SSEの1イベント分の文字列を作る。data は1行のJSONとして送る。"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _hex4(raw: str, pos: int) -> int:
+    """\\uXXXX の16進4桁を読む。不正な場合は json.JSONDecodeError を送出する。"""
+    digits = raw[pos:pos + 4]
+    if len(digits) != 4 or any(c not in "0123456789abcdefABCDEF" for c in digits):
+        raise json.JSONDecodeError("Invalid \\uXXXX escape", raw, pos - 2)
+    return int(digits, 16)
+
+
+class RefinementStreamParser:
+    """{"type": ..., "content": "..."} 形式のJSONを受信しながら分解する。
+
+    type が確定した時点で ("type", 値) を、content の文字列は届いた分だけ
+    デコードして ("content", 断片) を返す。type より先に content が来た場合は、
+    finish() で全体をJSONとして解析し直す。不正なエスケープや、途中で切れた・
+    形式の崩れた応答は json.JSONDecodeError として送出する。
+    """
+
+    def __init__(self) -> None:
+        self.type: Optional[str] = None
+        self._raw = ""
+        self._pos = 0  # content 文字列内の次にデコードする位置
+        self._in_content = False
+        self._content_closed = False
+        self._streamed_content = False
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        self._raw += text
+        events: List[Tuple[str, str]] = []
+        if self.type is None:
+            match = _TYPE_RE.search(self._raw)
+            content_start = _CONTENT_START_RE.search(self._raw)
+            # type の前に content が来た場合は、ストリーミングせずに最後にまとめて解析する
+            if match and (content_start is None or match.start() < content_start.start()):
+                self.type = match.group(1)
+                events.append(("type", self.type))
+        if self.type is not None and not self._in_content and not self._content_closed:
+            content_start = _CONTENT_START_RE.search(self._raw)
+            if content_start:
+                self._in_content = True
+                self._pos = content_start.end()
+        if self._in_content:
+            decoded = self._decode_available()
+            if decoded:
+                self._streamed_content = True
+                events.append(("content", decoded))
+        return events
+
+    def _decode_available(self) -> str:
+        raw = self._raw
+        out = []
+        pos = self._pos
+        while pos < len(raw):
+            ch = raw[pos]
+            if ch == '"':
+                self._in_content = False
+                self._content_closed = True
+                pos += 1
+                break
+            if ch != "\\":
+                end = pos
+                while end < len(raw) and raw[end] not in '"\\':
+                    end += 1
+                out.append(raw[pos:end])
+                pos = end
+                continue
+            # エスケープシーケンスがチャンクの境界で途切れている場合は次のチャンクを待つ
+            if pos + 1 >= len(raw):
+                break
+            esc = raw[pos + 1]
+            if esc == "u":
+                if pos + 6 > len(raw):
+                    break
+                code = _hex4(raw, pos + 2)
+                if 0xD800 <= code < 0xDC00:
+                    if pos + 12 > len(raw):
+                        break
+                    if raw[pos + 6:pos + 8] == "\\u":
+                        low = _hex4(raw, pos + 8)
+                        if 0xDC00 <= low < 0xE000:
+                            out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                            pos += 12
+                            continue
+                out.append(chr(code))
+                pos += 6
+                continue
+            if esc not in _SIMPLE_ESCAPES:
+                raise json.JSONDecodeError("Invalid \\escape", raw, pos)
+            out.append(_SIMPLE_ESCAPES[esc])
+            pos += 2
+        self._pos = pos
+        return "".join(out)
+
+    def finish(self) -> List[Tuple[str, str]]:
+        """ストリーム終了時に呼ぶ。まだ返していない type / content があれば返す。
+
+        受信した全体を json.loads で検証するので、途中で切れた応答や不正なJSONは
+        ストリーミング済みの content があっても json.JSONDecodeError を送出する。
+        """
+        response_json = json.loads(self._raw)
+        if not isinstance(response_json, dict):
+            raise json.JSONDecodeError("Expecting object", self._raw, 0)
+        if self._streamed_content or self._content_closed:
+            return []
+        events: List[Tuple[str, str]] = []
+        if self.type is None:
+            self.type = response_json.get("type", "answer")
+            events.append(("type", self.type))
+        events.append(("content", response_json.get("content", "エラー：応答を解析できませんでした。")))
+        return events
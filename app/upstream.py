@@ -0,0 +1,186 @@
+# app/upstream.py
+# Geminiへの上流呼び出しの管理
+# - モデル名ごとに GenerativeModel を一度だけ生成して使い回す
+# - モデルごとの同時実行数の上限と、ワーカー全体の上限
+# - 上限を超えたリクエストは優先度順の待ち行列に入れ、行列が満杯なら即座に 503 を返す
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+
+# 優先度 (小さいほど優先)。安価な flash の対話系エンドポイントを、重い pro の企画書生成より先に通す
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+
+class UpstreamBusyError(HTTPException):
+    """待ち行列が満杯のときに送出する。FastAPIがそのまま 503 + Retry-After を返す。"""
+
+    def __init__(self, model_name: str, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail=f"現在リクエストが混み合っています。{retry_after}秒ほど待ってから再度お試しください。(モデル: {model_name})",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.model_name = model_name
+        self.retry_after = retry_after
+
+
+class ModelPool:
+    """モデル名ごとにクライアントを一度だけ生成して共有する。"""
+
+    def __init__(self, factory: Callable[[str], Any]):
+        self._factory = factory
+        self._models: Dict[str, Any] = {}
+
+    def get(self, model_name: str) -> Any:
+        model = self._models.get(model_name)
+        if model is None:
+            model = self._factory(model_name)
+            self._models[model_name] = model
+        return model
+
+    def clear(self) -> None:
+        self._models.clear()
+
+
+class _Waiter:
+    __slots__ = ("model_name", "priority", "future", "enqueued_at")
+
+    def __init__(self, model_name: str, priority: int, future: "asyncio.Future[None]"):
+        self.model_name = model_name
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+class Lease:
+    """取得した実行枠。release() は何度呼んでもよい。"""
+
+    def __init__(self, scheduler: "UpstreamScheduler", model_name: str, wait_seconds: float):
+        self._scheduler = scheduler
+        self.model_name = model_name
+        self.wait_seconds = wait_seconds
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._scheduler._release(self.model_name)
+
+
+class UpstreamScheduler:
+    def __init__(
+        self,
+        global_limit: int,
+        model_limits: Optional[Dict[str, int]] = None,
+        default_model_limit: Optional[int] = None,
+        max_queue: int = 32,
+        retry_after: int = 5,
+    ):
+        self.global_limit = global_limit
+        self.model_limits = dict(model_limits or {})
+        self.default_model_limit = default_model_limit or global_limit
+        self.max_queue = max_queue  # 優先度ごとの待ち行列の上限
+        self.retry_after = retry_after
+        self.rejected = 0
+        self._active_total = 0
+        self._active: Dict[str, int] = {}
+        self._heap: List[tuple] = []
+        self._queued: Dict[int, int] = {}
+        self._seq = itertools.count()
+
+    def _model_limit(self, model_name: str) -> int:
+        return self.model_limits.get(model_name, self.default_model_limit)
+
+    def _has_capacity(self, model_name: str) -> bool:
+        return (
+            self._active_total < self.global_limit
+            and self._active.get(model_name, 0) < self._model_limit(model_name)
+        )
+
+    def _take(self, model_name: str) -> None:
+        self._active_total += 1
+        self._active[model_name] = self._active.get(model_name, 0) + 1
+
+    def _blocked_by_waiters(self, model_name: str, priority: int) -> bool:
+        # 同じモデルで同等以上の優先度の待ちがある場合は割り込まない
+        return any(
+            w.model_name == model_name and w.priority <= priority and not w.future.done()
+            for _, _, w in self._heap
+        )
+
+    async def acquire(self, model_name: str, priority: int = PRIORITY_INTERACTIVE) -> Lease:
+        if self._has_capacity(model_name) and not self._blocked_by_waiters(model_name, priority):
+            self._take(model_name)
+            return Lease(self, model_name, 0.0)
+
+        if self._queued.get(priority, 0) >= self.max_queue:
+            self.rejected += 1
+            raise UpstreamBusyError(model_name, self.retry_after)
+
+        waiter = _Waiter(model_name, priority, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, (priority, next(self._seq), waiter))
+        self._queued[priority] = self._queued.get(priority, 0) + 1
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 枠を割り当てられた直後にキャンセルされた場合は返却する
+                self._release(model_name)
+            else:
+                self._discard(waiter)
+            raise
+        return Lease(self, model_name, time.perf_counter() - waiter.enqueued_at)
+
+    @asynccontextmanager
+    async def slot(self, model_name: str, priority: int = PRIORITY_INTERACTIVE):
+        lease = await self.acquire(model_name, priority)
+        try:
+            yield lease
+        finally:
+            lease.release()
+
+    def _discard(self, waiter: _Waiter) -> None:
+        self._heap = [item for item in self._heap if item[2] is not waiter]
+        heapq.heapify(self._heap)
+        self._queued[waiter.priority] -= 1
+
+    def _release(self, model_name: str) -> None:
+        self._active_total -= 1
+        self._active[model_name] -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """空いた枠を、優先度の高い順に、実行可能なモデルの待ちへ割り当てる。"""
+        skipped = []
+        while self._heap and self._active_total < self.global_limit:
+            item = heapq.heappop(self._heap)
+            waiter = item[2]
+            if waiter.future.done():
+                self._queued[waiter.priority] -= 1
+                continue
+            if not self._has_capacity(waiter.model_name):
+                skipped.append(item)
+                continue
+            self._queued[waiter.priority] -= 1
+            self._take(waiter.model_name)
+            waiter.future.set_result(None)
+        for item in skipped:
+            heapq.heappush(self._heap, item)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "global_limit": self.global_limit,
+            "active": self._active_total,
+            "active_by_model": {k: v for k, v in self._active.items() if v},
+            "model_limits": self.model_limits,
+            "queued_by_priority": {k: v for k, v in self._queued.items() if v},
+            "max_queue_per_priority": self.max_queue,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,359 @@
+# benchmarks/load_test.py
+# 偽モデル (MODEL_BACKEND=fake) を使った負荷試験
+# uvicorn / gunicorn でサーバーを起動し、5つのエンドポイントを指定した同時実行数で叩いて、
+# スループット・レイテンシ (p50/p95/p99)・ワーカーごとのメモリ使用量を計測する。
+# Geminiは呼び出さないため、バックエンド自体のオーバーヘッドと処理能力だけを測れる。
+# 結果は benchmarks/results/ にJSONで保存し、--compare で以前の結果と比較できる。
+#
+# 実行方法 (リポジトリのルートで。クライアントに httpx を使う):
+#   python -m benchmarks.load_test --server uvicorn --workers 1 --concurrency 1,8,32 --requests 200
+#   python -m benchmarks.load_test --server gunicorn --workers 4 --compare benchmarks/results/<以前の結果>.json
+# 偽モデルの応答時間やエラー注入は FAKE_GEMINI_* 環境変数で指定する (app/model_clients.py を参照)。
+#   例: FAKE_GEMINI_LATENCY=lognormal:0.8,0.4 FAKE_GEMINI_429_RATE=0.05 python -m benchmarks.load_test
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from app.model_clients import DEFAULT_CANNED_OUTPUTS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# 比較時に劣化とみなす割合 (p95 の増加・スループットの低下)
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+
+def _user_payload(i: int) -> Dict[str, Any]:
+    # 応答キャッシュに当たらないよう、リクエストごとに目的を変える
+    return {
+        "purpose": f"チーム内の日報を集約して要約するWebアプリを作りたい (#{i})",
+        "projectType": "Webアプリ",
+        "budget": 3000,
+        "experienceLevel": "中級者",
+        "weeklyHours": "10時間",
+        "developmentTime": 2,
+        "language": "ja",
+    }
+
+
+ENDPOINTS: Dict[str, tuple] = {
+    "analyze_purpose": ("/analyze_purpose/", _user_payload),
+    "generate_prompt": ("/generate_prompt/", _user_payload),
+    "generate_full_proposal": (
+        "/generate_full_proposal/",
+        lambda i: {**_user_payload(i), "initialSuggestion": DEFAULT_CANNED_OUTPUTS["suggestion"]},
+    ),
+    "refine_proposal": (
+        "/refine_proposal/",
+        lambda i: {
+            "userPayload": _user_payload(i),
+            "currentProposal": DEFAULT_CANNED_OUTPUTS["proposal"],
+            "refinementRequest": f"4. 技術スタックをもっと安価な構成にしてください (#{i})",
+        },
+    ),
+    "execute_custom_prompt": (
+        "/execute_custom_prompt/",
+        lambda i: {"prompt": f"無料で使えるデータベースを教えてください (#{i})", "language": "ja"},
+    ),
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _server_command(server: str, workers: int, port: int) -> List[str]:
+    if server == "gunicorn":
+        return [
+            sys.executable, "-m", "gunicorn", "app.main:app",
+            "-k", "uvicorn.workers.UvicornWorker",
+            "-w", str(workers),
+            "-b", f"127.0.0.1:{port}",
+        ]
+    return [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers),
+    ]
+
+
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid: int) -> List[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def _worker_pids(master: int) -> List[int]:
+    """リクエストを処理するプロセス。ワーカーが1つの uvicorn ではマスター自身が処理する。"""
+    children = [pid for pid in _children(master) if _rss_kb(pid)]
+    return children or [master]
+
+
+class MemorySampler:
+    """計測中のワーカーごとの最大RSSを記録する (/proc を読むため Linux のみ)。"""
+
+    def __init__(self, master_pid: int, interval: float = 0.25):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peak_by_pid: Dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        while True:
+            for pid in _worker_pids(self.master_pid):
+                self.peak_by_pid[pid] = max(self.peak_by_pid.get(pid, 0), _rss_kb(pid))
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self) -> "MemorySampler":
+        self.peak_by_pid = {}
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def summary(self) -> Dict[str, float]:
+        peaks = [kb / 1024 for kb in self.peak_by_pid.values() if kb]
+        if not peaks:
+            return {"workers": 0, "max_rss_mb_per_worker": 0.0, "total_rss_mb": 0.0}
+        return {
+            "workers": len(peaks),
+            "max_rss_mb_per_worker": round(max(peaks), 1),
+            "total_rss_mb": round(sum(peaks), 1),
+        }
+
+
+def _percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+async def run_level(
+    client: httpx.AsyncClient,
+    name: str,
+    concurrency: int,
+    total_requests: int,
+    sampler: MemorySampler,
+    request_timeout: float,
+) -> Dict[str, Any]:
+    path, make_payload = ENDPOINTS[name]
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    next_index = 0
+
+    async def worker() -> None:
+        nonlocal next_index
+        while next_index < total_requests:
+            i = next_index
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                response = await client.post(path, json=make_payload(i), timeout=request_timeout)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    with sampler:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    ok = statuses.get("200", 0)
+    return {
+        "endpoint": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "ok": ok,
+        "errors": len(latencies) - ok,
+        "statuses": statuses,
+        "duration_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(statistics.mean(latencies), 1) if latencies else 0.0,
+        "p50_ms": round(_percentile(latencies, 50), 1),
+        "p95_ms": round(_percentile(latencies, 95), 1),
+        "p99_ms": round(_percentile(latencies, 99), 1),
+        "max_ms": round(max(latencies), 1) if latencies else 0.0,
+        **sampler.summary(),
+    }
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def _print_results(results: List[Dict[str, Any]]) -> None:
+    print(f"{'endpoint':<24}{'conc':>6}{'req':>6}{'err':>5}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'RSS/worker':>12}")
+    for r in results:
+        print(
+            f"{r['endpoint']:<24}{r['concurrency']:>6}{r['requests']:>6}{r['errors']:>5}{r['throughput_rps']:>9.1f}"
+            f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['max_rss_mb_per_worker']:>10.1f}MB"
+        )
+
+
+def compare(current: List[Dict[str, Any]], baseline_path: str, threshold: float) -> bool:
+    """以前の結果と比較して差分を表示する。劣化があれば False を返す。"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["endpoint"], r["concurrency"]): r for r in json.load(f)["results"]}
+    ok = True
+    print(f"\n比較対象: {baseline_path} (劣化の閾値: {threshold:.0%})")
+    print(f"{'endpoint':<24}{'conc':>6}{'rps':>10}{'p95':>10}{'p99':>10}{'RSS':>10}")
+
+    def delta(new: float, old: float) -> float:
+        return (new - old) / old if old else 0.0
+
+    for r in current:
+        old = baseline.get((r["endpoint"], r["concurrency"]))
+        if old is None:
+            continue
+        rps = delta(r["throughput_rps"], old["throughput_rps"])
+        p95 = delta(r["p95_ms"], old["p95_ms"])
+        p99 = delta(r["p99_ms"], old["p99_ms"])
+        rss = delta(r["max_rss_mb_per_worker"], old["max_rss_mb_per_worker"])
+        regressed = rps < -threshold or p95 > threshold
+        ok = ok and not regressed
+        mark = "  <- 劣化" if regressed else ""
+        print(f"{r['endpoint']:<24}{r['concurrency']:>6}{rps:>+10.1%}{p95:>+10.1%}{p99:>+10.1%}{rss:>+10.1%}{mark}")
+    return ok
+
+
+async def _wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("サーバーが起動前に終了しました。ログを確認してください。")
+            try:
+                if (await client.get("/", timeout=1.0)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("サーバーの起動を待っている間にタイムアウトしました。")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = {
+        **os.environ,
+        "MODEL_BACKEND": "fake",
+        # 既定では応答キャッシュを無効にして、毎回上流 (偽モデル) まで処理させる
+        "RESPONSE_CACHE_BACKEND": os.environ.get("RESPONSE_CACHE_BACKEND", "memory" if args.cache else "off"),
+        # 全リクエストが同じクライアント (127.0.0.1) から来るため、レート制限は既定で無効にする
+        "RATE_LIMIT_BACKEND": os.environ.get("RATE_LIMIT_BACKEND", "off"),
+    }
+    log_file = tempfile.NamedTemporaryFile(prefix="ain-load-test-", suffix=".log", delete=False)
+    process = subprocess.Popen(_server_command(args.server, args.workers, port), cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    results: List[Dict[str, Any]] = []
+    try:
+        await _wait_until_ready(base_url, process)
+        limits = httpx.Limits(max_connections=max(args.concurrency) * 2, max_keepalive_connections=max(args.concurrency))
+        async with httpx.AsyncClient(base_url=base_url, limits=limits) as client:
+            sampler = MemorySampler(process.pid)
+            for name in args.endpoints:
+                # 1件目はインポート後の初回処理 (知識ベースの読み込みなど) を含むため計測しない
+                await client.post(ENDPOINTS[name][0], json=ENDPOINTS[name][1](-1), timeout=args.timeout)
+                for concurrency in args.concurrency:
+                    result = await run_level(client, name, concurrency, args.requests, sampler, args.timeout)
+                    results.append(result)
+                    print(f"{name} (同時実行数 {concurrency}): {result['throughput_rps']} req/s, p95 {result['p95_ms']} ms, エラー {result['errors']}件", flush=True)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log_file.close()
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "server": args.server,
+            "workers": args.workers,
+            "requests_per_level": args.requests,
+            "response_cache": env["RESPONSE_CACHE_BACKEND"],
+            "fake_backend": {k: v for k, v in sorted(os.environ.items()) if k.startswith("FAKE_GEMINI_")},
+            "python": platform.python_version(),
+            "server_log": log_file.name,
+        },
+        "results": results,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="偽モデルを使った負荷試験")
+    parser.add_argument("--server", choices=("uvicorn", "gunicorn"), default="uvicorn")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", type=lambda v: [int(c) for c in v.split(",")], default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="同時実行数ごとのリクエスト数")
+    parser.add_argument("--endpoints", type=lambda v: v.split(","), default=list(ENDPOINTS))
+    parser.add_argument("--timeout", type=float, default=120.0, help="1リクエストのタイムアウト (秒)")
+    parser.add_argument("--cache", action="store_true", help="応答キャッシュを有効にしたまま計測する")
+    parser.add_argument("--output", help="結果の保存先 (既定: benchmarks/results/<日時>-<リビジョン>.json)")
+    parser.add_argument("--compare", help="比較する以前の結果ファイル")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+    unknown = [name for name in args.endpoints if name not in ENDPOINTS]
+    if unknown:
+        parser.error(f"不明なエンドポイント: {', '.join(unknown)}")
+
+    report = asyncio.run(run(args))
+    print()
+    _print_results(report["results"])
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{report['meta']['git_revision']}-{args.server}-w{args.workers}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {output}")
+
+    if args.compare and not compare(report["results"], args.compare, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
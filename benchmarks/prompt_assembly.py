@@ -0,0 +1,82 @@
+# benchmarks/prompt_assembly.py
+# プロンプト組み立てのマイクロベンチマーク (Geminiは呼び出さない)
+# エンドポイントごとに、組み立て時間 (平均/p95) とプロンプトサイズ (文字数・推定トークン数) を表示する。
+#
+# 実行方法 (リポジトリのルートで):
+#   python -m benchmarks.prompt_assembly [--iterations 2000]
+
+import argparse
+import logging
+import os
+import statistics
+import time
+
+# app.main はインポート時に GEMINI_API_KEY を要求するため、ダミーの値を入れておく
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+from app import main  # noqa: E402
+from app.retrieval import estimate_tokens  # noqa: E402
+from app.sections import select_sections, split_sections  # noqa: E402
+
+# 知識ベース検索のログが計測結果に混ざらないようにする
+logging.disable(logging.INFO)
+
+SAMPLE_PAYLOAD = main.UserPayload(
+    purpose="個人開発で、チーム内の日報をSlackから集約して要約するWebアプリを作りたい",
+    project_type="Webアプリ",
+    budget=3000,
+    experience_level="中級者",
+    weekly_hours="10時間",
+    development_time=2,
+    language="ja",
+)
+
+SAMPLE_PROPOSAL = "\n\n".join(
+    f"## {number}. セクション{number}\n" + "企画書の本文です。" * 80 for number in range(1, 9)
+) + "\n"
+
+
+def _builders():
+    full_request = main.FullProposalRequest(**SAMPLE_PAYLOAD.model_dump(), initial_suggestion="初回提案の本文です。" * 50)
+    refine_request = main.RefinementRequest(
+        user_payload=SAMPLE_PAYLOAD,
+        current_proposal=SAMPLE_PROPOSAL,
+        refinement_request="3. セクション3の技術スタックをもっと安価な構成にしてください",
+        mode="sections",
+    )
+    custom_request = main.CustomPromptRequest(prompt=SAMPLE_PAYLOAD.purpose, language="ja")
+    snapshot = main.KNOWLEDGE_BASE.get()
+    sections = split_sections(SAMPLE_PROPOSAL)
+    targets = select_sections(sections, refine_request.refinement_request)
+    return {
+        "analyze_purpose (検索)": lambda: main.generate_initial_prompt(SAMPLE_PAYLOAD, snapshot),
+        "analyze_purpose (全体)": lambda: main.generate_initial_prompt(SAMPLE_PAYLOAD, snapshot, knowledge_base=snapshot.text),
+        "analyze_purpose (コンテキストキャッシュ)": lambda: main.generate_initial_prompt(SAMPLE_PAYLOAD, snapshot, knowledge_base=main.CACHED_KNOWLEDGE_BASE_NOTE),
+        "generate_prompt": lambda: main.generate_prompt_creation_prompt(SAMPLE_PAYLOAD),
+        "generate_full_proposal (検索)": lambda: main.generate_full_proposal_prompt(full_request, snapshot),
+        "generate_full_proposal (全体)": lambda: main.generate_full_proposal_prompt(full_request, snapshot, knowledge_base=snapshot.text),
+        "refine_proposal (全体)": lambda: main.generate_refine_prompt(refine_request),
+        "refine_proposal (セクション)": lambda: main.generate_section_refine_prompt(refine_request, sections, targets),
+        "execute_custom_prompt (検索)": lambda: main.generate_custom_prompt(custom_request, snapshot),
+        "execute_custom_prompt (全体)": lambda: main.generate_custom_prompt(custom_request, snapshot, knowledge_base=snapshot.text),
+    }
+
+
+def run(iterations: int) -> None:
+    print(f"知識ベース: {len(main.KNOWLEDGE_BASE.get().text):,}文字 / 検索: {'有効' if main.KB_RETRIEVAL_ENABLED else '無効'} / 試行回数: {iterations}")
+    print(f"{'エンドポイント':<44}{'平均(µs)':>10}{'p95(µs)':>10}{'文字数':>10}{'推定トークン':>12}")
+    for name, build in _builders().items():
+        prompt = build()  # 初回 (前半の連結結果をキャッシュする) は計測に含めない
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            build()
+            samples.append((time.perf_counter() - started) * 1_000_000)
+        p95 = statistics.quantiles(samples, n=20)[-1] if len(samples) >= 20 else max(samples)
+        print(f"{name:<44}{statistics.mean(samples):>10.1f}{p95:>10.1f}{len(prompt):>10,}{estimate_tokens(prompt):>12,}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="プロンプト組み立て時間とサイズのマイクロベンチマーク")
+    parser.add_argument("--iterations", type=int, default=2000)
+    run(parser.parse_args().iterations)
@@ -0,0 +1,96 @@
+# benchmarks/recommend_latency.py
+# /analyze_purpose/ のモードごとのレイテンシ比較
+#   fast: ローカルの推薦のみ (Geminiを呼ばない) / hybrid: ローカルで絞り込んだ候補をGeminiに渡す / llm: 従来の経路
+# アプリをプロセス内で (httpx の ASGITransport 経由で) 呼び出し、HTTP処理を含めた応答時間を測る。
+# 既定では偽モデル (MODEL_BACKEND=fake) を使うため、LLMの経路の時間は FAKE_GEMINI_LATENCY の分布に従う。
+# 実際のGeminiと比較する場合は --backend gemini (GEMINI_API_KEY が必要。料金が発生する)。
+# 応答キャッシュは無効にし、毎回モデルを呼び出す。
+#
+# 実行方法 (リポジトリのルートで):
+#   python -m benchmarks.recommend_latency [--fast-requests 500] [--llm-requests 20]
+#   FAKE_GEMINI_FLASH_LATENCY=lognormal:2.0,0.4 python -m benchmarks.recommend_latency
+#   python -m benchmarks.recommend_latency --backend gemini --llm-requests 5
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import time
+from typing import Dict, List
+
+import httpx
+
+
+def _payload(i: int) -> Dict[str, object]:
+    # 応答キャッシュを無効にしていても、念のためリクエストごとに目的を変える
+    return {
+        "purpose": f"社内の問い合わせに答えるFAQチャットボットを作りたい (#{i})",
+        "projectType": "Webアプリ",
+        "budget": 3000,
+        "experienceLevel": "初心者",
+        "weeklyHours": "10時間",
+        "developmentTime": 2,
+        "language": "ja",
+    }
+
+
+def _summary(samples: List[float]) -> str:
+    samples = sorted(samples)
+    p95 = statistics.quantiles(samples, n=20)[-1] if len(samples) >= 20 else samples[-1]
+    return f"{statistics.mean(samples):>10.2f}{statistics.median(samples):>10.2f}{p95:>10.2f}{samples[-1]:>10.2f}"
+
+
+async def _measure(client: httpx.AsyncClient, mode: str, requests: int) -> List[float]:
+    samples = []
+    for i in range(requests):
+        started = time.perf_counter()
+        response = await client.post("/analyze_purpose/", json=_payload(i), params={"mode": mode})
+        response.raise_for_status()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+async def run(fast_requests: int, llm_requests: int) -> None:
+    from app import main
+
+    snapshot = main.KNOWLEDGE_BASE.get()
+    recommender = main.recommender_for(snapshot)
+    request = main.UserPayload.model_validate(_payload(0))
+    scoring = []
+    for _ in range(fast_requests):
+        started = time.perf_counter()
+        main.recommend_locally(request, snapshot)
+        scoring.append((time.perf_counter() - started) * 1000)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=600) as client:
+        results = {
+            "スコア計算のみ": scoring,
+            "fast": await _measure(client, "fast", fast_requests),
+            "hybrid": await _measure(client, "hybrid", llm_requests),
+            "llm": await _measure(client, "llm", llm_requests),
+        }
+
+    print(f"知識ベース: {len(recommender.candidates)}件 / モデル: {main.MODEL_BACKEND}")
+    print(f"{'モード':<20}{'件数':>6}{'平均(ms)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'最大(ms)':>10}")
+    for name, samples in results.items():
+        print(f"{name:<20}{len(samples):>6}{_summary(samples)}")
+    speedup = statistics.median(results["llm"]) / statistics.median(results["fast"])
+    print(f"fast は llm より p50 で約 {speedup:,.0f} 倍速い")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/analyze_purpose/ の fast / hybrid / llm モードのレイテンシ比較")
+    parser.add_argument("--backend", choices=("fake", "gemini"), default="fake")
+    parser.add_argument("--fast-requests", type=int, default=500)
+    parser.add_argument("--llm-requests", type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ["MODEL_BACKEND"] = args.backend
+    os.environ["RESPONSE_CACHE_BACKEND"] = "off"
+    # 全リクエストが同じクライアントから来るため、レート制限は既定で無効にする
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "off")
+    # 計測結果に各リクエストのログが混ざらないようにする
+    logging.disable(logging.INFO)
+    asyncio.run(run(args.fast_requests, args.llm_requests))